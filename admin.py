@@ -1,12 +1,148 @@
-from sqladmin import Admin, ModelView
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
-from models import User, Message
-from database import engine
-from datetime import datetime, timezone
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 
+import anyio
+from sqladmin import BaseView, ModelView, expose
+from sqladmin.pagination import PageControl, Pagination
+from sqlalchemy import false, or_, text
+from starlette.datastructures import URL
+from starlette.requests import Request
+from database import SessionLocal
+from models import User, Message, Contact, UserTheme, BackgroundJob
+from partitions import archive_tables
+from queries import conversation_filter
+from usage import usage_series
 
-class UserAdmin(ModelView, model=User):
+ESTIMATE_TTL = 60
+STATS_TABLES = (User, Message, Contact, UserTheme, BackgroundJob)
+
+_estimates: Dict[str, Tuple[float, int]] = {}
+
+
+def estimate_rows(session, table: str) -> int:
+    cached = _estimates.get(table)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    dialect = session.get_bind().dialect.name
+    estimate = None
+    if dialect == "postgresql":
+        estimate = session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE relname = :table"), {"table": table}
+        ).scalar()
+        if estimate is not None and estimate < 0:
+            estimate = None
+    elif dialect == "sqlite":
+        has_stats = session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+        ).scalar()
+        if has_stats:
+            stat = session.execute(
+                text("SELECT stat FROM sqlite_stat1 WHERE tbl = :table LIMIT 1"), {"table": table}
+            ).scalar()
+            estimate = int(stat.split()[0]) if stat else None
+    if estimate is None:
+        low, high = session.execute(text(f"SELECT MIN(id), MAX(id) FROM {table}")).one()
+        estimate = high - low + 1 if low is not None else 0
+    _estimates[table] = (time.monotonic() + ESTIMATE_TTL, estimate)
+    return estimate
+
+
+def _int_param(request: Request, name: str) -> Optional[int]:
+    value = request.query_params.get(name)
+    try:
+        return int(value) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class KeysetPagination(Pagination):
+    more_previous: bool = False
+    more_next: bool = False
+    first_id: Optional[int] = None
+    last_id: Optional[int] = None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.more_previous
+
+    @property
+    def has_next(self) -> bool:
+        return self.more_next
+
+    def add_pagination_urls(self, base_url: URL) -> None:
+        base_url = base_url.remove_query_params(["after", "before", "page"])
+        if self.more_previous:
+            self._add_page_control(base_url.include_query_params(page=self.page - 1, before=self.first_id), self.page - 1)
+        self._add_page_control(base_url.include_query_params(page=self.page), self.page)
+        if self.more_next:
+            self._add_page_control(base_url.include_query_params(page=self.page + 1, after=self.last_id), self.page + 1)
+
+    def _add_page_control(self, url: URL, page: int) -> None:
+        self.page_controls.append(PageControl(number=page, url=str(url)))
+
+
+class KeysetModelView(ModelView):
+    exact_filters: List[str] = []
+
+    def filter_query(self, stmt, request: Request):
+        for name in self.exact_filters:
+            value = _int_param(request, name)
+            if value is not None:
+                stmt = stmt.where(getattr(self.model, name) == value)
+        return stmt
+
+    def _is_filtered(self, request: Request) -> bool:
+        return bool(request.query_params.get("search")) or any(
+            _int_param(request, name) is not None for name in self.exact_filters
+        )
+
+    def _estimate_sync(self) -> int:
+        with self.session_maker() as session:
+            return estimate_rows(session, self.model.__tablename__)
+
+    async def list(self, request: Request) -> Pagination:
+        page = self.validate_page_number(request.query_params.get("page"), 1)
+        page_size = self.validate_page_number(request.query_params.get("pageSize"), 0)
+        page_size = min(page_size or self.page_size, max(self.page_size_options))
+        after = _int_param(request, "after")
+        before = _int_param(request, "before")
+        search = request.query_params.get("search")
+
+        stmt = self.filter_query(self.list_query(request), request)
+        if search:
+            stmt = self.search_query(stmt, search)
+
+        pk = self.pk_columns[0]
+        if before is not None:
+            stmt = stmt.where(pk > before).order_by(pk.asc())
+        else:
+            if after is not None:
+                stmt = stmt.where(pk < after)
+            stmt = stmt.order_by(pk.desc())
+
+        rows = list(await self._run_query(stmt.limit(page_size + 1)))
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if before is not None:
+            rows.reverse()
+
+        seen = (page - 1) * page_size + len(rows)
+        estimate = 0 if self._is_filtered(request) else await anyio.to_thread.run_sync(self._estimate_sync)
+        return KeysetPagination(
+            rows=rows,
+            page=page,
+            page_size=page_size,
+            count=max(estimate, seen),
+            more_previous=has_more if before is not None else page > 1,
+            more_next=True if before is not None else has_more,
+            first_id=getattr(rows[0], pk.name) if rows else None,
+            last_id=getattr(rows[-1], pk.name) if rows else None,
+        )
+
+
+class UserAdmin(KeysetModelView, model=User):
     column_list = [
         User.id,
         User.username,
@@ -17,9 +153,9 @@ class UserAdmin(ModelView, model=User):
         User.is_admin,
     ]
     
-    column_searchable_list = [User.username, User.bio]
+    column_searchable_list = [User.id, User.username, User.phone]
     
-    column_sortable_list = [User.id, User.username, User.last_seen, User.is_admin]
+    column_sortable_list = [User.id]
     
     form_columns = [
         User.username,
@@ -60,9 +196,16 @@ class UserAdmin(ModelView, model=User):
     
     page_size = 50
     page_size_options = [25, 50, 100, 200]
+    
+    def search_query(self, stmt, term: str):
+        term = term.strip()
+        conditions = [User.username.startswith(term, autoescape=True)]
+        if term.isdigit():
+            conditions += [User.id == int(term), User.phone == term]
+        return stmt.where(or_(*conditions))
 
 
-class MessageAdmin(ModelView, model=Message):
+class MessageAdmin(KeysetModelView, model=Message):
     column_list = [
         Message.id,
         Message.sender_id,
@@ -86,7 +229,9 @@ class MessageAdmin(ModelView, model=Message):
     
     column_searchable_list = [Message.sender_id, Message.receiver_id]
     
-    column_sortable_list = [Message.id, Message.timestamp, Message.is_read, Message.message_type]
+    column_sortable_list = [Message.id]
+    
+    exact_filters = ["sender_id", "receiver_id"]
     
     form_columns = [
         Message.sender_id,
@@ -127,8 +272,56 @@ class MessageAdmin(ModelView, model=Message):
     name_plural = "💬 Сообщения"
     icon = "fa-solid fa-message"
     
-    column_default_sort = (Message.timestamp, False)
+    column_default_sort = (Message.id, True)
     
     page_size = 50
     page_size_options = [25, 50, 100, 200]
+    
+    def search_query(self, stmt, term: str):
+        parts = term.replace(":", " ").split()
+        if not parts or not all(part.isdigit() for part in parts) or len(parts) > 2:
+            return stmt.where(false())
+        if len(parts) == 2:
+            return stmt.where(conversation_filter(int(parts[0]), int(parts[1])))
+        user_id = int(parts[0])
+        return stmt.where(or_(Message.sender_id == user_id, Message.receiver_id == user_id))
+
+
+def _stats_snapshot(session) -> dict:
+    tables = [(model.__tablename__, estimate_rows(session, model.__tablename__)) for model in STATS_TABLES]
+    partitions = [
+        (table.name, min_id, max_id, max_id - min_id + 1)
+        for table, min_id, max_id in archive_tables(session) if min_id is not None
+    ]
+    return {
+        "tables": tables,
+        "partitions": partitions,
+        "archived_estimate": sum(rows for _, _, _, rows in partitions),
+    }
+
+
+class StatsView(BaseView):
+    name = "📊 Статистика"
+    icon = "fa-solid fa-chart-line"
+
+    @expose("/stats", methods=["GET"])
+    async def stats_page(self, request: Request):
+        def load():
+            with SessionLocal() as session:
+                return _stats_snapshot(session)
+        stats = await anyio.to_thread.run_sync(load)
+        return await self.templates.TemplateResponse(request, "stats.html", context={"stats": stats})
+
+
+class UsageView(BaseView):
+    name = "📈 Активность"
+    icon = "fa-solid fa-chart-column"
 
+    @expose("/usage", methods=["GET"])
+    async def usage_page(self, request: Request):
+        period = "hour" if request.query_params.get("period") == "hour" else "day"
+        def load():
+            with SessionLocal() as session:
+                return usage_series(session, period, 48 if period == "hour" else 30)
+        series = await anyio.to_thread.run_sync(load)
+        return await self.templates.TemplateResponse(request, "usage.html", context={"period": period, "series": series})
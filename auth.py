@@ -1,19 +1,32 @@
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Set
 import hashlib
 import bcrypt
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from models import User
-from database import get_db
+from database import get_db, mark_user_write, read_session
+from event_bus import event_bus
 
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 24 * 60
+READ_ONLY_METHODS = {"GET", "HEAD", "OPTIONS"}
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_PREWARM_LIMIT = 1000
+USERNAME_INDEX_PREWARM_LIMIT = 100000
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
+_identity_cache: "OrderedDict[str, int]" = OrderedDict()
+_identity_lock = threading.Lock()
+_known_usernames: Set[str] = set()
+_username_lock = threading.Lock()
+_username_generation = 0
+
 
 def _preprocess_password(password: str) -> bytes:
     if password is None:
@@ -74,14 +87,91 @@ def authenticate_user(db: Session, username: str, password: str) -> Optional[Use
     if not user:
         normalized_phone = normalize_phone(username)
         user = db.query(User).filter(User.phone == normalized_phone).first()
-    if not user:
+    if not user or user.deleted_at is not None:
         return None
     if not verify_password(password, user.password_hash):
         return None
     return user
 
 
+def remember_identity(subject: str, user_id: int):
+    with _identity_lock:
+        _identity_cache[subject] = user_id
+        _identity_cache.move_to_end(subject)
+        while len(_identity_cache) > IDENTITY_CACHE_SIZE:
+            _identity_cache.popitem(last=False)
+
+
+def resolve_user(db: Session, subject: str) -> Optional[User]:
+    user_id = _identity_cache.get(subject)
+    if user_id is not None:
+        user = db.get(User, user_id)
+        if user is not None and (user.username == subject or str(user.id) == subject):
+            return user if user.deleted_at is None else None
+        with _identity_lock:
+            _identity_cache.pop(subject, None)
+    
+    user = db.query(User).filter(User.username == subject).first()
+    if not user:
+        try:
+            user = db.get(User, int(subject))
+        except (ValueError, TypeError):
+            pass
+    if user is None or user.deleted_at is not None:
+        return None
+    remember_identity(subject, user.id)
+    return user
+
+
+def remember_username(username: Optional[str], generation: Optional[int] = None):
+    if not username:
+        return
+    with _username_lock:
+        if generation is None or generation == _username_generation:
+            _known_usernames.add(username)
+
+
+def forget_username(username: Optional[str], broadcast: bool = True):
+    global _username_generation
+    if not username:
+        return
+    with _username_lock:
+        _known_usernames.discard(username)
+        _username_generation += 1
+    if broadcast:
+        event_bus.publish_nowait("username_released", {"username": username})
+
+
+def username_taken(db: Session, username: str) -> bool:
+    if username in _known_usernames:
+        return True
+    generation = _username_generation
+    taken = db.query(User.id).filter(User.username == username).first() is not None
+    if taken:
+        remember_username(username, generation)
+    return taken
+
+
+def prewarm_identities(db: Session, limit: int = IDENTITY_PREWARM_LIMIT) -> int:
+    rows = db.query(User.id, User.username).order_by(User.last_seen.desc()).limit(limit).all()
+    for user_id, username in reversed(rows):
+        remember_identity(username or str(user_id), user_id)
+    return len(rows)
+
+
+def prewarm_usernames(db: Session, limit: int = USERNAME_INDEX_PREWARM_LIMIT) -> int:
+    generation = _username_generation
+    query = db.query(User.username).filter(User.username.isnot(None)).limit(limit)
+    usernames = {username for (username,) in query.yield_per(1000)}
+    with _username_lock:
+        if generation != _username_generation:
+            return 0
+        _known_usernames.update(usernames)
+    return len(usernames)
+
+
 async def get_current_user(
+    request: Request,
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db)
 ) -> User:
@@ -98,19 +188,22 @@ async def get_current_user(
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == subject).first()
-    if not user:
-        try:
-            user_id = int(subject)
-            user = db.query(User).filter(User.id == user_id).first()
-        except (ValueError, TypeError):
-            pass
-    
+    user = resolve_user(db, subject)
     if user is None:
         raise credentials_exception
+    if request.method not in READ_ONLY_METHODS:
+        mark_user_write(user.id)
     return user
 
 
+def get_db_read(current_user: User = Depends(get_current_user)):
+    db = read_session(current_user.id)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
 def get_user_from_token(token: str, db: Session) -> Optional[User]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -118,15 +211,13 @@ def get_user_from_token(token: str, db: Session) -> Optional[User]:
         if subject is None:
             return None
         
-        user = db.query(User).filter(User.username == subject).first()
-        if not user:
-            try:
-                user_id = int(subject)
-                user = db.query(User).filter(User.id == user_id).first()
-            except (ValueError, TypeError):
-                pass
-        
-        return user
+        return resolve_user(db, subject)
     except JWTError:
         return None
 
+
+async def _on_bus_username_released(origin: str, message: dict):
+    forget_username(message["username"], broadcast=False)
+
+
+event_bus.on("username_released", _on_bus_username_released)
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import and_, create_engine, or_
+from sqlalchemy.orm import sessionmaker
+
+from database import Base
+from models import Message, User
+from queries import MESSAGE_HISTORY_FIELDS, chat_history_rows
+from serialization import rows_to_json
+
+ROWS = 10000
+REPEAT = 5
+
+
+def legacy_isoformat_utc(dt: datetime) -> str:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    else:
+        dt = dt.astimezone(timezone.utc)
+    return dt.isoformat().replace("+00:00", "Z")
+
+
+def setup():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    db = Session()
+    db.add_all([
+        User(id=1, first_name="A", last_name="A", phone="1", password_hash="x"),
+        User(id=2, first_name="B", last_name="B", phone="2", password_hash="x"),
+    ])
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    db.bulk_insert_mappings(Message, [
+        {
+            "sender_id": 1 + i % 2,
+            "receiver_id": 2 - i % 2,
+            "encrypted_content": "A" * 120,
+            "message_type": "text",
+            "timestamp": start + timedelta(seconds=i, microseconds=i),
+            "is_read": bool(i % 3),
+        }
+        for i in range(ROWS)
+    ])
+    db.commit()
+    return Session
+
+
+def conversation_filter():
+    return or_(
+        and_(Message.sender_id == 1, Message.receiver_id == 2),
+        and_(Message.sender_id == 2, Message.receiver_id == 1),
+    )
+
+
+def before(db) -> bytes:
+    messages = db.query(Message).filter(conversation_filter()).order_by(Message.timestamp.asc()).all()
+    content = [
+        {
+            "id": msg.id,
+            "sender_id": msg.sender_id,
+            "receiver_id": msg.receiver_id,
+            "encrypted_content": msg.encrypted_content,
+            "message_type": msg.message_type,
+            "media_url": msg.media_url,
+            "reply_to_message_id": msg.reply_to_message_id,
+            "timestamp": legacy_isoformat_utc(msg.timestamp),
+            "is_read": msg.is_read,
+        } for msg in messages
+    ]
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def after(db) -> bytes:
+    rows = chat_history_rows(db, 1, 2)
+    return rows_to_json(rows, MESSAGE_HISTORY_FIELDS, datetime_fields=("timestamp",))
+
+
+def measure(Session, fn):
+    best = None
+    for _ in range(REPEAT):
+        db = Session()
+        start = time.perf_counter()
+        body = fn(db)
+        elapsed = time.perf_counter() - start
+        db.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, body
+
+
+def run():
+    Session = setup()
+    before_time, before_body = measure(Session, before)
+    after_time, after_body = measure(Session, after)
+    print(f"history of {ROWS} rows")
+    print(f"  before: {before_time * 1000:8.1f} ms  {len(before_body)} bytes")
+    print(f"  after:  {after_time * 1000:8.1f} ms  {len(after_body)} bytes")
+    print(f"  speedup: {before_time / after_time:.1f}x")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,59 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPEAT = 5
+
+PROBE = """
+import json, logging, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import main
+imported = time.perf_counter()
+logging.disable(logging.CRITICAL)
+from fastapi.testclient import TestClient
+with TestClient(main.create_asgi_app()) as client:
+    client.get("/health")
+    ready = time.perf_counter()
+print(json.dumps({"import": imported - start, "ready": ready - start}))
+"""
+
+
+def measure(env_overrides: dict, migrated: bool = True) -> dict:
+    env = dict(os.environ, **env_overrides)
+    samples = {"import": [], "ready": []}
+    for _ in range(REPEAT):
+        with tempfile.TemporaryDirectory() as workdir:
+            if migrated:
+                subprocess.run(
+                    [sys.executable, os.path.join(ROOT, "migrations.py"), "upgrade"],
+                    cwd=workdir, env=env, capture_output=True, check=True,
+                )
+            output = subprocess.run(
+                [sys.executable, "-c", PROBE, ROOT],
+                cwd=workdir, env=env, capture_output=True, text=True, check=True,
+            ).stdout.strip().splitlines()[-1]
+        result = json.loads(output)
+        for key in samples:
+            samples[key].append(result[key])
+    return {key: statistics.median(values) for key, values in samples.items()}
+
+
+def main():
+    print(f"Cold start, median of {REPEAT} runs")
+    for label, env, migrated in (
+        ("default", {}, True),
+        ("no prewarm", {"PREWARM_CACHES": "0"}, True),
+        ("admin enabled", {"ENABLE_ADMIN": "1"}, True),
+        ("migrations on startup", {"RUN_MIGRATIONS_ON_STARTUP": "1"}, False),
+    ):
+        result = measure(env, migrated)
+        print(f"{label:24} import {result['import'] * 1000:7.1f} ms   first request {result['ready'] * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import base64
+import os
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from socketio import packet
+
+from wire_format import WIRE_COMPACT, WIRE_JSON, encode_payload
+
+ITERATIONS = 20000
+CIPHERTEXT_SIZES = [64, 256, 2048]
+
+
+def sample_message(ciphertext_size: int) -> dict:
+    return {
+        "id": 1234567,
+        "sender_id": 1042,
+        "receiver_id": 2077,
+        "encrypted_content": base64.b64encode(os.urandom(ciphertext_size)).decode("ascii"),
+        "message_type": "text",
+        "media_url": None,
+        "reply_to_message_id": None,
+        "timestamp": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+        "is_read": False,
+    }
+
+
+def encode_frames(message: dict, wire_format: str) -> list:
+    payload = encode_payload(message, wire_format)
+    encoded = packet.Packet(packet.EVENT, data=["new_message", payload], namespace="/").encode()
+    return encoded if isinstance(encoded, list) else [encoded]
+
+
+def frame_bytes(frames: list) -> int:
+    return sum(len(f) if isinstance(f, bytes) else len(f.encode("utf-8")) for f in frames)
+
+
+def deflated_bytes(frames: list) -> int:
+    total = 0
+    for f in frames:
+        raw = f if isinstance(f, bytes) else f.encode("utf-8")
+        compressor = zlib.compressobj(wbits=-15)
+        total += len(compressor.compress(raw) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def run():
+    print(f"{'ciphertext':>10} {'format':>8} {'bytes':>7} {'deflate':>8} {'us/msg':>8}")
+    for size in CIPHERTEXT_SIZES:
+        message = sample_message(size)
+        for wire_format in (WIRE_JSON, WIRE_COMPACT):
+            frames = encode_frames(message, wire_format)
+            start = time.perf_counter()
+            for _ in range(ITERATIONS):
+                encode_frames(message, wire_format)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{size:>10} {wire_format:>8} {frame_bytes(frames):>7} "
+                f"{deflated_bytes(frames):>8} {elapsed / ITERATIONS * 1e6:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    run()
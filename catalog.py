@@ -0,0 +1,120 @@
+import logging
+import os
+import sys
+import threading
+import urllib.request
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from serialization import encode_batch
+
+logger = logging.getLogger(__name__)
+
+PRESET_AVATAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "presets", "avatars")
+PRESET_AVATAR_REMOTE_URL = "https://api.dicebear.com/7.x/avataaars/svg?seed={seed}"
+PRESET_AVATAR_URL = "/avatars/presets/{id}"
+PRESET_AVATAR_MEDIA_TYPE = "image/svg+xml"
+CATALOG_CACHE_CONTROL = "public, max-age=86400"
+PRESET_IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+FETCH_TIMEOUT = 10
+AVATARS_LIST_CACHE_SIZE = 16
+
+AVATAR_PRESETS: Dict[str, dict] = {
+    str(seed): {"id": str(seed), "url": PRESET_AVATAR_URL.format(id=seed)}
+    for seed in range(1, 13)
+}
+
+FRAME_PRESETS: Dict[str, dict] = {
+    frame["id"]: frame for frame in (
+        {"id": "none", "name": "Без рамки", "color": "#000000"},
+        {"id": "fire", "name": "Огненная", "color": "#FF4500"},
+        {"id": "rainbow", "name": "Радужная", "color": "#FF0000"},
+        {"id": "purple", "name": "Фиолетовая", "color": "#800080"},
+    )
+}
+
+FRAMES_LIST = encode_batch({"frames": list(FRAME_PRESETS.values())})
+
+_avatars_lists: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+_avatars_lists_lock = threading.Lock()
+
+
+def avatar_preset(avatar_id: str) -> Optional[dict]:
+    return AVATAR_PRESETS.get(avatar_id)
+
+
+def preset_avatar_url(avatar_id: str, base_url: str) -> str:
+    return base_url.rstrip("/") + PRESET_AVATAR_URL.format(id=avatar_id)
+
+
+def avatars_list(base_url: str) -> Tuple[bytes, str]:
+    base_url = base_url.rstrip("/")
+    cached = _avatars_lists.get(base_url)
+    if cached is not None:
+        return cached
+    cached = encode_batch({"avatars": [
+        {"id": avatar_id, "url": preset_avatar_url(avatar_id, base_url)} for avatar_id in AVATAR_PRESETS
+    ]})
+    with _avatars_lists_lock:
+        _avatars_lists[base_url] = cached
+        _avatars_lists.move_to_end(base_url)
+        while len(_avatars_lists) > AVATARS_LIST_CACHE_SIZE:
+            _avatars_lists.popitem(last=False)
+    return cached
+
+
+def frame_preset(frame_id: str) -> Optional[dict]:
+    return FRAME_PRESETS.get(frame_id)
+
+
+def preset_avatar_path(avatar_id: str) -> str:
+    return os.path.join(PRESET_AVATAR_DIR, f"{avatar_id}.svg")
+
+
+def preset_avatar_remote_url(avatar_id: str) -> str:
+    return PRESET_AVATAR_REMOTE_URL.format(seed=avatar_id)
+
+
+def bundled_avatar(avatar_id: str) -> Optional[str]:
+    if avatar_id not in AVATAR_PRESETS:
+        return None
+    path = preset_avatar_path(avatar_id)
+    return path if os.path.isfile(path) else None
+
+
+def missing_preset_avatars() -> List[str]:
+    return [avatar_id for avatar_id in AVATAR_PRESETS if bundled_avatar(avatar_id) is None]
+
+
+def fetch_preset_avatars(force: bool = False) -> List[Tuple[str, bool]]:
+    os.makedirs(PRESET_AVATAR_DIR, exist_ok=True)
+    results = []
+    for avatar_id in AVATAR_PRESETS:
+        path = preset_avatar_path(avatar_id)
+        if os.path.isfile(path) and not force:
+            results.append((avatar_id, False))
+            continue
+        with urllib.request.urlopen(preset_avatar_remote_url(avatar_id), timeout=FETCH_TIMEOUT) as response:
+            content = response.read()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        results.append((avatar_id, True))
+    return results
+
+
+def main(argv: List[str]):
+    command = argv[1] if len(argv) > 1 else "status"
+    if command == "fetch-avatars":
+        for avatar_id, fetched in fetch_preset_avatars(force="--force" in argv[2:]):
+            print(f" Аватар {avatar_id}: {'загружен' if fetched else 'уже есть'}")
+    elif command == "status":
+        for avatar_id in AVATAR_PRESETS:
+            print(f" [{'+' if bundled_avatar(avatar_id) else ' '}] {avatar_id} {preset_avatar_path(avatar_id)}")
+    else:
+        print("Использование: python catalog.py [status | fetch-avatars [--force]]")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
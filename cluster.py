@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 5000
+DEFAULT_HUB_PORT = 5100
+DEFAULT_PRIVATE_PORT = 5101
+SOCKETIO_PATH = "socket.io"
+SUPERVISE_INTERVAL = 1.0
+HOP_BY_HOP_HEADERS = {b"connection", b"keep-alive", b"transfer-encoding", b"content-length", b"upgrade"}
+
+
+def sid_owner(query_string: bytes) -> Optional[str]:
+    sid = parse_qs(query_string.decode("latin-1")).get("sid")
+    if not sid or "." not in sid[0]:
+        return None
+    return sid[0].split(".", 1)[0]
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b";", 1)[0].strip() or b"0", 16)
+        if size == 0:
+            await reader.readline()
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+
+async def proxy_http(scope, receive, send, host: str, port: int):
+    body = await _read_body(receive)
+    target = scope.get("raw_path") or scope["path"].encode("utf-8")
+    if scope.get("query_string"):
+        target += b"?" + scope["query_string"]
+
+    request = [scope["method"].encode("ascii") + b" " + target + b" HTTP/1.1"]
+    request += [name + b": " + value for name, value in scope["headers"] if name.lower() not in HOP_BY_HOP_HEADERS]
+    request += [b"content-length: " + str(len(body)).encode("ascii"), b"connection: close"]
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(b"\r\n".join(request) + b"\r\n\r\n" + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        headers = []
+        chunked = False
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.rstrip(b"\r\n").partition(b":")
+            name = name.strip().lower()
+            value = value.strip()
+            if name == b"transfer-encoding" and b"chunked" in value.lower():
+                chunked = True
+            if name not in HOP_BY_HOP_HEADERS:
+                headers.append((name, value))
+
+        payload = await _read_chunked(reader) if chunked else await reader.read()
+        headers.append((b"content-length", str(len(payload)).encode("ascii")))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": payload})
+    finally:
+        writer.close()
+
+
+class StickySessionRouter:
+    def __init__(self, app, worker_id: str, peer_ports: Dict[str, int], peer_host: str = "127.0.0.1"):
+        self.app = app
+        self.worker_id = worker_id
+        self.peer_ports = peer_ports
+        self.peer_host = peer_host
+        self.prefix = f"/{SOCKETIO_PATH}/"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket") and scope["path"].startswith(self.prefix):
+            owner = sid_owner(scope.get("query_string", b""))
+            if owner is not None and owner != self.worker_id and owner in self.peer_ports:
+                if scope["type"] == "websocket":
+                    await send({"type": "websocket.close", "code": 1013})
+                    return
+                try:
+                    await proxy_http(scope, receive, send, self.peer_host, self.peer_ports[owner])
+                except Exception as e:
+                    logger.warning(f"Failed to route session of worker {owner}: {e}")
+                    await send({"type": "http.response.start", "status": 502, "headers": []})
+                    await send({"type": "http.response.body", "body": b""})
+                return
+        await self.app(scope, receive, send)
+
+
+def bind_socket(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(index: int, workers: int, host: str, port: int, hub_port: int, private_port: int):
+    os.environ["WORKER_ID"] = str(index)
+    os.environ["EVENT_BUS_URL"] = f"tcp://127.0.0.1:{hub_port}"
+    os.environ["RUN_MIGRATIONS_ON_STARTUP"] = "0"
+
+    import uvicorn
+    import main
+
+    peers = {str(i): private_port + i for i in range(workers)}
+    app = StickySessionRouter(main.create_asgi_app(), str(index), peers)
+    config = uvicorn.Config(app, ws_per_message_deflate=True, lifespan="on")
+    sockets = [bind_socket(host, port, reuse_port=True), bind_socket("127.0.0.1", private_port + index)]
+    uvicorn.Server(config).run(sockets=sockets)
+
+
+async def supervise(workers: int, host: str, port: int, hub_port: int, private_port: int):
+    from event_bus import EventHub
+    hub = await EventHub().serve("127.0.0.1", hub_port)
+    context = multiprocessing.get_context("spawn")
+    processes: List[Optional[multiprocessing.Process]] = [None] * workers
+    stopping = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    def spawn(index: int):
+        process = context.Process(
+            target=run_worker,
+            args=(index, workers, host, port, hub_port, private_port),
+            name=f"worker-{index}",
+        )
+        process.start()
+        processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    for index in range(workers):
+        spawn(index)
+
+    try:
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), SUPERVISE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            for index, process in enumerate(processes):
+                if not stopping.is_set() and process is not None and not process.is_alive():
+                    logger.warning(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    spawn(index)
+    finally:
+        for process in processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in processes:
+            if process is not None:
+                process.join(timeout=10)
+        hub.close()
+        await hub.wait_closed()
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Run the messenger backend on several worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--hub-port", type=int, default=DEFAULT_HUB_PORT)
+    parser.add_argument("--private-port", type=int, default=DEFAULT_PRIVATE_PORT)
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if os.environ.get("RUN_MIGRATIONS_ON_STARTUP", "0") == "1":
+        from migrations import migrate
+        migrate()
+
+    asyncio.run(supervise(args.workers, args.host, args.port, args.hub_port, args.private_port))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+CONTACT_SYNC_MAX = 10000
+CONTACT_NAME_MAX = 128
+IN_CLAUSE_CHUNK = 500
+PHONE_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def phone_hash(phone: Optional[str]) -> Optional[str]:
+    if not phone:
+        return None
+    digits = re.sub(r"[^\d]", "", phone)
+    return hashlib.sha256(digits.encode("ascii")).hexdigest() if digits else None
+
+
+def valid_phone_hash(value: str) -> bool:
+    return bool(PHONE_HASH_PATTERN.match(value))
+
+
+def _chunks(values: List[str], size: int = IN_CLAUSE_CHUNK) -> Iterable[List[str]]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _expanding(sql: str):
+    return text(sql).bindparams(bindparam("hashes", expanding=True))
+
+
+def _next_sync_version(db: Session, owner_id: int) -> int:
+    current = db.execute(
+        text("SELECT MAX(sync_version) FROM contact_hashes WHERE owner_id = :owner_id"),
+        {"owner_id": owner_id}
+    ).scalar()
+    return (current or 0) + 1
+
+
+def _store_hashes(db: Session, owner_id: int, entries: Dict[str, Optional[str]], sync_version: int):
+    if not entries:
+        return
+    db.execute(text(
+        "INSERT INTO contact_hashes (owner_id, phone_hash, name, sync_version) "
+        "VALUES (:owner_id, :phone_hash, :name, :sync_version) "
+        "ON CONFLICT (owner_id, phone_hash) DO UPDATE SET name = excluded.name, sync_version = excluded.sync_version"
+    ), [
+        {"owner_id": owner_id, "phone_hash": value, "name": name, "sync_version": sync_version}
+        for value, name in entries.items()
+    ])
+
+
+def _link_contacts(db: Session, owner_id: int, sync_version: int) -> int:
+    result = db.execute(text(
+        "INSERT INTO contacts (owner_id, contact_id, local_name, source, created_at, updated_at) "
+        "SELECT ch.owner_id, u.id, ch.name, 'sync', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP "
+        "FROM contact_hashes ch JOIN users u ON u.phone_hash = ch.phone_hash "
+        "WHERE ch.owner_id = :owner_id AND ch.sync_version = :sync_version AND u.id != :owner_id "
+        "ON CONFLICT (owner_id, contact_id) DO UPDATE SET "
+        "local_name = CASE WHEN contacts.source = 'sync' THEN excluded.local_name ELSE contacts.local_name END, "
+        "updated_at = CURRENT_TIMESTAMP"
+    ), {"owner_id": owner_id, "sync_version": sync_version})
+    return result.rowcount
+
+
+def _remove_hashes(db: Session, owner_id: int, hashes: Sequence[str]) -> int:
+    removed = 0
+    for chunk in _chunks(list(hashes)):
+        params = {"owner_id": owner_id, "hashes": chunk}
+        db.execute(_expanding(
+            "DELETE FROM contacts WHERE owner_id = :owner_id AND source = 'sync' AND contact_id IN "
+            "(SELECT id FROM users WHERE phone_hash IN :hashes)"
+        ), params)
+        removed += db.execute(_expanding(
+            "DELETE FROM contact_hashes WHERE owner_id = :owner_id AND phone_hash IN :hashes"
+        ), params).rowcount
+    return removed
+
+
+def _remove_stale(db: Session, owner_id: int, sync_version: int) -> int:
+    params = {"owner_id": owner_id, "sync_version": sync_version}
+    db.execute(text(
+        "DELETE FROM contacts WHERE owner_id = :owner_id AND source = 'sync' AND contact_id IN "
+        "(SELECT u.id FROM contact_hashes ch JOIN users u ON u.phone_hash = ch.phone_hash "
+        "WHERE ch.owner_id = :owner_id AND ch.sync_version < :sync_version)"
+    ), params)
+    return db.execute(text(
+        "DELETE FROM contact_hashes WHERE owner_id = :owner_id AND sync_version < :sync_version"
+    ), params).rowcount
+
+
+def _matches(db: Session, owner_id: int, sync_version: int) -> List[dict]:
+    rows = db.execute(text(
+        "SELECT ch.phone_hash, u.id FROM contact_hashes ch JOIN users u ON u.phone_hash = ch.phone_hash "
+        "WHERE ch.owner_id = :owner_id AND ch.sync_version = :sync_version AND u.id != :owner_id"
+    ), {"owner_id": owner_id, "sync_version": sync_version})
+    return [{"phone_hash": value, "user_id": user_id} for value, user_id in rows]
+
+
+def sync_contacts(
+    db: Session,
+    owner_id: int,
+    added: Dict[str, Optional[str]],
+    removed: Sequence[str] = (),
+    full: bool = False,
+) -> dict:
+    sync_version = _next_sync_version(db, owner_id)
+    removed = [value for value in removed if value not in added]
+    removed_count = _remove_hashes(db, owner_id, removed) if removed else 0
+    _store_hashes(db, owner_id, added, sync_version)
+    if full:
+        removed_count += _remove_stale(db, owner_id, sync_version)
+    _link_contacts(db, owner_id, sync_version)
+    matched = _matches(db, owner_id, sync_version)
+    db.commit()
+    logger.info(
+        f"Contact sync for user {owner_id}: {len(added)} uploaded, {removed_count} removed, "
+        f"{len(matched)} matched (version {sync_version})"
+    )
+    return {"sync_version": sync_version, "matched": matched, "removed": removed_count}
+
+
+def link_new_user(db: Session, user_id: int, user_phone_hash: Optional[str]) -> List[int]:
+    if not user_phone_hash:
+        return []
+    owners = [owner_id for (owner_id,) in db.execute(text(
+        "SELECT owner_id FROM contact_hashes WHERE phone_hash = :phone_hash AND owner_id != :user_id"
+    ), {"phone_hash": user_phone_hash, "user_id": user_id})]
+    if owners:
+        db.execute(text(
+            "INSERT INTO contacts (owner_id, contact_id, local_name, source, created_at, updated_at) "
+            "SELECT owner_id, :user_id, name, 'sync', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP "
+            "FROM contact_hashes WHERE phone_hash = :phone_hash AND owner_id != :user_id "
+            "ON CONFLICT (owner_id, contact_id) DO NOTHING"
+        ), {"phone_hash": user_phone_hash, "user_id": user_id})
+    return owners
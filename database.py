@@ -1,13 +1,33 @@
+import itertools
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./chat.db"
+READ_REPLICA_URLS = [url.strip() for url in os.environ.get("READ_REPLICA_URLS", "").split(",") if url.strip()]
+READ_YOUR_WRITES_WINDOW = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "5"))
+
+
+def _create_engine(url: str):
+    connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+    return create_engine(url, connect_args=connect_args, pool_pre_ping=not url.startswith("sqlite"))
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+
+engine = _create_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+replica_engines = [_create_engine(url) for url in READ_REPLICA_URLS]
+_replica_sessions = [sessionmaker(autocommit=False, autoflush=False, bind=e) for e in replica_engines]
+_replica_cycle = itertools.cycle(_replica_sessions) if _replica_sessions else None
+
+_recent_writes: Dict[int, float] = {}
+_recent_writes_lock = threading.Lock()
+_write_listener: Optional[Callable[[int], None]] = None
+
 Base = declarative_base()
 
 
@@ -19,38 +39,34 @@ def get_db():
         db.close()
 
 
-def init_db():
-    Base.metadata.create_all(bind=engine)
-    _migrate_database()
+def set_write_listener(listener: Optional[Callable[[int], None]]):
+    global _write_listener
+    _write_listener = listener
 
 
-def _migrate_database():
-    import sqlite3
-    import os
-    
-    db_path = "./chat.db"
-    
-    if not os.path.exists(db_path):
+def mark_user_write(user_id: Optional[int], broadcast: bool = True):
+    if user_id is None or not _replica_sessions:
         return
-    
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'avatar_frame' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN avatar_frame TEXT")
-        
-        cursor.execute("PRAGMA table_info(messages)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'reply_to_message_id' not in columns:
-            cursor.execute("ALTER TABLE messages ADD COLUMN reply_to_message_id INTEGER")
-        
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"⚠️ Ошибка миграции (можно игнорировать): {e}")
+    if broadcast and _write_listener is not None:
+        _write_listener(user_id)
+    now = time.monotonic()
+    with _recent_writes_lock:
+        _recent_writes[user_id] = now + READ_YOUR_WRITES_WINDOW
+        if len(_recent_writes) > 10000:
+            for key in [k for k, expires in _recent_writes.items() if expires < now]:
+                del _recent_writes[key]
+
+
+def has_recent_write(user_id: Optional[int]) -> bool:
+    if user_id is None:
+        return False
+    expires = _recent_writes.get(user_id)
+    return expires is not None and expires > time.monotonic()
+
 
+def read_session(user_id: Optional[int] = None):
+    if _replica_cycle is None or has_recent_write(user_id):
+        return SessionLocal()
+    with _recent_writes_lock:
+        factory = next(_replica_cycle)
+    return factory()
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = os.environ.get("WORKER_ID", "0")
+EVENT_BUS_URL = os.environ.get("EVENT_BUS_URL", "")
+HUB_RECONNECT_DELAY = 1.0
+HUB_MAX_LINE = 16 * 1024 * 1024
+HUB_MAX_CLIENT_BUFFER = 64 * 1024 * 1024
+
+Handler = Callable[[str, dict], Awaitable[None]]
+
+
+def is_primary_worker() -> bool:
+    return WORKER_ID == "0"
+
+
+def _frame(kind: str, origin: str, data: dict) -> bytes:
+    return dumps({"kind": kind, "origin": origin, "data": data}) + b"\n"
+
+
+class EventBus:
+    def __init__(self, worker_id: str = WORKER_ID):
+        self.worker_id = worker_id
+        self.handlers: Dict[str, Handler] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: Set[asyncio.Task] = set()
+
+    def on(self, kind: str, handler: Handler):
+        self.handlers[kind] = handler
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        pass
+
+    async def publish(self, kind: str, data: dict):
+        raise NotImplementedError
+
+    def _spawn(self, kind: str, data: dict):
+        task = asyncio.get_running_loop().create_task(self.publish(kind, data))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def publish_nowait(self, kind: str, data: dict):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            loop = self.loop
+            if loop is None or loop.is_closed():
+                return
+            loop.call_soon_threadsafe(self._spawn, kind, data)
+            return
+        self._spawn(kind, data)
+
+    async def dispatch(self, message: dict):
+        origin = message.get("origin")
+        if origin == self.worker_id:
+            return
+        handler = self.handlers.get(message.get("kind"))
+        if handler is None:
+            return
+        try:
+            await handler(origin, message.get("data") or {})
+        except Exception as e:
+            logger.error(f"Event bus handler for {message.get('kind')} failed: {e}")
+
+
+class InProcessBus(EventBus):
+    def __init__(self, worker_id: str = WORKER_ID, peers: Optional[List["InProcessBus"]] = None):
+        super().__init__(worker_id)
+        self.peers = peers if peers is not None else []
+        self.peers.append(self)
+
+    async def publish(self, kind: str, data: dict):
+        message = {"kind": kind, "origin": self.worker_id, "data": data}
+        for peer in list(self.peers):
+            if peer is not self:
+                await peer.dispatch(message)
+
+
+class HubBus(EventBus):
+    def __init__(self, url: str, worker_id: str = WORKER_ID):
+        super().__init__(worker_id)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await super().start()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def publish(self, kind: str, data: dict):
+        writer = self.writer
+        if writer is None:
+            logger.debug(f"Event bus is not connected, dropping {kind}")
+            return
+        writer.write(_frame(kind, self.worker_id, data))
+        await writer.drain()
+
+    async def _run(self):
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=HUB_MAX_LINE)
+                writer.write(_frame("hello", self.worker_id, {}))
+                await writer.drain()
+                self.writer = writer
+                logger.info(f"Worker {self.worker_id} connected to event hub {self.host}:{self.port}")
+                await self.dispatch({"kind": "bus_connected", "origin": "hub", "data": {}})
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    await self.dispatch(loads(line))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Event hub connection failed: {e}")
+            finally:
+                self.writer = None
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(HUB_RECONNECT_DELAY)
+
+
+class EventHub:
+    def __init__(self):
+        self.clients: Dict[asyncio.StreamWriter, str] = {}
+
+    async def serve(self, host: str, port: int):
+        return await asyncio.start_server(self.handle, host, port, limit=HUB_MAX_LINE)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if worker_id is None:
+                    message = loads(line)
+                    if message.get("kind") == "hello":
+                        worker_id = message.get("origin")
+                        self.clients[writer] = worker_id
+                        logger.info(f"Worker {worker_id} joined the event hub")
+                    continue
+                self.broadcast(line, skip=writer)
+        except Exception as e:
+            logger.warning(f"Event hub client {worker_id} failed: {e}")
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+            if worker_id is not None:
+                logger.info(f"Worker {worker_id} left the event hub")
+                self.broadcast(_frame("worker_down", "hub", {"worker_id": worker_id}))
+
+    def broadcast(self, line: bytes, skip: Optional[asyncio.StreamWriter] = None):
+        for writer in list(self.clients):
+            if writer is skip:
+                continue
+            if writer.transport.get_write_buffer_size() > HUB_MAX_CLIENT_BUFFER:
+                logger.warning(f"Event hub client {self.clients.get(writer)} is too slow, disconnecting")
+                self.clients.pop(writer, None)
+                writer.close()
+                continue
+            writer.write(line)
+
+
+def create_bus() -> EventBus:
+    if EVENT_BUS_URL:
+        return HubBus(EVENT_BUS_URL)
+    return InProcessBus()
+
+
+event_bus = create_bus()
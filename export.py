@@ -0,0 +1,143 @@
+import zipfile
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import or_
+
+from database import SessionLocal
+from models import User, UserTheme, Contact
+from queries import MESSAGE_HISTORY_FIELDS, conversation_filter, message_rows_by_id, stream_rows
+from serialization import dumps, isoformat_utc
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_FORMATS = ("ndjson", "zip")
+
+
+def _header(scope: str, user_id: int, peer_id: Optional[int], after_id: int) -> dict:
+    return {
+        "type": "export",
+        "scope": scope,
+        "user_id": user_id,
+        "peer_id": peer_id,
+        "after_id": after_id,
+        "generated_at": isoformat_utc(datetime.now(timezone.utc)),
+    }
+
+
+def _message_records(db, condition_for, after_id: int) -> Iterator[dict]:
+    for row in message_rows_by_id(db, condition_for, after_id, EXPORT_BATCH_SIZE):
+        record = {"type": "message"}
+        record.update(zip(MESSAGE_HISTORY_FIELDS, row))
+        record["timestamp"] = isoformat_utc(record["timestamp"])
+        yield record
+        if record["media_url"]:
+            yield {"type": "media", "message_id": record["id"], "url": record["media_url"]}
+
+
+def iter_chat_export(user_id: int, peer_id: int, after_id: int = 0) -> Iterator[dict]:
+    db = SessionLocal()
+    try:
+        yield _header("chat", user_id, peer_id, after_id)
+        yield from _message_records(db, lambda table: conversation_filter(user_id, peer_id, table), after_id)
+    finally:
+        db.close()
+
+
+def iter_account_export(user_id: int, after_id: int = 0) -> Iterator[dict]:
+    db = SessionLocal()
+    try:
+        yield _header("account", user_id, None, after_id)
+
+        if not after_id:
+            user = db.query(
+                User.id, User.username, User.first_name, User.last_name, User.phone, User.public_key,
+                User.avatar_url, User.avatar_frame, User.bio, User.birthdate, User.last_seen,
+            ).filter(User.id == user_id).first()
+            if user:
+                profile = {"type": "profile"}
+                profile.update(user._mapping)
+                profile["last_seen"] = isoformat_utc(profile["last_seen"]) if profile["last_seen"] else None
+                yield profile
+                if profile["avatar_url"]:
+                    yield {"type": "media", "message_id": None, "url": profile["avatar_url"]}
+
+            themes = db.query(UserTheme).filter(UserTheme.user_id == user_id).order_by(UserTheme.id.asc())
+            for theme in stream_rows(themes, EXPORT_BATCH_SIZE):
+                yield {
+                    "type": "theme",
+                    "id": theme.id,
+                    "name": theme.name,
+                    "primary_color": theme.primary_color,
+                    "background_color": theme.background_color,
+                    "bubble_color_me": theme.bubble_color_me,
+                    "bubble_color_other": theme.bubble_color_other,
+                    "text_color": theme.text_color,
+                    "secondary_text_color": theme.secondary_text_color,
+                    "brightness": theme.brightness,
+                    "wallpaper_url": theme.wallpaper_url,
+                    "wallpaper_blur": theme.wallpaper_blur,
+                }
+                if theme.wallpaper_url:
+                    yield {"type": "media", "message_id": None, "url": theme.wallpaper_url}
+
+            contacts = db.query(Contact.contact_id, Contact.local_name).filter(
+                Contact.owner_id == user_id
+            ).order_by(Contact.id.asc())
+            for contact_id, local_name in stream_rows(contacts, EXPORT_BATCH_SIZE):
+                yield {"type": "contact", "contact_id": contact_id, "local_name": local_name}
+
+        yield from _message_records(
+            db, lambda table: or_(table.c.sender_id == user_id, table.c.receiver_id == user_id), after_id
+        )
+    finally:
+        db.close()
+
+
+def ndjson_stream(records: Iterable[dict]) -> Iterator[bytes]:
+    buffer = []
+    size = 0
+    for record in records:
+        line = dumps(record) + b"\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+class _ZipBuffer:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(records: Iterable[dict], arcname: str = "export.ndjson") -> Iterator[bytes]:
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(arcname, mode="w", force_zip64=True) as entry:
+            for chunk in ndjson_stream(records):
+                entry.write(chunk)
+                data = buffer.drain()
+                if data:
+                    yield data
+    yield buffer.drain()
@@ -0,0 +1,296 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, delete, exists, func, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+from models import User, Conversation, ConversationMember, ConversationMessage
+
+logger = logging.getLogger(__name__)
+
+GROUP_MEMBERS_MAX = int(os.environ.get("GROUP_MEMBERS_MAX", "500"))
+GROUP_TITLE_MAX = 128
+MEMBER_CACHE_SIZE = 10000
+MEMBER_CACHE_TTL = 60
+IN_CLAUSE_CHUNK = 500
+
+GROUP_MESSAGE_FIELDS = (
+    "id", "conversation_id", "sender_id", "encrypted_content", "message_type",
+    "media_url", "reply_to_message_id", "timestamp",
+)
+GROUP_MESSAGE_COLUMNS = tuple(getattr(ConversationMessage, name) for name in GROUP_MESSAGE_FIELDS)
+
+_member_cache: "OrderedDict[int, Tuple[FrozenSet[int], float]]" = OrderedDict()
+_member_lock = threading.Lock()
+_member_generation: Dict[int, int] = {}
+_members_listener: Optional[Callable[[int, List[int], List[int]], None]] = None
+
+
+class GroupNotFound(Exception):
+    pass
+
+
+class GroupForbidden(Exception):
+    pass
+
+
+class GroupFull(Exception):
+    pass
+
+
+def set_members_listener(listener: Optional[Callable[[int, List[int], List[int]], None]]):
+    global _members_listener
+    _members_listener = listener
+
+
+def forget_members(conversation_id: int):
+    with _member_lock:
+        _member_cache.pop(conversation_id, None)
+        _member_generation[conversation_id] = _member_generation.get(conversation_id, 0) + 1
+
+
+def member_ids(db: Session, conversation_id: int) -> FrozenSet[int]:
+    now = time.monotonic()
+    cached = _member_cache.get(conversation_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    generation = _member_generation.get(conversation_id, 0)
+    members = frozenset(db.execute(
+        select(ConversationMember.user_id).where(ConversationMember.conversation_id == conversation_id)
+    ).scalars())
+    with _member_lock:
+        if _member_generation.get(conversation_id, 0) != generation:
+            return members
+        _member_cache[conversation_id] = (members, now + MEMBER_CACHE_TTL)
+        _member_cache.move_to_end(conversation_id)
+        while len(_member_cache) > MEMBER_CACHE_SIZE:
+            _member_cache.popitem(last=False)
+    return members
+
+
+def user_group_ids(db: Session, user_id: int) -> List[int]:
+    return list(db.execute(
+        select(ConversationMember.conversation_id).where(ConversationMember.user_id == user_id)
+    ).scalars())
+
+
+def member_role(db: Session, conversation_id: int, user_id: int) -> Optional[str]:
+    return db.execute(select(ConversationMember.role).where(
+        ConversationMember.conversation_id == conversation_id,
+        ConversationMember.user_id == user_id
+    )).scalar()
+
+
+def _existing_users(db: Session, user_ids: Sequence[int]) -> List[int]:
+    found = set()
+    for start in range(0, len(user_ids), IN_CLAUSE_CHUNK):
+        chunk = user_ids[start:start + IN_CLAUSE_CHUNK]
+        found.update(db.execute(select(User.id).where(User.id.in_(chunk))).scalars())
+    return [user_id for user_id in user_ids if user_id in found]
+
+
+def _insert_members(db: Session, conversation_id: int, user_ids: Iterable[int], role: str = "member"):
+    rows = [{"conversation_id": conversation_id, "user_id": user_id, "role": role, "last_read_message_id": 0} for user_id in user_ids]
+    if rows:
+        db.execute(insert(ConversationMember), rows)
+
+
+def create_group(db: Session, owner_id: int, title: str, user_ids: Sequence[int]) -> int:
+    members = [user_id for user_id in _existing_users(db, list(dict.fromkeys(user_ids))) if user_id != owner_id]
+    if len(members) + 1 > GROUP_MEMBERS_MAX:
+        raise GroupFull(GROUP_MEMBERS_MAX)
+    conversation = Conversation(title=title, created_by=owner_id)
+    db.add(conversation)
+    db.flush()
+    conversation_id = conversation.id
+    _insert_members(db, conversation_id, [owner_id], role="owner")
+    _insert_members(db, conversation_id, members)
+    db.commit()
+    forget_members(conversation_id)
+    logger.info(f"User {owner_id} created group {conversation_id} with {len(members) + 1} member(s)")
+    return conversation_id
+
+
+def add_members(db: Session, conversation_id: int, actor_id: int, user_ids: Sequence[int]) -> List[int]:
+    role = member_role(db, conversation_id, actor_id)
+    if role is None:
+        raise GroupNotFound(conversation_id)
+    if role != "owner":
+        raise GroupForbidden(conversation_id)
+    current = member_ids(db, conversation_id)
+    added = [user_id for user_id in _existing_users(db, list(dict.fromkeys(user_ids))) if user_id not in current]
+    if len(current) + len(added) > GROUP_MEMBERS_MAX:
+        raise GroupFull(GROUP_MEMBERS_MAX)
+    _insert_members(db, conversation_id, added)
+    db.commit()
+    forget_members(conversation_id)
+    logger.info(f"User {actor_id} added {len(added)} member(s) to group {conversation_id}")
+    return added
+
+
+def _promote_next_owner(db: Session, conversation_id: int) -> Optional[int]:
+    next_owner = db.execute(
+        select(ConversationMember.user_id)
+        .where(ConversationMember.conversation_id == conversation_id)
+        .order_by(ConversationMember.joined_at.asc(), ConversationMember.user_id.asc())
+        .limit(1)
+    ).scalar()
+    if next_owner is None:
+        db.execute(delete(ConversationMessage).where(ConversationMessage.conversation_id == conversation_id))
+        db.execute(delete(Conversation).where(Conversation.id == conversation_id))
+        return None
+    db.execute(update(ConversationMember).where(
+        ConversationMember.conversation_id == conversation_id,
+        ConversationMember.user_id == next_owner
+    ).values(role="owner"))
+    return next_owner
+
+
+def remove_member(db: Session, conversation_id: int, actor_id: int, user_id: int) -> bool:
+    actor_role = member_role(db, conversation_id, actor_id)
+    if actor_role is None:
+        raise GroupNotFound(conversation_id)
+    if actor_id != user_id and actor_role != "owner":
+        raise GroupForbidden(conversation_id)
+    removed_role = member_role(db, conversation_id, user_id)
+    if removed_role is None:
+        return False
+    db.execute(delete(ConversationMember).where(
+        ConversationMember.conversation_id == conversation_id,
+        ConversationMember.user_id == user_id
+    ))
+    if removed_role == "owner":
+        _promote_next_owner(db, conversation_id)
+    db.commit()
+    forget_members(conversation_id)
+    logger.info(f"User {user_id} left group {conversation_id} (removed by {actor_id})")
+    return True
+
+
+def leave_all_groups(db: Session, user_id: int) -> List[int]:
+    memberships = db.execute(select(ConversationMember.conversation_id, ConversationMember.role).where(
+        ConversationMember.user_id == user_id
+    )).all()
+    db.execute(delete(ConversationMember).where(ConversationMember.user_id == user_id))
+    for conversation_id, role in memberships:
+        if role == "owner":
+            _promote_next_owner(db, conversation_id)
+    db.commit()
+    for conversation_id, _ in memberships:
+        forget_members(conversation_id)
+        if _members_listener is not None:
+            _members_listener(conversation_id, [], [user_id])
+    return [conversation_id for conversation_id, _ in memberships]
+
+
+def insert_group_message(
+    db: Session,
+    conversation_id: int,
+    sender_id: int,
+    encrypted_content: str,
+    message_type: str,
+    media_url: Optional[str],
+    reply_to_message_id: Optional[int],
+    timestamp: datetime,
+) -> Optional[Sequence]:
+    values = {
+        "conversation_id": conversation_id,
+        "sender_id": sender_id,
+        "encrypted_content": encrypted_content,
+        "message_type": message_type,
+        "media_url": media_url,
+        "reply_to_message_id": reply_to_message_id,
+        "timestamp": timestamp,
+    }
+    table = ConversationMessage.__table__
+    source = select(*[literal(value, table.c[name].type) for name, value in values.items()]).where(
+        exists().where(ConversationMember.conversation_id == conversation_id, ConversationMember.user_id == sender_id)
+    )
+    if reply_to_message_id is not None:
+        source = source.where(exists().where(
+            ConversationMessage.id == reply_to_message_id,
+            ConversationMessage.conversation_id == conversation_id
+        ))
+    statement = insert(ConversationMessage).from_select(list(values), source).returning(
+        ConversationMessage.id, ConversationMessage.timestamp
+    )
+    return db.execute(statement).first()
+
+
+def group_history_page(db: Session, conversation_id: int, limit: int, before_id: Optional[int] = None) -> List[Sequence]:
+    statement = select(*GROUP_MESSAGE_COLUMNS).where(ConversationMessage.conversation_id == conversation_id)
+    if before_id is not None:
+        statement = statement.where(ConversationMessage.id < before_id)
+    rows = db.execute(statement.order_by(ConversationMessage.id.desc()).limit(limit)).all()
+    rows.reverse()
+    return rows
+
+
+def mark_read(db: Session, conversation_id: int, user_id: int, message_id: int) -> Optional[int]:
+    latest = select(func.max(ConversationMessage.id)).where(
+        ConversationMessage.conversation_id == conversation_id
+    ).scalar_subquery()
+    result = db.execute(update(ConversationMember).where(
+        ConversationMember.conversation_id == conversation_id,
+        ConversationMember.user_id == user_id,
+        ConversationMember.last_read_message_id < message_id,
+        latest >= message_id
+    ).values(last_read_message_id=message_id))
+    db.commit()
+    return message_id if result.rowcount else None
+
+
+def group_summaries(db: Session, user_id: int) -> List[dict]:
+    other = ConversationMessage.__table__.alias("unread_messages")
+    member_count = select(func.count()).where(
+        ConversationMember.conversation_id == Conversation.id
+    ).correlate(Conversation).scalar_subquery()
+    last_message_id = select(func.max(ConversationMessage.id)).where(
+        ConversationMessage.conversation_id == Conversation.id
+    ).correlate(Conversation).scalar_subquery()
+    me = ConversationMember.__table__.alias("me")
+    unread = select(func.count()).select_from(other).where(
+        other.c.conversation_id == me.c.conversation_id,
+        other.c.id > me.c.last_read_message_id,
+        other.c.sender_id != user_id
+    ).correlate(me).scalar_subquery()
+    rows = db.execute(
+        select(
+            Conversation.id, Conversation.title, Conversation.avatar_url, me.c.role,
+            member_count, last_message_id, me.c.last_read_message_id, unread
+        )
+        .select_from(me)
+        .join(Conversation, and_(Conversation.id == me.c.conversation_id, me.c.user_id == user_id))
+        .order_by(Conversation.id.asc())
+    ).all()
+    fields = ("id", "title", "avatar_url", "role", "member_count", "last_message_id", "last_read_message_id", "unread_count")
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def group_detail(db: Session, conversation_id: int) -> Optional[dict]:
+    conversation = db.execute(
+        select(Conversation.id, Conversation.title, Conversation.avatar_url, Conversation.created_at)
+        .where(Conversation.id == conversation_id)
+    ).first()
+    if conversation is None:
+        return None
+    members = db.execute(
+        select(ConversationMember.user_id, ConversationMember.role, ConversationMember.last_read_message_id)
+        .where(ConversationMember.conversation_id == conversation_id)
+        .order_by(ConversationMember.user_id.asc())
+    ).all()
+    return {
+        "id": conversation.id,
+        "title": conversation.title,
+        "avatar_url": conversation.avatar_url,
+        "created_at": conversation.created_at,
+        "members": [
+            {"user_id": member_id, "role": role, "last_read_message_id": last_read}
+            for member_id, role, last_read in members
+        ],
+    }
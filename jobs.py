@@ -0,0 +1,287 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from auth import forget_username
+from database import SessionLocal
+from models import User, Message, MessageChange, MessageChangeHead, ConversationMessage, UserTheme, Contact, BackgroundJob, PrivacyException, UserKeyVersion, ContactHash
+from partitions import archive_tables
+from themes import invalidate_themes
+from groups import leave_all_groups
+
+logger = logging.getLogger(__name__)
+
+JOB_CHUNK_SIZE = 500
+JOB_CHUNK_PAUSE = 0.05
+JOB_WORKERS = 1
+
+MEDIA_DIRS = ("static/uploads", "static/avatars")
+
+_handlers: Dict[str, Callable] = {}
+
+
+def job_handler(kind: str):
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def local_media_path(url: Optional[str]) -> Optional[str]:
+    if not url or "/static/" not in url:
+        return None
+    path = "static/" + url.split("/static/", 1)[1].split("?", 1)[0]
+    path = os.path.normpath(path)
+    if not any(path.startswith(os.path.normpath(d) + os.sep) for d in MEDIA_DIRS):
+        return None
+    return path
+
+
+def remove_media_files(urls) -> int:
+    removed = 0
+    for url in urls:
+        path = local_media_path(url)
+        if not path or not os.path.exists(path):
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except Exception as e:
+            logger.warning(f"Failed to delete media file {path}: {e}")
+    return removed
+
+
+class JobContext:
+    def __init__(self, db: Session, job: BackgroundJob):
+        self.db = db
+        self.job = job
+        self.payload = json.loads(job.payload) if job.payload else {}
+
+    def set_total(self, total: int):
+        self.job.total = (self.job.progress or 0) + total
+        self.db.commit()
+
+    def advance(self, count: int):
+        self.job.progress = (self.job.progress or 0) + count
+
+    def delete_in_chunks(self, model, condition, media_column: Optional[str] = None) -> int:
+        table = getattr(model, "__table__", model)
+        deleted = 0
+        while True:
+            columns = [table.c.id] + ([table.c[media_column]] if media_column else [])
+            rows = self.db.execute(select(*columns).where(condition).limit(JOB_CHUNK_SIZE)).all()
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            self.db.execute(delete(table).where(table.c.id.in_(ids)))
+            self.advance(len(ids))
+            self.db.commit()
+            deleted += len(ids)
+            if media_column:
+                remove_media_files(row[1] for row in rows if row[1])
+            time.sleep(JOB_CHUNK_PAUSE)
+        return deleted
+
+
+def enqueue_job(db: Session, kind: str, payload: dict, user_id: Optional[int] = None) -> BackgroundJob:
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = BackgroundJob(kind=kind, user_id=user_id, payload=json.dumps(payload), status="pending", progress=0)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    job_runner.submit(job.id)
+    logger.info(f"Enqueued job {job.id} ({kind}) for user {user_id}")
+    return job
+
+
+def job_status(job: BackgroundJob) -> dict:
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "total": job.total,
+        "error": job.error,
+    }
+
+
+class JobRunner:
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+
+    def submit(self, job_id: int):
+        if self.queue is None:
+            logger.warning(f"Job runner is not started, job {job_id} will run after restart")
+            return
+        self.queue.put_nowait(job_id)
+
+    async def start(self, resume: bool = True):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        if resume:
+            for job_id in await asyncio.to_thread(self._unfinished_job_ids):
+                self.queue.put_nowait(job_id)
+        self.tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Job runner started with {self.workers} worker(s), {self.queue.qsize()} job(s) resumed")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.queue = None
+
+    def _unfinished_job_ids(self) -> List[int]:
+        db = SessionLocal()
+        try:
+            rows = db.query(BackgroundJob.id).filter(
+                BackgroundJob.status.in_(["pending", "running"])
+            ).order_by(BackgroundJob.id.asc()).all()
+            return [row[0] for row in rows]
+        finally:
+            db.close()
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await asyncio.to_thread(self._run, job_id)
+            except Exception as e:
+                logger.error(f"Job {job_id} crashed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def _run(self, job_id: int):
+        db = SessionLocal()
+        try:
+            job = db.query(BackgroundJob).filter(BackgroundJob.id == job_id).first()
+            if not job or job.status in ("done", "failed"):
+                return
+            handler = _handlers.get(job.kind)
+            if handler is None:
+                job.status = "failed"
+                job.error = f"Unknown job kind: {job.kind}"
+                db.commit()
+                return
+
+            job.status = "running"
+            db.commit()
+            logger.info(f"Running job {job.id} ({job.kind})")
+
+            try:
+                handler(JobContext(db, job))
+            except Exception as e:
+                db.rollback()
+                job.status = "failed"
+                job.error = str(e)
+                db.commit()
+                logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+                return
+
+            job.status = "done"
+            db.commit()
+            logger.info(f"Job {job.id} ({job.kind}) finished, {job.progress} row(s) processed")
+        finally:
+            db.close()
+
+
+job_runner = JobRunner()
+
+
+def _count(db: Session, table, condition) -> int:
+    return db.execute(select(func.count()).select_from(table).where(condition)).scalar() or 0
+
+
+def _prune_change_heads(db: Session, condition):
+    db.execute(update(MessageChangeHead).where(condition).values(pruned_seq=MessageChangeHead.last_seq))
+    db.commit()
+
+
+@job_handler("clear_chat")
+def _clear_chat(ctx: JobContext):
+    user_id = ctx.payload["user_id"]
+    peer_id = ctx.payload["peer_id"]
+    tables = [Message.__table__] + [table for table, _, _ in archive_tables(ctx.db, cached=False)]
+    conditions = [
+        (table, or_(
+            (table.c.sender_id == user_id) & (table.c.receiver_id == peer_id),
+            (table.c.sender_id == peer_id) & (table.c.receiver_id == user_id),
+        ))
+        for table in tables
+    ]
+    low, high = (user_id, peer_id) if user_id < peer_id else (peer_id, user_id)
+    change_condition = (MessageChange.user_low_id == low) & (MessageChange.user_high_id == high)
+    ctx.set_total(
+        sum(_count(ctx.db, table, condition) for table, condition in conditions)
+        + _count(ctx.db, MessageChange.__table__, change_condition)
+    )
+    deleted = 0
+    for table, condition in conditions:
+        deleted += ctx.delete_in_chunks(table, condition, media_column="media_url")
+    _prune_change_heads(ctx.db, (MessageChangeHead.user_low_id == low) & (MessageChangeHead.user_high_id == high))
+    ctx.delete_in_chunks(MessageChange, change_condition)
+    logger.info(f"User {user_id} cleared chat with user {peer_id}. Deleted {deleted} messages.")
+
+
+@job_handler("delete_account")
+def _delete_account(ctx: JobContext):
+    db = ctx.db
+    user_id = ctx.payload["user_id"]
+
+    tables = [Message.__table__] + [table for table, _, _ in archive_tables(db, cached=False)]
+    message_conditions = [
+        (table, or_(table.c.sender_id == user_id, table.c.receiver_id == user_id))
+        for table in tables
+    ]
+    contact_condition = or_(Contact.owner_id == user_id, Contact.contact_id == user_id)
+    theme_condition = UserTheme.user_id == user_id
+    privacy_condition = or_(PrivacyException.owner_id == user_id, PrivacyException.viewer_id == user_id)
+    key_condition = UserKeyVersion.user_id == user_id
+    contact_hash_condition = ContactHash.owner_id == user_id
+    change_condition = or_(MessageChange.user_low_id == user_id, MessageChange.user_high_id == user_id)
+    group_message_condition = ConversationMessage.sender_id == user_id
+    ctx.set_total(
+        sum(_count(db, table, condition) for table, condition in message_conditions)
+        + db.query(Contact.id).filter(contact_condition).count()
+        + db.query(UserTheme.id).filter(theme_condition).count()
+        + db.query(PrivacyException.id).filter(privacy_condition).count()
+        + db.query(UserKeyVersion.id).filter(key_condition).count()
+        + db.query(ContactHash.id).filter(contact_hash_condition).count()
+        + db.query(MessageChange.id).filter(change_condition).count()
+        + db.query(ConversationMessage.id).filter(group_message_condition).count()
+        + 1
+    )
+
+    for table, condition in message_conditions:
+        ctx.delete_in_chunks(table, condition, media_column="media_url")
+    ctx.delete_in_chunks(Contact, contact_condition)
+    ctx.delete_in_chunks(UserTheme, theme_condition, media_column="wallpaper_url")
+    ctx.delete_in_chunks(PrivacyException, privacy_condition)
+    ctx.delete_in_chunks(UserKeyVersion, key_condition)
+    ctx.delete_in_chunks(ContactHash, contact_hash_condition)
+    _prune_change_heads(db, or_(MessageChangeHead.user_low_id == user_id, MessageChangeHead.user_high_id == user_id))
+    ctx.delete_in_chunks(MessageChange, change_condition)
+    ctx.delete_in_chunks(ConversationMessage, group_message_condition, media_column="media_url")
+    leave_all_groups(db, user_id)
+
+    user = db.query(User).filter(User.id == user_id).first()
+    if user:
+        avatar_url = user.avatar_url
+        username = user.username
+        db.delete(user)
+        ctx.advance(1)
+        db.commit()
+        forget_username(username)
+        invalidate_themes(user_id)
+        remove_media_files([avatar_url])
+    logger.info(f"User account {user_id} deleted successfully")
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select, union
+from sqlalchemy.orm import Session
+
+from event_bus import event_bus
+from models import User, Message, UserKeyVersion, ConversationMember
+from partitions import archive_tables
+
+logger = logging.getLogger(__name__)
+
+KEY_CACHE_SIZE = 50000
+KEY_CACHE_TTL = 300
+IN_CLAUSE_CHUNK = 500
+
+KeyEntry = Tuple[int, Optional[str]]
+
+_key_cache: "OrderedDict[int, Tuple[KeyEntry, float]]" = OrderedDict()
+_key_lock = threading.Lock()
+_key_generation: Dict[int, int] = {}
+
+
+def _remember_key(user_id: int, entry: KeyEntry, generation: int, now: float):
+    with _key_lock:
+        if _key_generation.get(user_id, 0) != generation:
+            return
+        _key_cache[user_id] = (entry, now + KEY_CACHE_TTL)
+        _key_cache.move_to_end(user_id)
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+
+
+def forget_key(user_id: int, broadcast: bool = True):
+    with _key_lock:
+        _key_cache.pop(user_id, None)
+        _key_generation[user_id] = _key_generation.get(user_id, 0) + 1
+    if broadcast:
+        event_bus.publish_nowait("key_rotated", {"user_id": user_id})
+
+
+def current_keys(db: Session, user_ids: Iterable[int]) -> Dict[int, KeyEntry]:
+    now = time.monotonic()
+    keys: Dict[int, KeyEntry] = {}
+    missing = []
+    for user_id in user_ids:
+        cached = _key_cache.get(user_id)
+        if cached is not None and cached[1] > now:
+            keys[user_id] = cached[0]
+        else:
+            missing.append(user_id)
+
+    generations = {user_id: _key_generation.get(user_id, 0) for user_id in missing}
+    for start in range(0, len(missing), IN_CLAUSE_CHUNK):
+        chunk = missing[start:start + IN_CLAUSE_CHUNK]
+        for user_id, key_version, public_key in db.query(User.id, User.key_version, User.public_key).filter(User.id.in_(chunk)):
+            entry = (key_version or 1, public_key)
+            _remember_key(user_id, entry, generations[user_id], now)
+            keys[user_id] = entry
+    return keys
+
+
+def current_key(db: Session, user_id: int) -> Optional[KeyEntry]:
+    return current_keys(db, [user_id]).get(user_id)
+
+
+def key_at_version(db: Session, user_id: int, key_version: int) -> Optional[str]:
+    row = db.query(UserKeyVersion.public_key).filter(
+        UserKeyVersion.user_id == user_id,
+        UserKeyVersion.key_version == key_version
+    ).first()
+    return row[0] if row else None
+
+
+def record_initial_key(db: Session, user: User):
+    if user.public_key:
+        db.add(UserKeyVersion(user_id=user.id, key_version=user.key_version or 1, public_key=user.public_key))
+
+
+def rotate_key(db: Session, user: User, public_key: str) -> Optional[int]:
+    if public_key == user.public_key:
+        return None
+    key_version = (user.key_version or 1) + 1 if user.public_key else (user.key_version or 1)
+    db.add(UserKeyVersion(user_id=user.id, key_version=key_version, public_key=public_key))
+    user.public_key = public_key
+    user.key_version = key_version
+    db.commit()
+    forget_key(user.id)
+    logger.info(f"User {user.id} rotated public key to version {key_version}")
+    return key_version
+
+
+def conversation_peers(db: Session, user_id: int) -> List[int]:
+    tables = [Message.__table__] + [table for table, _, _ in archive_tables(db)]
+    me = ConversationMember.__table__.alias("me")
+    selects = [
+        select(ConversationMember.user_id).join(me, me.c.conversation_id == ConversationMember.conversation_id).where(
+            me.c.user_id == user_id
+        )
+    ]
+    for table in tables:
+        selects.append(select(table.c.receiver_id).where(table.c.sender_id == user_id))
+        selects.append(select(table.c.sender_id).where(table.c.receiver_id == user_id))
+    return [peer_id for (peer_id,) in db.execute(union(*selects)) if peer_id != user_id]
+
+
+async def _on_bus_key_rotated(origin: str, message: dict):
+    forget_key(message["user_id"], broadcast=False)
+
+
+event_bus.on("key_rotated", _on_bus_key_rotated)
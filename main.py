@@ -1,90 +1,168 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import os
-from sqladmin import Admin
 import socketio
 import logging
-from database import engine, init_db
-from admin import UserAdmin, MessageAdmin
+from database import SessionLocal, engine
 from routes import router
-from socketio_handler import ChatNamespace
-
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-        ]
-    )
-app = FastAPI(
-    title="Messenger Backend API",
-    description="Backend API for messenger application with E2EE support",
-    version="1.0.0"
-)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-init_db()
-
-app.include_router(router)
-
-os.makedirs("static/avatars", exist_ok=True)
-os.makedirs("static/uploads", exist_ok=True)
-
-app.mount("/static", StaticFiles(directory="static"), name="static")
-admin = Admin(
-    app, 
-    engine, 
-    title="Nebula Admin Panel",
-    base_url="/admin",
-    logo_url="https://via.placeholder.com/200x50/7C4DFF/FFFFFF?text=Nebula+Admin",
-    templates_dir="templates",
+from socketio_handler import ChatNamespace, WorkerSocketIOServer, set_sio_server
+from serialization import FastJSONResponse
+from jobs import job_runner
+from retention import retention_scheduler
+from usage import usage_flusher
+from auth import prewarm_identities, prewarm_usernames
+from partitions import archive_tables
+from catalog import missing_preset_avatars
+from event_bus import event_bus, is_primary_worker
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(),
+    ]
 )
-admin.add_view(UserAdmin)
-admin.add_view(MessageAdmin)
-
-sio = socketio.AsyncServer(
-    async_mode='asgi',
-    cors_allowed_origins="*",
-    logger=True,
-    engineio_logger=True,
-    ping_timeout=60,
-    ping_interval=25,
-    max_http_buffer_size=1e6,
-    allow_upgrades=True,
-    transports=['polling', 'websocket'],
-)
-sio.register_namespace(ChatNamespace('/'))
-
-from socketio_handler import set_sio_server
-set_sio_server(sio)
-
-socketio_app = socketio.ASGIApp(sio, other_asgi_app=app, socketio_path='socket.io')
+logger = logging.getLogger(__name__)
+
+ENABLE_ADMIN = os.environ.get("ENABLE_ADMIN", "0") == "1"
+RUN_MIGRATIONS_ON_STARTUP = os.environ.get("RUN_MIGRATIONS_ON_STARTUP", "0") == "1"
+PREWARM_CACHES = os.environ.get("PREWARM_CACHES", "1") == "1"
+
+
+def prewarm_caches():
+    db = SessionLocal()
+    try:
+        identities = prewarm_identities(db)
+        usernames = prewarm_usernames(db)
+        partitions = len(archive_tables(db))
+        logger.info(f"Caches prewarmed: {identities} identities, {usernames} usernames, {partitions} archive partitions")
+    except Exception as e:
+        logger.warning(f"Cache prewarm failed: {e}")
+    finally:
+        db.close()
+
+
+def check_preset_avatars():
+    missing = missing_preset_avatars()
+    if missing:
+        logger.warning(f"{len(missing)} preset avatar(s) are not bundled and will be redirected to the CDN, run: python catalog.py fetch-avatars")
+
+
+def check_schema():
+    from migrations import migrate, pending_migrations
+    if RUN_MIGRATIONS_ON_STARTUP and is_primary_worker():
+        migrate()
+        return
+    pending = pending_migrations()
+    if pending:
+        logger.warning(f"Database schema is behind by {len(pending)} migration(s), run: python migrations.py upgrade")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs("static/avatars", exist_ok=True)
+    os.makedirs("static/uploads", exist_ok=True)
+    await asyncio.to_thread(check_schema)
+    if is_primary_worker():
+        check_preset_avatars()
+    await event_bus.start()
+    await job_runner.start(resume=is_primary_worker())
+    await usage_flusher.start()
+    if is_primary_worker():
+        await retention_scheduler.start()
+    prewarm = asyncio.ensure_future(asyncio.to_thread(prewarm_caches)) if PREWARM_CACHES else None
+    try:
+        yield
+    finally:
+        if prewarm is not None:
+            await asyncio.gather(prewarm, return_exceptions=True)
+        await retention_scheduler.stop()
+        await usage_flusher.stop()
+        await job_runner.stop()
+        await event_bus.stop()
+
+
+def mount_admin(app: FastAPI):
+    from sqladmin import Admin
+    from admin import UserAdmin, MessageAdmin, StatsView, UsageView
+    admin = Admin(
+        app,
+        engine,
+        title="Nebula Admin Panel",
+        base_url="/admin",
+        logo_url="https://via.placeholder.com/200x50/7C4DFF/FFFFFF?text=Nebula+Admin",
+        templates_dir="templates",
+    )
+    admin.add_view(UserAdmin)
+    admin.add_view(MessageAdmin)
+    admin.add_view(StatsView)
+    admin.add_view(UsageView)
+    return admin
+
+
+def create_app(enable_admin: bool = ENABLE_ADMIN) -> FastAPI:
+    app = FastAPI(
+        title="Messenger Backend API",
+        description="Backend API for messenger application with E2EE support",
+        version="1.0.0",
+        default_response_class=FastJSONResponse,
+        lifespan=lifespan,
+    )
 
-@app.get("/")
-async def root():
-    return {
-        "message": "Messenger Backend API",
-        "docs": "/docs",
-        "admin": "/admin"
-    }
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
 
+    app.include_router(router)
+    app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
+    if enable_admin:
+        mount_admin(app)
+
+    @app.get("/")
+    async def root():
+        return {
+            "message": "Messenger Backend API",
+            "docs": "/docs",
+            "admin": "/admin" if enable_admin else None
+        }
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy"}
+
+    return app
+
+
+def create_sio_server() -> WorkerSocketIOServer:
+    sio = WorkerSocketIOServer(
+        async_mode='asgi',
+        cors_allowed_origins="*",
+        logger=True,
+        engineio_logger=True,
+        ping_timeout=60,
+        ping_interval=25,
+        max_http_buffer_size=1e6,
+        http_compression=True,
+        compression_threshold=1024,
+        allow_upgrades=True,
+        transports=['polling', 'websocket'],
+    )
+    sio.register_namespace(ChatNamespace('/'))
+    set_sio_server(sio)
+    return sio
 
-@app.get("/health")
-async def health():
-    return {"status": "healthy"}
 
+def create_asgi_app(enable_admin: bool = ENABLE_ADMIN) -> socketio.ASGIApp:
+    return socketio.ASGIApp(create_sio_server(), other_asgi_app=create_app(enable_admin), socketio_path='socket.io')
 
-asgi_app = socketio_app
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(socketio_app, host="0.0.0.0", port=5000)
-
+    uvicorn.run(create_asgi_app(), host="0.0.0.0", port=5000, ws_per_message_deflate=True)
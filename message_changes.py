@@ -0,0 +1,136 @@
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import delete, insert, literal, text, update
+from sqlalchemy.orm import Session
+
+from jobs import remove_media_files
+from models import Message, MessageChange, MessageChangeHead
+from partitions import archive_tables
+from retention import conversation_pair
+from serialization import isoformat_utc
+
+logger = logging.getLogger(__name__)
+
+CHANGE_KINDS = ("edit", "delete")
+CHANGES_PAGE_MAX = 500
+
+CHANGE_FIELDS = ("seq", "message_id", "kind", "encrypted_content", "created_at")
+CHANGE_COLUMNS = tuple(getattr(MessageChange, name) for name in CHANGE_FIELDS)
+
+_next_seq = text(
+    "INSERT INTO message_change_heads (user_low_id, user_high_id, last_seq, pruned_seq) "
+    "VALUES (:low, :high, 1, 0) "
+    "ON CONFLICT (user_low_id, user_high_id) DO UPDATE SET last_seq = message_change_heads.last_seq + 1 "
+    "RETURNING last_seq"
+)
+
+
+class MessageNotFound(Exception):
+    pass
+
+
+class NotMessageOwner(Exception):
+    pass
+
+
+def _append_change(db: Session, low: int, high: int, message_id: int, kind: str,
+                   encrypted_content: Optional[str], created_at: datetime) -> int:
+    seq = db.execute(_next_seq, {"low": low, "high": high}).scalar_one()
+    db.execute(insert(MessageChange).values(
+        user_low_id=low, user_high_id=high, seq=seq, message_id=message_id, kind=kind,
+        encrypted_content=encrypted_content, created_at=created_at,
+    ))
+    return seq
+
+
+def _owned_archive_change(db: Session, message_id: int, user_id: int, kind: str, encrypted_content: Optional[str],
+                          now: datetime):
+    for table, min_id, max_id in archive_tables(db, cached=False):
+        if min_id is not None and not min_id <= message_id <= max_id:
+            continue
+        owned = (table.c.id == message_id, table.c.sender_id == user_id)
+        if kind == "delete":
+            statement = delete(table).where(*owned).returning(table.c.sender_id, table.c.receiver_id, table.c.media_url)
+        else:
+            statement = update(table).where(*owned).values(encrypted_content=encrypted_content, edited_at=now).returning(
+                table.c.sender_id, table.c.receiver_id, literal(None)
+            )
+        row = db.execute(statement).first()
+        if row is not None:
+            return row
+        if db.query(table.c.id).filter(table.c.id == message_id).first() is not None:
+            db.rollback()
+            raise NotMessageOwner(message_id)
+    return None
+
+
+def _owned_update(db: Session, message_id: int, user_id: int, kind: str, values: dict,
+                  encrypted_content: Optional[str], now: datetime):
+    row = db.execute(
+        update(Message)
+        .where(Message.id == message_id, Message.sender_id == user_id, Message.deleted_at.is_(None))
+        .values(**values)
+        .returning(Message.sender_id, Message.receiver_id, literal(None))
+    ).first()
+    if row is not None:
+        return row
+    owner = db.query(Message.sender_id).filter(Message.id == message_id, Message.deleted_at.is_(None)).first()
+    if owner is not None:
+        db.rollback()
+        raise NotMessageOwner(message_id)
+    row = _owned_archive_change(db, message_id, user_id, kind, encrypted_content, now)
+    if row is None:
+        db.rollback()
+        raise MessageNotFound(message_id)
+    return row
+
+
+def _record(db: Session, message_id: int, user_id: int, kind: str, values: dict,
+            encrypted_content: Optional[str], now: datetime) -> dict:
+    sender_id, receiver_id, archived_media_url = _owned_update(db, message_id, user_id, kind, values, encrypted_content, now)
+    low, high = conversation_pair(sender_id, receiver_id)
+    seq = _append_change(db, low, high, message_id, kind, encrypted_content, now)
+    db.commit()
+    if archived_media_url:
+        remove_media_files([archived_media_url])
+    logger.info(f"User {user_id} {kind}ed message {message_id} (conversation {low}:{high}, seq {seq})")
+    return {
+        "seq": seq,
+        "message_id": message_id,
+        "kind": kind,
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "encrypted_content": encrypted_content,
+        "timestamp": isoformat_utc(now),
+    }
+
+
+def edit_message(db: Session, message_id: int, user_id: int, encrypted_content: str) -> dict:
+    now = datetime.now(timezone.utc)
+    values = {"encrypted_content": encrypted_content, "edited_at": now}
+    return _record(db, message_id, user_id, "edit", values, encrypted_content, now)
+
+
+def delete_message(db: Session, message_id: int, user_id: int) -> dict:
+    now = datetime.now(timezone.utc)
+    return _record(db, message_id, user_id, "delete", {"encrypted_content": "", "deleted_at": now}, None, now)
+
+
+def changes_since(db: Session, user_id: int, peer_id: int, after_seq: int, limit: int) -> dict:
+    low, high = conversation_pair(user_id, peer_id)
+    pruned_seq = db.query(MessageChangeHead.pruned_seq).filter(
+        MessageChangeHead.user_low_id == low,
+        MessageChangeHead.user_high_id == high
+    ).scalar() or 0
+    rows = db.query(*CHANGE_COLUMNS).filter(
+        MessageChange.user_low_id == low,
+        MessageChange.user_high_id == high,
+        MessageChange.seq > after_seq
+    ).order_by(MessageChange.seq.asc()).limit(limit + 1).all()
+    return {
+        "changes": [dict(zip(CHANGE_FIELDS, row)) for row in rows[:limit]],
+        "has_more": len(rows) > limit,
+        "reset": after_seq < pruned_seq,
+    }
@@ -0,0 +1,294 @@
+import json
+import logging
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import bindparam, inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from database import Base, engine
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = "schema_migrations"
+BACKFILL_BATCH_SIZE = 1000
+BACKFILL_PAUSE = 0.01
+
+_migrations: Dict[int, Tuple[str, Callable]] = {}
+
+
+def migration(version: int, name: str):
+    def register(func):
+        if version in _migrations:
+            raise ValueError(f"Duplicate migration version: {version}")
+        _migrations[version] = (name, func)
+        return func
+    return register
+
+
+def column_names(conn: Connection, table: str) -> List[str]:
+    return [column["name"] for column in inspect(conn).get_columns(table)]
+
+
+def add_column(conn: Connection, table: str, column: str, ddl: str) -> bool:
+    if column in column_names(conn, table):
+        return False
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    conn.commit()
+    logger.info(f"Added column {table}.{column}")
+    return True
+
+
+def create_index(conn: Connection, name: str, table: str, columns: Sequence[str], unique: bool = False):
+    unique_sql = "UNIQUE " if unique else ""
+    column_sql = ", ".join(columns)
+    if conn.dialect.name == "postgresql":
+        conn.commit()
+        conn.execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            conn.execute(text(
+                f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column_sql})"
+            ))
+        finally:
+            conn.execution_options(isolation_level=conn.default_isolation_level)
+    else:
+        conn.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({column_sql})"))
+        conn.commit()
+
+
+def backfill(conn: Connection, table: str, assignments: str, condition: str, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    updated = 0
+    while True:
+        result = conn.execute(text(
+            f"UPDATE {table} SET {assignments} WHERE id IN "
+            f"(SELECT id FROM {table} WHERE {condition} LIMIT :batch_size)"
+        ), {"batch_size": batch_size})
+        conn.commit()
+        if not result.rowcount:
+            return updated
+        updated += result.rowcount
+        time.sleep(BACKFILL_PAUSE)
+
+
+def _ensure_migrations_table(conn: Connection):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} ("
+        "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    ))
+    conn.commit()
+
+
+def applied_versions(conn: Connection) -> List[int]:
+    if MIGRATIONS_TABLE not in inspect(conn).get_table_names():
+        return []
+    return [row[0] for row in conn.execute(text(f"SELECT version FROM {MIGRATIONS_TABLE} ORDER BY version"))]
+
+
+def pending_migrations(db_engine: Engine = engine) -> List[Tuple[int, str]]:
+    with db_engine.connect() as conn:
+        applied = set(applied_versions(conn))
+    return [(version, _migrations[version][0]) for version in sorted(_migrations) if version not in applied]
+
+
+def migrate(db_engine: Engine = engine, target: Optional[int] = None) -> List[int]:
+    done = []
+    with db_engine.connect() as conn:
+        _ensure_migrations_table(conn)
+        applied = set(applied_versions(conn))
+        for version in sorted(_migrations):
+            if version in applied or (target is not None and version > target):
+                continue
+            name, func = _migrations[version]
+            logger.info(f"Applying migration {version}: {name}")
+            func(conn)
+            conn.execute(
+                text(f"INSERT INTO {MIGRATIONS_TABLE} (version, name) VALUES (:version, :name)"),
+                {"version": version, "name": name}
+            )
+            conn.commit()
+            done.append(version)
+    return done
+
+
+@migration(1, "baseline schema")
+def _baseline(conn: Connection):
+    import models
+    Base.metadata.create_all(bind=conn)
+    conn.commit()
+
+
+@migration(2, "legacy user and message columns")
+def _legacy_columns(conn: Connection):
+    add_column(conn, "users", "first_name", "VARCHAR")
+    add_column(conn, "users", "last_name", "VARCHAR")
+    add_column(conn, "users", "phone", "VARCHAR")
+    add_column(conn, "users", "avatar_frame", "VARCHAR")
+    add_column(conn, "users", "avatar_visibility", "VARCHAR DEFAULT 'all'")
+    add_column(conn, "users", "avatar_visibility_exceptions", "TEXT")
+    add_column(conn, "users", "show_read_receipts", "BOOLEAN DEFAULT 1")
+    add_column(conn, "users", "show_last_seen", "BOOLEAN DEFAULT 1")
+    add_column(conn, "users", "show_online_status", "BOOLEAN DEFAULT 1")
+    add_column(conn, "messages", "reply_to_message_id", "INTEGER")
+    create_index(conn, "ix_users_phone", "users", ["phone"], unique=True)
+
+
+@migration(3, "backfill privacy defaults")
+def _privacy_defaults(conn: Connection):
+    backfill(conn, "users", "avatar_visibility = 'all'", "avatar_visibility IS NULL")
+    backfill(conn, "users", "show_read_receipts = 1", "show_read_receipts IS NULL")
+    backfill(conn, "users", "show_last_seen = 1", "show_last_seen IS NULL")
+    backfill(conn, "users", "show_online_status = 1", "show_online_status IS NULL")
+
+
+@migration(4, "message timestamp index")
+def _message_timestamp_index(conn: Connection):
+    create_index(conn, "ix_messages_timestamp", "messages", ["timestamp"])
+
+
+@migration(5, "privacy exceptions relation")
+def _privacy_exceptions(conn: Connection):
+    from models import PrivacyException
+    Base.metadata.create_all(bind=conn, tables=[PrivacyException.__table__])
+    conn.commit()
+    copy = text(
+        "INSERT INTO privacy_exceptions (owner_id, viewer_id, setting) "
+        "SELECT :owner_id, id, 'avatar' FROM users WHERE id IN :viewer_ids AND id != :owner_id "
+        "AND id NOT IN (SELECT viewer_id FROM privacy_exceptions WHERE owner_id = :owner_id AND setting = 'avatar')"
+    ).bindparams(bindparam("viewer_ids", expanding=True))
+    rows = conn.execute(text(
+        "SELECT id, avatar_visibility_exceptions FROM users WHERE avatar_visibility_exceptions IS NOT NULL"
+    )).all()
+    for owner_id, raw in rows:
+        try:
+            viewer_ids = sorted({int(viewer_id) for viewer_id in json.loads(raw)})
+        except (ValueError, TypeError):
+            logger.warning(f"Skipping malformed avatar exceptions of user {owner_id}")
+            continue
+        if viewer_ids:
+            conn.execute(copy, {"owner_id": owner_id, "viewer_ids": viewer_ids})
+    conn.commit()
+
+
+@migration(6, "message conversation index")
+def _message_conversation_index(conn: Connection):
+    create_index(conn, "ix_messages_conversation", "messages", ["sender_id", "receiver_id"])
+
+
+@migration(7, "versioned public keys")
+def _key_versions(conn: Connection):
+    from models import UserKeyVersion
+    add_column(conn, "users", "key_version", "INTEGER NOT NULL DEFAULT 1")
+    Base.metadata.create_all(bind=conn, tables=[UserKeyVersion.__table__])
+    conn.commit()
+    conn.execute(text(
+        "INSERT INTO user_key_versions (user_id, key_version, public_key) "
+        "SELECT id, key_version, public_key FROM users WHERE public_key IS NOT NULL "
+        "AND id NOT IN (SELECT user_id FROM user_key_versions)"
+    ))
+    conn.commit()
+
+
+@migration(8, "message receiver index")
+def _message_receiver_index(conn: Connection):
+    create_index(conn, "ix_messages_receiver", "messages", ["receiver_id", "sender_id"])
+
+
+@migration(9, "contact sync")
+def _contact_sync(conn: Connection):
+    from models import ContactHash
+    from contacts import phone_hash
+    add_column(conn, "users", "phone_hash", "VARCHAR")
+    add_column(conn, "contacts", "source", "VARCHAR NOT NULL DEFAULT 'manual'")
+    Base.metadata.create_all(bind=conn, tables=[ContactHash.__table__])
+    conn.commit()
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, phone FROM users WHERE phone_hash IS NULL AND phone IS NOT NULL AND phone != '' LIMIT :batch_size"
+        ), {"batch_size": BACKFILL_BATCH_SIZE}).all()
+        if not rows:
+            break
+        conn.execute(
+            text("UPDATE users SET phone_hash = :phone_hash WHERE id = :id"),
+            [{"id": user_id, "phone_hash": phone_hash(phone) or ""} for user_id, phone in rows]
+        )
+        conn.commit()
+        time.sleep(BACKFILL_PAUSE)
+    create_index(conn, "ix_users_phone_hash", "users", ["phone_hash"])
+
+
+@migration(10, "usage rollups")
+def _usage_rollups(conn: Connection):
+    from models import UsageRollup, UsageActiveUser
+    Base.metadata.create_all(bind=conn, tables=[UsageRollup.__table__, UsageActiveUser.__table__])
+    conn.commit()
+
+
+@migration(11, "message reply index")
+def _message_reply_index(conn: Connection):
+    create_index(conn, "ix_messages_reply_to", "messages", ["reply_to_message_id"])
+
+
+@migration(12, "message edits and change log")
+def _message_changes(conn: Connection):
+    from models import MessageChange
+    add_column(conn, "messages", "edited_at", "DATETIME")
+    add_column(conn, "messages", "deleted_at", "DATETIME")
+    add_column(conn, "archived_messages", "edited_at", "DATETIME")
+    partitions = [name for (name,) in conn.execute(text("SELECT name FROM message_partitions"))]
+    existing = set(inspect(conn).get_table_names())
+    for name in partitions:
+        if name in existing:
+            add_column(conn, name, "edited_at", "DATETIME")
+    create_index(conn, "ix_messages_deleted_at", "messages", ["deleted_at"])
+    Base.metadata.create_all(bind=conn, tables=[MessageChange.__table__])
+    conn.commit()
+
+
+@migration(13, "group conversations")
+def _group_conversations(conn: Connection):
+    from models import Conversation, ConversationMember, ConversationMessage
+    Base.metadata.create_all(bind=conn, tables=[
+        Conversation.__table__, ConversationMember.__table__, ConversationMessage.__table__
+    ])
+    conn.commit()
+
+
+@migration(14, "change log sequence heads")
+def _message_change_heads(conn: Connection):
+    from models import MessageChangeHead
+    Base.metadata.create_all(bind=conn, tables=[MessageChangeHead.__table__])
+    conn.execute(text(
+        "INSERT INTO message_change_heads (user_low_id, user_high_id, last_seq, pruned_seq) "
+        "SELECT user_low_id, user_high_id, MAX(seq), MIN(seq) - 1 FROM message_changes "
+        "GROUP BY user_low_id, user_high_id"
+    ))
+    conn.commit()
+
+
+@migration(15, "user deletion flag")
+def _user_deleted_at(conn: Connection):
+    add_column(conn, "users", "deleted_at", "DATETIME")
+    conn.commit()
+
+
+def main(argv: List[str]):
+    command = argv[1] if len(argv) > 1 else "upgrade"
+    if command == "upgrade":
+        target = int(argv[2]) if len(argv) > 2 else None
+        done = migrate(target=target)
+        for version in done:
+            print(f" Миграция {version} ({_migrations[version][0]}) применена")
+        print("\n Миграция завершена успешно!" if done else " Новых миграций нет")
+    elif command == "status":
+        with engine.connect() as conn:
+            applied = set(applied_versions(conn))
+        for version in sorted(_migrations):
+            mark = "+" if version in applied else " "
+            print(f" [{mark}] {version} {_migrations[version][0]}")
+    else:
+        print("Использование: python migrations.py [upgrade [VERSION] | status]")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Boolean, DateTime, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -12,8 +12,10 @@ class User(Base):
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
     phone = Column(String, unique=True, index=True, nullable=False)
+    phone_hash = Column(String, index=True, nullable=True)
     password_hash = Column(String, nullable=False)
     public_key = Column(Text, nullable=True)
+    key_version = Column(Integer, default=1, nullable=False)
     avatar_url = Column(String, nullable=True)
     avatar_frame = Column(String, nullable=True)
     bio = Column(Text, nullable=True)
@@ -26,6 +28,7 @@ class User(Base):
     show_read_receipts = Column(Boolean, default=True, nullable=False)
     show_last_seen = Column(Boolean, default=True, nullable=False)
     show_online_status = Column(Boolean, default=True, nullable=False)
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
 
     sent_messages = relationship("Message", foreign_keys="Message.sender_id", back_populates="sender")
     received_messages = relationship("Message", foreign_keys="Message.receiver_id", back_populates="receiver")
@@ -41,12 +44,20 @@ class Message(Base):
     message_type = Column(String, default="text", nullable=False)
     media_url = Column(String, nullable=True)
     reply_to_message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
     is_read = Column(Boolean, default=False, nullable=False)
+    edited_at = Column(DateTime(timezone=True), nullable=True)
+    deleted_at = Column(DateTime(timezone=True), nullable=True, index=True)
 
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
 
+    __table_args__ = (
+        Index('ix_messages_conversation', 'sender_id', 'receiver_id'),
+        Index('ix_messages_receiver', 'receiver_id', 'sender_id'),
+        Index('ix_messages_reply_to', 'reply_to_message_id'),
+    )
+
 
 class UserTheme(Base):
     __tablename__ = "user_themes"
@@ -73,6 +84,7 @@ class Contact(Base):
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     contact_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     local_name = Column(String, nullable=True)
+    source = Column(String, default="manual", nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
 
@@ -83,3 +95,189 @@ class Contact(Base):
         UniqueConstraint('owner_id', 'contact_id', name='uq_owner_contact'),
     )
 
+
+class ContactHash(Base):
+    __tablename__ = "contact_hashes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    phone_hash = Column(String, nullable=False, index=True)
+    name = Column(String, nullable=True)
+    sync_version = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('owner_id', 'phone_hash', name='uq_contact_hash'),
+    )
+
+
+class UserKeyVersion(Base):
+    __tablename__ = "user_key_versions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    key_version = Column(Integer, nullable=False)
+    public_key = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'key_version', name='uq_user_key_version'),
+    )
+
+
+class PrivacyException(Base):
+    __tablename__ = "privacy_exceptions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    viewer_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    setting = Column(String, default="avatar", nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('owner_id', 'setting', 'viewer_id', name='uq_privacy_exception'),
+    )
+
+
+class BackgroundJob(Base):
+    __tablename__ = "background_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    user_id = Column(Integer, nullable=True, index=True)
+    payload = Column(Text, nullable=True)
+    status = Column(String, default="pending", nullable=False, index=True)
+    progress = Column(Integer, default=0, nullable=False)
+    total = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class ArchivedMessage(Base):
+    __tablename__ = "archived_messages"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    sender_id = Column(Integer, nullable=False)
+    receiver_id = Column(Integer, nullable=False)
+    encrypted_content = Column(Text, nullable=False)
+    message_type = Column(String, default="text", nullable=False)
+    media_url = Column(String, nullable=True)
+    reply_to_message_id = Column(Integer, nullable=True)
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    is_read = Column(Boolean, default=False, nullable=False)
+    edited_at = Column(DateTime(timezone=True), nullable=True)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_archived_messages_conversation', 'sender_id', 'receiver_id', 'id'),
+    )
+
+
+class MessagePartition(Base):
+    __tablename__ = "message_partitions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    month_start = Column(DateTime, nullable=False, index=True)
+    month_end = Column(DateTime, nullable=False)
+    min_message_id = Column(Integer, nullable=True)
+    max_message_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class RetentionPolicy(Base):
+    __tablename__ = "retention_policies"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_low_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_high_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    ttl_days = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('user_low_id', 'user_high_id', name='uq_retention_conversation'),
+    )
+
+
+class UsageRollup(Base):
+    __tablename__ = "usage_rollups"
+
+    id = Column(Integer, primary_key=True, index=True)
+    period = Column(String, nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    metric = Column(String, nullable=False)
+    value = Column(BigInteger, default=0, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('period', 'bucket_start', 'metric', name='uq_usage_rollup'),
+    )
+
+
+class UsageActiveUser(Base):
+    __tablename__ = "usage_active_users"
+
+    period = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+
+
+class MessageChange(Base):
+    __tablename__ = "message_changes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_low_id = Column(Integer, nullable=False)
+    user_high_id = Column(Integer, nullable=False)
+    seq = Column(Integer, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    kind = Column(String, nullable=False)
+    encrypted_content = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+
+    __table_args__ = (
+        UniqueConstraint('user_low_id', 'user_high_id', 'seq', name='uq_message_change_seq'),
+    )
+
+
+class MessageChangeHead(Base):
+    __tablename__ = "message_change_heads"
+
+    user_low_id = Column(Integer, primary_key=True)
+    user_high_id = Column(Integer, primary_key=True)
+    last_seq = Column(Integer, default=0, nullable=False)
+    pruned_seq = Column(Integer, default=0, nullable=False)
+
+
+class Conversation(Base):
+    __tablename__ = "conversations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    title = Column(String, nullable=False)
+    avatar_url = Column(String, nullable=True)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class ConversationMember(Base):
+    __tablename__ = "conversation_members"
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True, index=True)
+    role = Column(String, default="member", nullable=False)
+    last_read_message_id = Column(Integer, default=0, nullable=False)
+    joined_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class ConversationMessage(Base):
+    __tablename__ = "conversation_messages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
+    sender_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    encrypted_content = Column(Text, nullable=False)
+    message_type = Column(String, default="text", nullable=False)
+    media_url = Column(String, nullable=True)
+    reply_to_message_id = Column(Integer, nullable=True)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_conversation_messages_conversation', 'conversation_id', 'id'),
+    )
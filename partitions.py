@@ -0,0 +1,188 @@
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import Index, MetaData, Table, case, delete, event, insert, select, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from event_bus import event_bus
+from models import ArchivedMessage, MessagePartition
+
+logger = logging.getLogger(__name__)
+
+PARTITION_PREFIX = "archived_messages_"
+PARTITIONS_AHEAD = 2
+CATALOG_TTL = 60.0
+
+ARCHIVE_COLUMNS = (
+    "id", "sender_id", "receiver_id", "encrypted_content", "message_type",
+    "media_url", "reply_to_message_id", "timestamp", "is_read", "edited_at",
+)
+
+partition_metadata = MetaData()
+default_archive_table = ArchivedMessage.__table__
+
+_catalog_cache: Tuple[float, list] = (0.0, [])
+_known_partitions = set()
+
+
+def month_start(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(value: datetime) -> datetime:
+    value = month_start(value)
+    if value.month == 12:
+        return value.replace(year=value.year + 1, month=1)
+    return value.replace(month=value.month + 1)
+
+
+def partition_name(value: datetime) -> str:
+    return f"{PARTITION_PREFIX}{month_start(value):%Y%m}"
+
+
+def partition_table(name: str) -> Table:
+    if name in partition_metadata.tables:
+        return partition_metadata.tables[name]
+    columns = [column._copy() for column in default_archive_table.columns]
+    return Table(
+        name,
+        partition_metadata,
+        *columns,
+        Index(f"ix_{name}_conversation", "sender_id", "receiver_id", "id"),
+    )
+
+
+def invalidate_catalog(broadcast: bool = True):
+    global _catalog_cache
+    _catalog_cache = (0.0, [])
+    if broadcast:
+        event_bus.publish_nowait("partitions_changed", {})
+
+
+def _invalidate_catalog_on_commit(db: Session):
+    event.listen(db, "after_commit", lambda session: invalidate_catalog(), once=True)
+
+
+def ensure_partition(db: Session, month: datetime) -> Table:
+    month = month_start(month)
+    name = partition_name(month)
+    table = partition_table(name)
+    if name in _known_partitions:
+        return table
+    table.create(bind=db.connection(), checkfirst=True)
+    if not db.query(MessagePartition.id).filter(MessagePartition.name == name).first():
+        db.add(MessagePartition(name=name, month_start=month, month_end=next_month(month)))
+        db.flush()
+        _invalidate_catalog_on_commit(db)
+        logger.info(f"Created message partition {name}")
+    _known_partitions.add(name)
+    return table
+
+
+def create_partitions_ahead(db: Session, months: int = PARTITIONS_AHEAD, now: Optional[datetime] = None) -> List[str]:
+    month = month_start(now or datetime.now(timezone.utc))
+    names = []
+    for _ in range(months + 1):
+        ensure_partition(db, month)
+        names.append(partition_name(month))
+        month = next_month(month)
+    db.commit()
+    return names
+
+
+def archive_tables(db: Session, cached: bool = True) -> List[Tuple[Table, Optional[int], Optional[int]]]:
+    global _catalog_cache
+    expires, tables = _catalog_cache
+    if cached and time.monotonic() < expires:
+        return tables
+    rows = db.query(
+        MessagePartition.name, MessagePartition.min_message_id, MessagePartition.max_message_id
+    ).order_by(MessagePartition.month_start.desc()).all()
+    tables = [(partition_table(name), min_id, max_id) for name, min_id, max_id in rows if min_id is not None]
+    tables.append((default_archive_table, None, None))
+    _catalog_cache = (time.monotonic() + CATALOG_TTL, tables)
+    return tables
+
+
+def route_rows(db: Session, source_table: Table, rows: Iterable[Tuple[int, datetime]]) -> int:
+    by_month = {}
+    for message_id, timestamp in rows:
+        by_month.setdefault(month_start(timestamp), []).append(message_id)
+
+    moved = 0
+    for month, ids in by_month.items():
+        table = ensure_partition(db, month)
+        source = select(*[source_table.c[name] for name in ARCHIVE_COLUMNS]).where(source_table.c.id.in_(ids))
+        db.execute(insert(table).from_select(list(ARCHIVE_COLUMNS), source))
+        low, high = min(ids), max(ids)
+        db.execute(
+            update(MessagePartition)
+            .where(MessagePartition.name == table.name)
+            .values(
+                min_message_id=case(
+                    (MessagePartition.min_message_id.is_(None), low),
+                    (MessagePartition.min_message_id > low, low),
+                    else_=MessagePartition.min_message_id,
+                ),
+                max_message_id=case(
+                    (MessagePartition.max_message_id.is_(None), high),
+                    (MessagePartition.max_message_id < high, high),
+                    else_=MessagePartition.max_message_id,
+                ),
+            )
+        )
+        moved += len(ids)
+    if by_month:
+        _invalidate_catalog_on_commit(db)
+    return moved
+
+
+def redistribute_default_partition(db: Session, chunk_size: int = 500) -> int:
+    moved = 0
+    while True:
+        rows = db.query(ArchivedMessage.id, ArchivedMessage.timestamp).order_by(
+            ArchivedMessage.id.asc()
+        ).limit(chunk_size).all()
+        if not rows:
+            return moved
+        route_rows(db, default_archive_table, rows)
+        ids = [row[0] for row in rows]
+        db.execute(delete(default_archive_table).where(default_archive_table.c.id.in_(ids)))
+        db.commit()
+        moved += len(ids)
+
+
+def main(argv: List[str]):
+    command = argv[1] if len(argv) > 1 else "list"
+    db = SessionLocal()
+    try:
+        if command == "create-ahead":
+            months = int(argv[2]) if len(argv) > 2 else PARTITIONS_AHEAD
+            for name in create_partitions_ahead(db, months):
+                print(f" Партиция {name} создана или уже существует")
+        elif command == "redistribute":
+            print(f" Перенесено сообщений из {default_archive_table.name}: {redistribute_default_partition(db)}")
+        elif command == "list":
+            for partition in db.query(MessagePartition).order_by(MessagePartition.month_start.asc()):
+                print(f" {partition.name}: id {partition.min_message_id}..{partition.max_message_id}")
+        else:
+            print("Использование: python partitions.py [list | create-ahead [N] | redistribute]")
+    finally:
+        db.close()
+
+
+async def _on_bus_partitions_changed(origin: str, message: dict):
+    invalidate_catalog(broadcast=False)
+
+
+event_bus.on("partitions_changed", _on_bus_partitions_changed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
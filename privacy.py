@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
+
+from sqlalchemy import and_, delete, insert, or_, select
+from sqlalchemy.orm import Session
+
+from event_bus import event_bus
+from models import User, Message, PrivacyException, ConversationMember
+from partitions import archive_tables
+
+logger = logging.getLogger(__name__)
+
+AVATAR_VISIBILITY_MODES = ("all", "contacts", "nobody", "except")
+AVATAR_SETTING = "avatar"
+POLICY_CACHE_SIZE = 10000
+POLICY_CACHE_TTL = 300
+IN_CLAUSE_CHUNK = 500
+
+
+class PrivacyPolicy:
+    __slots__ = ("user_id", "avatar_visibility", "avatar_exceptions", "show_last_seen", "show_online_status")
+
+    def __init__(self, user_id: int, avatar_visibility: str, avatar_exceptions: FrozenSet[int],
+                 show_last_seen: bool, show_online_status: bool):
+        self.user_id = user_id
+        self.avatar_visibility = avatar_visibility if avatar_visibility in AVATAR_VISIBILITY_MODES else "all"
+        self.avatar_exceptions = avatar_exceptions
+        self.show_last_seen = show_last_seen
+        self.show_online_status = show_online_status
+
+    @property
+    def needs_conversation(self) -> bool:
+        return self.avatar_visibility == "contacts"
+
+    def avatar_visible(self, viewer_id: int, in_conversation: bool = False) -> bool:
+        if viewer_id == self.user_id or self.avatar_visibility == "all":
+            return True
+        if self.avatar_visibility == "contacts":
+            return in_conversation
+        if self.avatar_visibility == "except":
+            return viewer_id not in self.avatar_exceptions
+        return False
+
+
+class Visibility:
+    __slots__ = ("avatar", "last_seen", "online")
+
+    def __init__(self, avatar: bool, last_seen: bool, online: bool):
+        self.avatar = avatar
+        self.last_seen = last_seen
+        self.online = online
+
+
+FULL_VISIBILITY = Visibility(True, True, True)
+
+_policy_cache: "OrderedDict[int, Tuple[PrivacyPolicy, float]]" = OrderedDict()
+_policy_lock = threading.Lock()
+
+
+def _chunks(values: List[int], size: int = IN_CLAUSE_CHUNK) -> Iterable[List[int]]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _remember_policy(policy: PrivacyPolicy, now: float):
+    with _policy_lock:
+        _policy_cache[policy.user_id] = (policy, now + POLICY_CACHE_TTL)
+        _policy_cache.move_to_end(policy.user_id)
+        while len(_policy_cache) > POLICY_CACHE_SIZE:
+            _policy_cache.popitem(last=False)
+
+
+def invalidate_policies(user_ids: Iterable[int], broadcast: bool = True):
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    with _policy_lock:
+        for user_id in user_ids:
+            _policy_cache.pop(user_id, None)
+    if broadcast and user_ids:
+        event_bus.publish_nowait("privacy_changed", {"user_ids": user_ids})
+
+
+def load_policies(db: Session, user_ids: Iterable[int]) -> Dict[int, PrivacyPolicy]:
+    now = time.monotonic()
+    policies: Dict[int, PrivacyPolicy] = {}
+    missing = []
+    for user_id in set(user_ids):
+        cached = _policy_cache.get(user_id)
+        if cached is not None and cached[1] > now:
+            policies[user_id] = cached[0]
+        else:
+            missing.append(user_id)
+
+    if not missing:
+        return policies
+
+    rows = []
+    for chunk in _chunks(missing):
+        rows.extend(db.query(
+            User.id, User.avatar_visibility, User.show_last_seen, User.show_online_status
+        ).filter(User.id.in_(chunk)).all())
+
+    exceptions: Dict[int, Set[int]] = {}
+    except_owners = [row[0] for row in rows if row[1] == "except"]
+    for chunk in _chunks(except_owners):
+        for owner_id, viewer_id in db.query(PrivacyException.owner_id, PrivacyException.viewer_id).filter(
+            PrivacyException.owner_id.in_(chunk),
+            PrivacyException.setting == AVATAR_SETTING
+        ):
+            exceptions.setdefault(owner_id, set()).add(viewer_id)
+
+    for user_id, avatar_visibility, show_last_seen, show_online_status in rows:
+        policy = PrivacyPolicy(
+            user_id,
+            avatar_visibility or "all",
+            frozenset(exceptions.get(user_id, ())),
+            show_last_seen if show_last_seen is not None else True,
+            show_online_status if show_online_status is not None else True,
+        )
+        _remember_policy(policy, now)
+        policies[user_id] = policy
+    return policies
+
+
+def conversation_pairs(db: Session, viewer_ids: Iterable[int], target_ids: Iterable[int]) -> Set[Tuple[int, int]]:
+    viewer_ids = list(set(viewer_ids))
+    target_ids = list(set(target_ids))
+    pairs: Set[Tuple[int, int]] = set()
+    if not viewer_ids or not target_ids:
+        return pairs
+    tables = [Message.__table__] + [table for table, _, _ in archive_tables(db)]
+    viewer_member = ConversationMember.__table__.alias("viewer_member")
+    target_member = ConversationMember.__table__.alias("target_member")
+    for viewers in _chunks(viewer_ids):
+        for targets in _chunks(target_ids):
+            for table in tables:
+                statement = select(table.c.sender_id, table.c.receiver_id).where(or_(
+                    and_(table.c.sender_id.in_(viewers), table.c.receiver_id.in_(targets)),
+                    and_(table.c.sender_id.in_(targets), table.c.receiver_id.in_(viewers)),
+                )).distinct()
+                for sender_id, receiver_id in db.execute(statement):
+                    pairs.add((sender_id, receiver_id))
+                    pairs.add((receiver_id, sender_id))
+            statement = select(viewer_member.c.user_id, target_member.c.user_id).join(
+                target_member, target_member.c.conversation_id == viewer_member.c.conversation_id
+            ).where(viewer_member.c.user_id.in_(viewers), target_member.c.user_id.in_(targets)).distinct()
+            for viewer_id, target_id in db.execute(statement):
+                pairs.add((viewer_id, target_id))
+                pairs.add((target_id, viewer_id))
+    return pairs
+
+
+def evaluate(db: Session, viewer_ids: Iterable[int], target_ids: Iterable[int]) -> Dict[Tuple[int, int], Visibility]:
+    viewer_ids = list(set(viewer_ids))
+    policies = load_policies(db, target_ids)
+    conversation_targets = [user_id for user_id, policy in policies.items() if policy.needs_conversation]
+    conversations = conversation_pairs(db, viewer_ids, conversation_targets)
+
+    result: Dict[Tuple[int, int], Visibility] = {}
+    for target_id, policy in policies.items():
+        for viewer_id in viewer_ids:
+            if viewer_id == target_id:
+                result[(viewer_id, target_id)] = FULL_VISIBILITY
+                continue
+            result[(viewer_id, target_id)] = Visibility(
+                policy.avatar_visible(viewer_id, (viewer_id, target_id) in conversations),
+                policy.show_last_seen,
+                policy.show_online_status,
+            )
+    return result
+
+
+def visible_to(db: Session, viewer_id: int, target_ids: Iterable[int]) -> Dict[int, Visibility]:
+    return {target_id: visibility for (_, target_id), visibility in evaluate(db, [viewer_id], target_ids).items()}
+
+
+def viewers_of(db: Session, target_id: int, viewer_ids: Iterable[int]) -> Dict[int, Visibility]:
+    return {viewer_id: visibility for (viewer_id, _), visibility in evaluate(db, viewer_ids, [target_id]).items()}
+
+
+def avatar_exceptions(db: Session, owner_id: int) -> List[int]:
+    return sorted(
+        viewer_id for (viewer_id,) in db.query(PrivacyException.viewer_id).filter(
+            PrivacyException.owner_id == owner_id,
+            PrivacyException.setting == AVATAR_SETTING
+        )
+    )
+
+
+def set_avatar_exceptions(db: Session, owner_id: int, viewer_ids: Iterable[int]):
+    viewer_ids = sorted({int(viewer_id) for viewer_id in viewer_ids if int(viewer_id) != owner_id})
+    db.execute(delete(PrivacyException).where(
+        PrivacyException.owner_id == owner_id,
+        PrivacyException.setting == AVATAR_SETTING
+    ))
+    existing = []
+    for chunk in _chunks(viewer_ids):
+        existing.extend(user_id for (user_id,) in db.query(User.id).filter(User.id.in_(chunk)))
+    if existing:
+        db.execute(insert(PrivacyException), [
+            {"owner_id": owner_id, "viewer_id": viewer_id, "setting": AVATAR_SETTING} for viewer_id in existing
+        ])
+
+
+async def _on_bus_privacy_changed(origin: str, message: dict):
+    invalidate_policies(message.get("user_ids") or [], broadcast=False)
+
+
+event_bus.on("privacy_changed", _on_bus_privacy_changed)
@@ -0,0 +1,79 @@
+from typing import Callable, Iterable, List
+
+from sqlalchemy.orm import Session
+
+from models import User, Contact
+from keys import current_keys
+from privacy import visible_to
+from serialization import isoformat_utc
+
+BATCH_LOOKUP_MAX = 500
+IN_CLAUSE_CHUNK = 500
+
+CARD_COLUMNS = (
+    User.id, User.username, User.first_name, User.last_name, User.public_key, User.key_version,
+    User.avatar_url, User.avatar_frame, User.bio, User.birthdate, User.last_seen,
+)
+
+
+def parse_user_ids(raw) -> List[int]:
+    if isinstance(raw, str):
+        raw = [part for part in raw.split(",") if part.strip()]
+    if not isinstance(raw, (list, tuple)):
+        raise ValueError("user_ids must be a list")
+    try:
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in raw))
+    except (ValueError, TypeError):
+        raise ValueError("user_ids must be integers")
+    if len(user_ids) > BATCH_LOOKUP_MAX:
+        raise ValueError(f"At most {BATCH_LOOKUP_MAX} user ids per request")
+    return user_ids
+
+
+def _chunks(values: List[int], size: int = IN_CLAUSE_CHUNK) -> Iterable[List[int]]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def public_keys(db: Session, user_ids: List[int]) -> List[dict]:
+    found = current_keys(db, user_ids)
+    return [
+        {"user_id": user_id, "public_key": found[user_id][1], "key_version": found[user_id][0]}
+        for user_id in user_ids if user_id in found
+    ]
+
+
+def user_cards(db: Session, viewer_id: int, user_ids: List[int], is_online: Callable[[int], bool]) -> List[dict]:
+    rows = {}
+    local_names = {}
+    for chunk in _chunks(user_ids):
+        rows.update((row[0], row) for row in db.query(*CARD_COLUMNS).filter(User.id.in_(chunk)))
+        local_names.update(db.query(Contact.contact_id, Contact.local_name).filter(
+            Contact.owner_id == viewer_id,
+            Contact.contact_id.in_(chunk)
+        ).all())
+    visibility = visible_to(db, viewer_id, list(rows))
+
+    cards = []
+    for user_id in user_ids:
+        row = rows.get(user_id)
+        if row is None:
+            continue
+        visible = visibility[user_id]
+        _, username, first_name, last_name, public_key, key_version, avatar_url, avatar_frame, bio, birthdate, last_seen = row
+        cards.append({
+            "id": user_id,
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "local_name": local_names.get(user_id),
+            "public_key": public_key,
+            "key_version": key_version,
+            "avatar_url": avatar_url if visible.avatar else None,
+            "avatar_frame": avatar_frame,
+            "bio": bio,
+            "birthdate": birthdate,
+            "last_seen": isoformat_utc(last_seen) if last_seen and visible.last_seen else None,
+            "is_online": is_online(user_id) if visible.online else None,
+        })
+    return cards
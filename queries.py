@@ -0,0 +1,163 @@
+import heapq
+import itertools
+from typing import Iterator, List, Optional, Sequence
+
+from sqlalchemy import and_, case, func, literal, or_, select, union_all
+from sqlalchemy.orm import Session
+
+from models import User, Message
+from partitions import archive_tables
+
+YIELD_PER = 1000
+
+USER_LIST_FIELDS = ("id", "username", "public_key", "avatar_url", "avatar_frame", "phone")
+USER_LIST_COLUMNS = (User.id, User.username, User.public_key, User.avatar_url, User.avatar_frame, User.phone)
+
+MESSAGE_HISTORY_FIELDS = (
+    "id", "sender_id", "receiver_id", "encrypted_content", "message_type",
+    "media_url", "reply_to_message_id", "timestamp", "is_read", "edited_at",
+)
+MESSAGE_HISTORY_COLUMNS = (
+    Message.id, Message.sender_id, Message.receiver_id, Message.encrypted_content, Message.message_type,
+    Message.media_url, Message.reply_to_message_id, Message.timestamp, Message.is_read, Message.edited_at,
+)
+
+CHAT_MEDIA_FIELDS = ("id", "media_url", "timestamp", "sender_id")
+CHAT_MEDIA_COLUMNS = (Message.id, Message.media_url, Message.timestamp, Message.sender_id)
+
+LAST_MESSAGE_FIELDS = ("encrypted_content", "timestamp", "sender_id", "message_type")
+
+
+def conversation_filter(user_id: int, peer_id: int, model=Message):
+    if hasattr(model, "c"):
+        model = model.c
+    return or_(
+        and_(model.sender_id == user_id, model.receiver_id == peer_id),
+        and_(model.sender_id == peer_id, model.receiver_id == user_id)
+    )
+
+
+def stream_rows(query, batch_size: int = YIELD_PER) -> Iterator[Sequence]:
+    return iter(query.yield_per(batch_size))
+
+
+def stream_select(db: Session, statement, batch_size: int = YIELD_PER) -> Iterator[Sequence]:
+    return iter(db.execute(statement.execution_options(yield_per=batch_size)))
+
+
+def archive_select(table, fields: Sequence[str]):
+    return select(*[table.c[name] for name in fields])
+
+
+def user_list_rows(db: Session, exclude_user_id: int, limit: int, offset: int = 0, after_id: Optional[int] = None) -> Iterator[Sequence]:
+    query = db.query(*USER_LIST_COLUMNS).filter(User.id != exclude_user_id)
+    if after_id is not None:
+        query = query.filter(User.id > after_id)
+    query = query.order_by(User.id.asc()).limit(limit)
+    if offset and after_id is None:
+        query = query.offset(offset)
+    return stream_rows(query)
+
+
+def chat_history_rows(db: Session, user_id: int, peer_id: int) -> Iterator[Sequence]:
+    archived = [
+        stream_select(db, archive_select(table, MESSAGE_HISTORY_FIELDS).where(
+            conversation_filter(user_id, peer_id, table)
+        ).order_by(table.c.id.asc()))
+        for table, _, _ in archive_tables(db)
+    ]
+    hot = db.query(*MESSAGE_HISTORY_COLUMNS).filter(
+        conversation_filter(user_id, peer_id),
+        Message.deleted_at.is_(None)
+    ).order_by(Message.timestamp.asc())
+    return itertools.chain(heapq.merge(*archived, key=lambda row: row[0]), stream_rows(hot))
+
+
+def archived_history_page(db: Session, user_id: int, peer_id: int, limit: int, before_id: Optional[int] = None) -> List[Sequence]:
+    rows: List[Sequence] = []
+    for table, min_id, max_id in archive_tables(db):
+        if before_id is not None and min_id is not None and min_id >= before_id:
+            continue
+        if len(rows) >= limit and max_id is not None and max_id < rows[-1][0]:
+            continue
+        statement = archive_select(table, MESSAGE_HISTORY_FIELDS).where(conversation_filter(user_id, peer_id, table))
+        if before_id is not None:
+            statement = statement.where(table.c.id < before_id)
+        rows.extend(db.execute(statement.order_by(table.c.id.desc()).limit(limit)).all())
+        rows.sort(key=lambda row: row[0], reverse=True)
+        del rows[limit:]
+    return rows
+
+
+def chat_history_page(db: Session, user_id: int, peer_id: int, limit: int, before_id: Optional[int] = None) -> List[Sequence]:
+    query = db.query(*MESSAGE_HISTORY_COLUMNS).filter(conversation_filter(user_id, peer_id), Message.deleted_at.is_(None))
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    rows = query.order_by(Message.id.desc()).limit(limit).all()
+    
+    if len(rows) < limit:
+        bound = rows[-1][0] if rows else before_id
+        rows.extend(archived_history_page(db, user_id, peer_id, limit - len(rows), bound))
+    
+    rows.reverse()
+    return rows
+
+
+def chat_media_rows(db: Session, user_id: int, peer_id: int) -> Iterator[Sequence]:
+    hot = db.query(*CHAT_MEDIA_COLUMNS).filter(
+        Message.message_type == "image",
+        conversation_filter(user_id, peer_id),
+        Message.deleted_at.is_(None)
+    ).order_by(Message.timestamp.desc())
+    archived = [
+        stream_select(db, archive_select(table, CHAT_MEDIA_FIELDS).where(
+            table.c.message_type == "image",
+            conversation_filter(user_id, peer_id, table)
+        ).order_by(table.c.id.desc()))
+        for table, _, _ in archive_tables(db)
+    ]
+    return itertools.chain(stream_rows(hot), heapq.merge(*archived, key=lambda row: row[0], reverse=True))
+
+
+def _last_message_select(table, user_id: int, live):
+    peer_id = case((table.c.sender_id == user_id, table.c.receiver_id), else_=table.c.sender_id)
+    return select(
+        peer_id.label("peer_id"), table.c.id, live.label("live"), *[table.c[name] for name in LAST_MESSAGE_FIELDS]
+    ).where(
+        or_(table.c.sender_id == user_id, table.c.receiver_id == user_id),
+        table.c.sender_id != table.c.receiver_id
+    )
+
+
+def last_message_rows(db: Session, user_id: int) -> List[Sequence]:
+    hot = Message.__table__
+    selects = [_last_message_select(hot, user_id, case((hot.c.deleted_at.is_(None), 1), else_=0))]
+    for table, _, _ in archive_tables(db):
+        selects.append(_last_message_select(table, user_id, literal(1)))
+    messages = union_all(*selects).subquery("messages")
+    rank = func.row_number().over(
+        partition_by=messages.c.peer_id,
+        order_by=(messages.c.live.desc(), messages.c.timestamp.desc(), messages.c.id.desc())
+    ).label("rank")
+    ranked = select(messages, rank).subquery("ranked")
+    statement = select(
+        ranked.c.peer_id, ranked.c.live, *[ranked.c[name] for name in LAST_MESSAGE_FIELDS]
+    ).where(ranked.c.rank == 1)
+    return db.execute(statement).all()
+
+
+def message_rows_by_id(db: Session, condition_for, after_id: int = 0, batch_size: int = YIELD_PER) -> Iterator[Sequence]:
+    hot = db.query(*MESSAGE_HISTORY_COLUMNS).filter(condition_for(Message.__table__), Message.deleted_at.is_(None))
+    if after_id:
+        hot = hot.filter(Message.id > after_id)
+    streams = [stream_rows(hot.order_by(Message.id.asc()), batch_size)]
+    
+    for table, _, max_id in archive_tables(db):
+        if after_id and max_id is not None and max_id <= after_id:
+            continue
+        statement = archive_select(table, MESSAGE_HISTORY_FIELDS).where(condition_for(table))
+        if after_id:
+            statement = statement.where(table.c.id > after_id)
+        streams.append(stream_select(db, statement.order_by(table.c.id.asc()), batch_size))
+    
+    return heapq.merge(*streams, key=lambda row: row[0])
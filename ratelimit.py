@@ -0,0 +1,204 @@
+import functools
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request, status
+
+from auth import get_current_user
+from models import User
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMITS_ENABLED = os.environ.get("RATE_LIMITS_ENABLED", "1") == "1"
+MEMORY_BUCKETS_MAX = 100000
+MEMORY_BUCKET_IDLE = 3600
+
+
+class RateLimit:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+
+
+RATE_LIMITS: Dict[str, RateLimit] = {
+    "login": RateLimit(rate=5 / 60, burst=10),
+    "register": RateLimit(rate=3 / 60, burst=5),
+    "search": RateLimit(rate=2, burst=10),
+    "upload": RateLimit(rate=1, burst=5),
+    "send_message": RateLimit(rate=10, burst=30),
+    "contact_sync": RateLimit(rate=1 / 60, burst=5),
+}
+
+CONCURRENCY_LIMITS: Dict[str, int] = {
+    "db_writes": int(os.environ.get("MAX_CONCURRENT_DB_WRITES", "4")),
+    "search": int(os.environ.get("MAX_CONCURRENT_SEARCHES", "8")),
+}
+
+
+class MemoryBackend:
+    def __init__(self):
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        self.lock = threading.Lock()
+
+    def consume(self, key: str, limit: RateLimit) -> float:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / limit.rate
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > MEMORY_BUCKETS_MAX:
+                self._prune(now)
+        return 0.0
+
+    def _prune(self, now: float):
+        for key, (_, updated) in list(self.buckets.items()):
+            if now - updated > MEMORY_BUCKET_IDLE:
+                del self.buckets[key]
+        if len(self.buckets) > MEMORY_BUCKETS_MAX:
+            for key in list(self.buckets)[: len(self.buckets) // 2]:
+                del self.buckets[key]
+
+
+class SQLiteBackend:
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self.lock = threading.Lock()
+
+    def consume(self, key: str, limit: RateLimit) -> float:
+        params = {"key": key, "burst": limit.burst, "rate": limit.rate, "now": time.time()}
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO rate_buckets (key, tokens, updated) VALUES (:key, :burst - 1, :now) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "tokens = MIN(:burst, tokens + (:now - updated) * :rate) - 1, updated = :now "
+                "WHERE MIN(:burst, tokens + (:now - updated) * :rate) >= 1",
+                params,
+            )
+        return 0.0 if cursor.rowcount else 1 / limit.rate
+
+
+def create_backend(url: str = RATE_LIMIT_BACKEND):
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    return MemoryBackend()
+
+
+backend = create_backend()
+
+
+def check_rate(name: str, key: str) -> float:
+    if not RATE_LIMITS_ENABLED:
+        return 0.0
+    limit = RATE_LIMITS[name]
+    try:
+        return backend.consume(f"{name}:{key}", limit)
+    except sqlite3.Error as e:
+        logger.warning(f"Rate limit backend failed, allowing request: {e}")
+        return 0.0
+
+
+class ConcurrencyLimiter:
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+
+concurrency_limiters = {name: ConcurrencyLimiter(name, limit) for name, limit in CONCURRENCY_LIMITS.items()}
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def _too_many_requests(retry_after: float, detail: str = "Too many requests") -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def rate_limit_ip(name: str):
+    async def dependency(request: Request):
+        retry_after = check_rate(name, client_ip(request))
+        if retry_after:
+            logger.warning(f"Rate limit {name} exceeded for IP {client_ip(request)}")
+            raise _too_many_requests(retry_after)
+    return dependency
+
+
+def rate_limit_user(name: str):
+    async def dependency(current_user: User = Depends(get_current_user)):
+        retry_after = check_rate(name, str(current_user.id))
+        if retry_after:
+            logger.warning(f"Rate limit {name} exceeded for user {current_user.id}")
+            raise _too_many_requests(retry_after)
+    return dependency
+
+
+def concurrency_limit(name: str):
+    limiter = concurrency_limiters[name]
+
+    async def dependency():
+        if not limiter.try_acquire():
+            logger.warning(f"Concurrency limit {name} reached ({limiter.limit}), shedding request")
+            raise _too_many_requests(1, detail="Server is busy, try again later")
+        try:
+            yield
+        finally:
+            limiter.release()
+    return dependency
+
+
+def socket_rate_limit(name: str, concurrency: Optional[str] = None):
+    limiter = concurrency_limiters[concurrency] if concurrency else None
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, sid, *args):
+            session = await self.get_session(sid)
+            key = str(session["user_id"]) if session and "user_id" in session else sid
+            retry_after = check_rate(name, key)
+            if retry_after:
+                logger.warning(f"Rate limit {name} exceeded for socket {sid} ({key})")
+                await self.emit("error", {"message": "Rate limit exceeded", "event": name, "retry_after": retry_after}, room=sid)
+                return
+            if limiter is None:
+                return await handler(self, sid, *args)
+            if not limiter.try_acquire():
+                logger.warning(f"Concurrency limit {concurrency} reached, shedding {name} from socket {sid}")
+                await self.emit("error", {"message": "Server is busy, try again later", "event": name, "retry_after": 1}, room=sid)
+                return
+            try:
+                return await handler(self, sid, *args)
+            finally:
+                limiter.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,154 @@
+import itertools
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import and_, exists, insert, literal, or_, select, union_all
+from sqlalchemy.orm import Session
+
+from models import Message
+from partitions import archive_tables
+from queries import MESSAGE_HISTORY_COLUMNS, MESSAGE_HISTORY_FIELDS, archive_select, conversation_filter
+
+IN_CLAUSE_CHUNK = 500
+THREAD_DEPTH_DEFAULT = 10
+THREAD_DEPTH_MAX = 50
+THREAD_MESSAGES_MAX = 500
+
+REPLY_PREVIEW_FIELDS = ("id", "sender_id", "message_type", "encrypted_content", "media_url")
+HISTORY_WITH_REPLY_FIELDS = MESSAGE_HISTORY_FIELDS + ("reply_to",)
+THREAD_FIELDS = MESSAGE_HISTORY_FIELDS + ("depth",)
+
+_REPLY_ID_POS = MESSAGE_HISTORY_FIELDS.index("reply_to_message_id")
+
+
+def _reply_target_exists(db: Session, reply_to_message_id: int, sender_id: int, receiver_id: int):
+    conditions = [exists().where(
+        Message.id == reply_to_message_id,
+        conversation_filter(sender_id, receiver_id)
+    )]
+    for table, min_id, max_id in archive_tables(db):
+        if min_id is not None and not min_id <= reply_to_message_id <= max_id:
+            continue
+        conditions.append(exists().where(
+            table.c.id == reply_to_message_id,
+            conversation_filter(sender_id, receiver_id, table)
+        ))
+    return or_(*conditions)
+
+
+def insert_message(
+    db: Session,
+    sender_id: int,
+    receiver_id: int,
+    encrypted_content: str,
+    message_type: str,
+    media_url: Optional[str],
+    reply_to_message_id: Optional[int],
+    timestamp: datetime,
+) -> Optional[Sequence]:
+    values = {
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "encrypted_content": encrypted_content,
+        "message_type": message_type,
+        "media_url": media_url,
+        "reply_to_message_id": reply_to_message_id,
+        "timestamp": timestamp,
+        "is_read": False,
+    }
+    source = select(*[literal(value, Message.__table__.c[name].type) for name, value in values.items()])
+    if reply_to_message_id is not None:
+        source = source.where(_reply_target_exists(db, reply_to_message_id, sender_id, receiver_id))
+    statement = insert(Message).from_select(list(values), source).returning(Message.id, Message.timestamp)
+    return db.execute(statement).first()
+
+
+def _lookup_previews(db: Session, ids: List[int], user_id: int, peer_id: int) -> Dict[int, dict]:
+    previews: Dict[int, dict] = {}
+    columns = [Message.__table__.c[name] for name in REPLY_PREVIEW_FIELDS]
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        statement = select(*columns).where(
+            Message.id.in_(chunk),
+            conversation_filter(user_id, peer_id),
+            Message.deleted_at.is_(None)
+        )
+        for row in db.execute(statement):
+            previews[row[0]] = dict(zip(REPLY_PREVIEW_FIELDS, row))
+
+    missing = [message_id for message_id in ids if message_id not in previews]
+    if missing:
+        low, high = min(missing), max(missing)
+        for table, min_id, max_id in archive_tables(db):
+            if min_id is not None and (max_id < low or min_id > high):
+                continue
+            for start in range(0, len(missing), IN_CLAUSE_CHUNK):
+                chunk = missing[start:start + IN_CLAUSE_CHUNK]
+                statement = archive_select(table, REPLY_PREVIEW_FIELDS).where(
+                    table.c.id.in_(chunk),
+                    conversation_filter(user_id, peer_id, table)
+                )
+                for row in db.execute(statement):
+                    previews[row[0]] = dict(zip(REPLY_PREVIEW_FIELDS, row))
+    return previews
+
+
+def with_reply_previews(db: Session, rows: Iterable[Sequence], user_id: int, peer_id: int) -> Iterator[tuple]:
+    rows = iter(rows)
+    while True:
+        page = list(itertools.islice(rows, IN_CLAUSE_CHUNK))
+        if not page:
+            return
+        ids = sorted({row[_REPLY_ID_POS] for row in page if row[_REPLY_ID_POS] is not None})
+        previews = _lookup_previews(db, ids, user_id, peer_id) if ids else {}
+        for row in page:
+            yield tuple(row) + (previews.get(row[_REPLY_ID_POS]),)
+
+
+def message_parties(db: Session, message_id: int) -> Optional[Sequence]:
+    row = db.query(Message.sender_id, Message.receiver_id).filter(Message.id == message_id).first()
+    if row is not None:
+        return row
+    for table, min_id, max_id in archive_tables(db):
+        if min_id is not None and not min_id <= message_id <= max_id:
+            continue
+        row = db.execute(select(table.c.sender_id, table.c.receiver_id).where(table.c.id == message_id)).first()
+        if row is not None:
+            return row
+    return None
+
+
+def _conversation_messages(db: Session, user_id: int, peer_id: int):
+    parts = [select(*MESSAGE_HISTORY_COLUMNS).where(conversation_filter(user_id, peer_id), Message.deleted_at.is_(None))]
+    for table, _, _ in archive_tables(db):
+        parts.append(archive_select(table, MESSAGE_HISTORY_FIELDS).where(conversation_filter(user_id, peer_id, table)))
+    return union_all(*parts).subquery("conversation")
+
+
+def _thread_cte(messages, message_id: int, depth: int, direction: str):
+    base = select(messages.c.id, messages.c.reply_to_message_id, literal(0).label("depth")).where(
+        messages.c.id == message_id
+    ).cte("thread", recursive=True)
+    if direction == "up":
+        link = messages.c.id == base.c.reply_to_message_id
+    else:
+        link = messages.c.reply_to_message_id == base.c.id
+    step = select(messages.c.id, messages.c.reply_to_message_id, base.c.depth + 1).join(base, link).where(
+        base.c.depth < depth
+    )
+    return base.union_all(step)
+
+
+def thread_rows(db: Session, message_id: int, user_id: int, peer_id: int, depth: int = THREAD_DEPTH_DEFAULT) -> dict:
+    depth = max(1, min(depth, THREAD_DEPTH_MAX))
+    messages = _conversation_messages(db, user_id, peer_id)
+    columns = [messages.c[name] for name in MESSAGE_HISTORY_FIELDS]
+    result = {}
+    for direction, key, order in (("up", "ancestors", "desc"), ("down", "replies", "asc")):
+        thread = _thread_cte(messages, message_id, depth, direction)
+        statement = select(*columns, thread.c.depth).join(thread, and_(
+            messages.c.id == thread.c.id,
+            thread.c.depth > 0
+        )).order_by(getattr(thread.c.depth, order)(), messages.c.id.asc()).limit(THREAD_MESSAGES_MAX)
+        result[key] = db.execute(statement).all()
+    return result
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from sqlalchemy import and_, case, exists, func, select, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import Message, MessageChange, MessageChangeHead, RetentionPolicy, BackgroundJob
+from jobs import JOB_CHUNK_SIZE, JobContext, enqueue_job, job_handler
+from partitions import create_partitions_ahead, month_start, route_rows
+from queries import conversation_filter
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_RETENTION_DAYS = int(os.environ.get("MESSAGE_RETENTION_DAYS", "0"))
+MONTHLY_ROLLOVER = os.environ.get("MONTHLY_ROLLOVER", "1") == "1"
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_MIN_TTL_DAYS = 1
+TOMBSTONE_PURGE_HOURS = int(os.environ.get("TOMBSTONE_PURGE_HOURS", "24"))
+CHANGE_LOG_RETENTION_DAYS = int(os.environ.get("CHANGE_LOG_RETENTION_DAYS", "30"))
+SCHEDULED_JOBS = ("archive_messages", "rollover_messages", "compact_tombstones")
+
+
+def conversation_pair(user_id: int, peer_id: int) -> Tuple[int, int]:
+    return (user_id, peer_id) if user_id < peer_id else (peer_id, user_id)
+
+
+def get_retention_policy(db: Session, user_id: int, peer_id: int) -> Optional[RetentionPolicy]:
+    low, high = conversation_pair(user_id, peer_id)
+    return db.query(RetentionPolicy).filter(
+        RetentionPolicy.user_low_id == low,
+        RetentionPolicy.user_high_id == high
+    ).first()
+
+
+def set_retention_policy(db: Session, user_id: int, peer_id: int, ttl_days: Optional[int]) -> Optional[RetentionPolicy]:
+    policy = get_retention_policy(db, user_id, peer_id)
+    if ttl_days is None:
+        if policy:
+            db.delete(policy)
+            db.commit()
+        return None
+    if policy is None:
+        low, high = conversation_pair(user_id, peer_id)
+        policy = RetentionPolicy(user_low_id=low, user_high_id=high, ttl_days=ttl_days)
+        db.add(policy)
+    else:
+        policy.ttl_days = ttl_days
+    db.commit()
+    db.refresh(policy)
+    return policy
+
+
+def archive_chunk(db: Session, condition) -> int:
+    rows = db.query(Message.id, Message.timestamp).filter(condition, Message.deleted_at.is_(None)).order_by(Message.id.asc()).limit(JOB_CHUNK_SIZE).all()
+    if not rows:
+        return 0
+    route_rows(db, Message.__table__, rows)
+    ids = [row[0] for row in rows]
+    db.query(Message).filter(Message.id.in_(ids)).delete(synchronize_session=False)
+    return len(ids)
+
+
+def _archive_until_done(ctx: JobContext, condition) -> int:
+    archived = 0
+    while True:
+        count = archive_chunk(ctx.db, condition)
+        if not count:
+            return archived
+        ctx.advance(count)
+        ctx.db.commit()
+        archived += count
+
+
+@job_handler("archive_messages")
+def _archive_messages(ctx: JobContext):
+    now = datetime.now(timezone.utc)
+    create_partitions_ahead(ctx.db, now=now)
+    policies = ctx.db.query(
+        RetentionPolicy.user_low_id, RetentionPolicy.user_high_id, RetentionPolicy.ttl_days
+    ).all()
+
+    archived = 0
+    for low, high, ttl_days in policies:
+        cutoff = now - timedelta(days=ttl_days)
+        archived += _archive_until_done(ctx, and_(conversation_filter(low, high), Message.timestamp < cutoff))
+
+    if MESSAGE_RETENTION_DAYS > 0:
+        cutoff = now - timedelta(days=MESSAGE_RETENTION_DAYS)
+        low = case((Message.sender_id < Message.receiver_id, Message.sender_id), else_=Message.receiver_id)
+        high = case((Message.sender_id < Message.receiver_id, Message.receiver_id), else_=Message.sender_id)
+        has_policy = exists().where(RetentionPolicy.user_low_id == low, RetentionPolicy.user_high_id == high)
+        archived += _archive_until_done(ctx, and_(Message.timestamp < cutoff, ~has_policy))
+
+    logger.info(f"Retention: archived {archived} message(s)")
+
+
+@job_handler("rollover_messages")
+def _rollover_messages(ctx: JobContext):
+    if not MONTHLY_ROLLOVER:
+        return
+    now = datetime.now(timezone.utc)
+    create_partitions_ahead(ctx.db, now=now)
+    closed = and_(Message.timestamp < month_start(now), Message.is_read == True)
+    archived = _archive_until_done(ctx, closed)
+    logger.info(f"Rollover: moved {archived} message(s) from closed months to partitions")
+
+
+@job_handler("compact_tombstones")
+def _compact_tombstones(ctx: JobContext):
+    now = datetime.now(timezone.utc)
+    tombstones = and_(Message.deleted_at.isnot(None), Message.deleted_at < now - timedelta(hours=TOMBSTONE_PURGE_HOURS))
+    old_changes = MessageChange.created_at < now - timedelta(days=CHANGE_LOG_RETENTION_DAYS)
+    ctx.set_total(
+        ctx.db.query(Message.id).filter(tombstones).count()
+        + ctx.db.query(MessageChange.id).filter(old_changes).count()
+    )
+    purged = ctx.delete_in_chunks(Message, tombstones, media_column="media_url")
+    newest_old = select(func.max(MessageChange.seq)).where(
+        MessageChange.user_low_id == MessageChangeHead.user_low_id,
+        MessageChange.user_high_id == MessageChangeHead.user_high_id,
+        old_changes
+    ).scalar_subquery()
+    ctx.db.execute(update(MessageChangeHead).where(newest_old > MessageChangeHead.pruned_seq).values(pruned_seq=newest_old))
+    ctx.db.commit()
+    pruned = ctx.delete_in_chunks(MessageChange, old_changes)
+    logger.info(f"Compaction: purged {purged} deleted message(s), pruned {pruned} change log entr(ies)")
+
+
+class RetentionScheduler:
+    def __init__(self, interval: int = RETENTION_INTERVAL):
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def run_once(self):
+        db = SessionLocal()
+        try:
+            for kind in SCHEDULED_JOBS:
+                active = db.query(BackgroundJob.id).filter(
+                    BackgroundJob.kind == kind,
+                    BackgroundJob.status.in_(["pending", "running"])
+                ).first()
+                if active is None:
+                    enqueue_job(db, kind, {})
+        finally:
+            db.close()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Failed to schedule retention jobs: {e}")
+
+
+retention_scheduler = RetentionScheduler()
@@ -1,14 +1,42 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Request
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Request, Query
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_, func, String
+from sqlalchemy import and_, func, String
 from typing import List, Optional
 from datetime import datetime, timezone
 from models import User, Message, UserTheme, Contact
 from database import get_db
-from auth import authenticate_user, create_access_token, get_current_user, get_password_hash
-from schemas import UserCreate, UserLogin, UserResponse, Token, KeyExchangeRequest, KeyExchangeResponse, UserThemeCreate, UserThemeResponse
-from socketio_handler import user_socket_map
+from auth import authenticate_user, create_access_token, get_current_user, get_db_read, get_password_hash, username_taken, remember_username, forget_username
+from schemas import UserCreate, UserLogin, UserResponse, Token, KeyExchangeRequest, KeyExchangeResponse, PublicKeyUpdate, MessageEdit, GroupCreate, GroupMembersAdd, GroupReadUpdate, UserThemeCreate, UserThemeResponse, ContactSyncRequest, ThemeSyncRequest
+from socketio_handler import disconnect_user, is_user_online, notify_key_changed, notify_message_changed, notify_group_members_changed, emit_to_group
+from serialization import FastJSONResponse, rows_response, encode_batch, etag_matches, loads
+from queries import (
+    USER_LIST_FIELDS, CHAT_MEDIA_FIELDS,
+    user_list_rows, chat_history_rows, chat_history_page, chat_media_rows, last_message_rows,
+)
+from retention import MESSAGE_RETENTION_DAYS, RETENTION_MIN_TTL_DAYS, get_retention_policy, set_retention_policy
+from jobs import enqueue_job, job_status
+from models import BackgroundJob
+from ratelimit import rate_limit_ip, rate_limit_user, concurrency_limit
+from privacy import AVATAR_VISIBILITY_MODES, visible_to, invalidate_policies, avatar_exceptions, set_avatar_exceptions
+from contacts import CONTACT_SYNC_MAX, CONTACT_NAME_MAX, phone_hash, valid_phone_hash, sync_contacts, link_new_user
+from catalog import (
+    FRAMES_LIST, FRAME_PRESETS, CATALOG_CACHE_CONTROL, PRESET_AVATAR_MEDIA_TYPE, PRESET_IMAGE_CACHE_CONTROL,
+    avatar_preset, avatars_list, frame_preset, bundled_avatar, preset_avatar_remote_url, preset_avatar_url,
+)
+from themes import THEME_SYNC_MAX, ThemeNotFound, theme_list, sync_themes, invalidate_themes
+from keys import current_key, key_at_version, record_initial_key, rotate_key, forget_key, conversation_peers
+from profiles import parse_user_ids, public_keys, user_cards
+from usage import USAGE_PERIODS, USAGE_SERIES_MAX, record_registration, record_upload, usage_series
+from replies import HISTORY_WITH_REPLY_FIELDS, THREAD_DEPTH_DEFAULT, THREAD_DEPTH_MAX, THREAD_FIELDS, message_parties, thread_rows, with_reply_previews
+from message_changes import CHANGES_PAGE_MAX, MessageNotFound, NotMessageOwner, changes_since, delete_message as record_delete, edit_message as record_edit
+from groups import (
+    GROUP_MEMBERS_MAX, GROUP_TITLE_MAX, GROUP_MESSAGE_FIELDS, GroupForbidden, GroupFull, GroupNotFound,
+    add_members, create_group, group_detail, group_history_page, group_summaries, mark_read, member_ids, remove_member,
+)
+from export import EXPORT_FORMATS, iter_chat_export, iter_account_export, ndjson_stream, zip_stream
 from datetime import timedelta
+import json
 import shutil
 import os
 import uuid
@@ -18,13 +46,6 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-def isoformat_utc(dt: datetime) -> str:
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    else:
-        dt = dt.astimezone(timezone.utc)
-    return dt.isoformat().replace("+00:00", "Z")
-
 
 @router.get("/test")
 async def test_connection():
@@ -39,7 +60,7 @@ def normalize_phone(phone: str) -> str:
     return normalized
 
 
-@router.post("/auth/register", response_model=Token, status_code=status.HTTP_201_CREATED)
+@router.post("/auth/register", response_model=Token, status_code=status.HTTP_201_CREATED, dependencies=[Depends(rate_limit_ip("register"))])
 async def register(user_data: UserCreate, db: Session = Depends(get_db)):
     normalized_phone = normalize_phone(user_data.phone)
     
@@ -55,13 +76,18 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         first_name=user_data.first_name,
         last_name=user_data.last_name,
         phone=normalized_phone,
+        phone_hash=phone_hash(normalized_phone),
         username=None,
         password_hash=hashed_password,
         public_key=user_data.public_key
     )
     db.add(new_user)
+    db.flush()
+    record_initial_key(db, new_user)
+    link_new_user(db, new_user.id, new_user.phone_hash)
     db.commit()
     db.refresh(new_user)
+    record_registration()
     
     access_token_expires = timedelta(days=1)
     token_subject = new_user.username if new_user.username else str(new_user.id)
@@ -72,7 +98,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-@router.post("/auth/login", response_model=Token)
+@router.post("/auth/login", response_model=Token, dependencies=[Depends(rate_limit_ip("login"))])
 async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
     normalized_phone = normalize_phone(user_credentials.phone)
     user = authenticate_user(db, normalized_phone, user_credentials.password)
@@ -116,16 +142,18 @@ async def update_username(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    existing_user = db.query(User).filter(User.username == new_username).first()
-    if existing_user:
+    if username_taken(db, new_username):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already taken"
         )
     
+    old_username = current_user.username
     current_user.username = new_username
     db.commit()
     db.refresh(current_user)
+    forget_username(old_username)
+    remember_username(new_username)
     return UserResponse(
         id=current_user.id, 
         username=current_user.username, 
@@ -271,11 +299,8 @@ async def set_avatar_frame(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    valid_frames = [
-        "none", "fire", "rainbow", "purple"
-    ]
-    if frame not in valid_frames:
-        raise HTTPException(400, detail=f"Invalid frame. Must be one of: {', '.join(valid_frames)}")
+    if frame_preset(frame) is None:
+        raise HTTPException(400, detail=f"Invalid frame. Must be one of: {', '.join(FRAME_PRESETS)}")
     
     current_user.avatar_frame = frame if frame != "none" else None
     db.commit()
@@ -285,59 +310,53 @@ async def set_avatar_frame(
 
 
 @router.get("/avatars/list")
-async def get_avatars_list():
-    avatars = [
-        {"id": "1", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=1"},
-        {"id": "2", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=2"},
-        {"id": "3", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=3"},
-        {"id": "4", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=4"},
-        {"id": "5", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=5"},
-        {"id": "6", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=6"},
-        {"id": "7", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=7"},
-        {"id": "8", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=8"},
-        {"id": "9", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=9"},
-        {"id": "10", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=10"},
-        {"id": "11", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=11"},
-        {"id": "12", "url": "https://api.dicebear.com/7.x/avataaars/svg?seed=12"},
-    ]
-    return {"avatars": avatars}
+async def get_avatars_list(request: Request):
+    return _etag_body_response(request, *avatars_list(str(request.base_url)), cache_control=CATALOG_CACHE_CONTROL)
+
+
+@router.get("/avatars/presets/{avatar_id}")
+async def get_preset_avatar_image(avatar_id: str):
+    if avatar_preset(avatar_id) is None:
+        raise HTTPException(404, detail="Avatar not found")
+    path = bundled_avatar(avatar_id)
+    if path is None:
+        return RedirectResponse(preset_avatar_remote_url(avatar_id), status_code=status.HTTP_307_TEMPORARY_REDIRECT)
+    return FileResponse(path, media_type=PRESET_AVATAR_MEDIA_TYPE, headers={"Cache-Control": PRESET_IMAGE_CACHE_CONTROL})
 
 
 @router.get("/avatar-frames/list")
-async def get_avatar_frames_list():
-    frames = [
-        {"id": "none", "name": "Без рамки", "color": "#000000"},
-        {"id": "fire", "name": "Огненная", "color": "#FF4500"},
-        {"id": "rainbow", "name": "Радужная", "color": "#FF0000"},
-        {"id": "purple", "name": "Фиолетовая", "color": "#800080"},
-    ]
-    return {"frames": frames}
+async def get_avatar_frames_list(request: Request):
+    return _etag_body_response(request, *FRAMES_LIST, cache_control=CATALOG_CACHE_CONTROL)
 
 
 @router.put("/users/me/preset-avatar")
 async def set_preset_avatar(
+    request: Request,
     avatar_id: str,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    avatars_response = await get_avatars_list()
-    avatar = next((a for a in avatars_response["avatars"] if a["id"] == avatar_id), None)
+    avatar = avatar_preset(avatar_id)
     
     if not avatar:
         raise HTTPException(400, detail="Invalid avatar ID")
     
-    current_user.avatar_url = avatar["url"]
+    current_user.avatar_url = preset_avatar_url(avatar_id, str(request.base_url))
     db.commit()
     db.refresh(current_user)
     
     return {"avatar_url": current_user.avatar_url}
 
 
-@router.get("/users/search", response_model=List[UserResponse])
-async def search_users(
+@router.get(
+    "/users/search",
+    response_model=List[UserResponse],
+    dependencies=[Depends(rate_limit_user("search")), Depends(concurrency_limit("search"))]
+)
+def search_users(
     query: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_read)
 ):
     if len(query) < 2:
         return []
@@ -371,6 +390,7 @@ async def search_users(
             filtered_users.append(user)
     
     users = filtered_users[:20]
+    visibility = visible_to(db, current_user.id, [user.id for user in users])
     
     return [
         UserResponse(
@@ -380,12 +400,12 @@ async def search_users(
             last_name=user.last_name,
             phone=user.phone,
             public_key=user.public_key,
-            avatar_url=user.avatar_url,
+            avatar_url=user.avatar_url if visibility[user.id].avatar else None,
             avatar_frame=user.avatar_frame,
             bio=user.bio,
             birthdate=user.birthdate,
-            last_seen=user.last_seen,
-            is_online=user.id in user_socket_map and len(user_socket_map[user.id]) > 0
+            last_seen=user.last_seen if visibility[user.id].last_seen else None,
+            is_online=is_user_online(user.id) if visibility[user.id].online else None
         ) for user in users
     ]
 
@@ -395,26 +415,31 @@ async def check_availability(
     username: str,
     db: Session = Depends(get_db)
 ):
-    user = db.query(User).filter(User.username == username).first()
-    return {"available": user is None}
+    return {"available": not username_taken(db, username)}
+
+
+USERS_PAGE_SIZE = 100
+USERS_PAGE_SIZE_MAX = 500
+USER_LIST_EXTRA_FIELDS = tuple(name for name in UserResponse.model_fields if name not in USER_LIST_FIELDS)
+USER_LIST_PADDING = (None,) * len(USER_LIST_EXTRA_FIELDS)
 
 
 @router.get("/users", response_model=List[UserResponse])
 async def get_users(
+    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_PAGE_SIZE_MAX),
+    offset: int = Query(0, ge=0),
+    after_id: Optional[int] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_read)
 ):
-    users = db.query(User).filter(User.id != current_user.id).all()
-    return [
-        UserResponse(
-            id=user.id, 
-            username=user.username, 
-            public_key=user.public_key,
-            avatar_url=user.avatar_url,
-            avatar_frame=user.avatar_frame,
-            phone=user.phone
-        ) for user in users
+    rows = list(user_list_rows(db, current_user.id, limit, offset=offset, after_id=after_id))
+    visibility = visible_to(db, current_user.id, [row[0] for row in rows])
+    avatar_index = USER_LIST_FIELDS.index("avatar_url")
+    rows = [
+        (tuple(row) if visibility[row[0]].avatar else row[:avatar_index] + (None,) + row[avatar_index + 1:]) + USER_LIST_PADDING
+        for row in rows
     ]
+    return rows_response(rows, USER_LIST_FIELDS + USER_LIST_EXTRA_FIELDS)
 
 
 @router.post("/keys/exchange", response_model=KeyExchangeResponse)
@@ -423,20 +448,89 @@ async def exchange_key(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    user = db.query(User).filter(User.id == key_request.user_id).first()
-    if not user:
+    key = current_key(db, key_request.user_id)
+    if key is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    if not user.public_key:
+    key_version, public_key = key
+    if not public_key:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User does not have a public key"
         )
     
-    return KeyExchangeResponse(user_id=user.id, public_key=user.public_key)
+    return KeyExchangeResponse(user_id=key_request.user_id, public_key=public_key, key_version=key_version)
+
+
+@router.get("/keys/{user_id}/versions/{key_version}", response_model=KeyExchangeResponse)
+async def get_key_version(
+    user_id: int,
+    key_version: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    public_key = key_at_version(db, user_id, key_version)
+    if public_key is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Key version not found")
+    return KeyExchangeResponse(user_id=user_id, public_key=public_key, key_version=key_version)
+
+
+@router.put("/users/me/public-key", response_model=KeyExchangeResponse)
+async def update_public_key(
+    key_update: PublicKeyUpdate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not key_update.public_key.strip():
+        raise HTTPException(400, detail="Public key cannot be empty")
+    
+    key_version = rotate_key(db, current_user, key_update.public_key)
+    if key_version is not None:
+        peer_ids = conversation_peers(db, current_user.id)
+        await notify_key_changed(current_user.id, key_version, current_user.public_key, peer_ids)
+    
+    return KeyExchangeResponse(user_id=current_user.id, public_key=current_user.public_key, key_version=current_user.key_version)
+
+
+def _batch_ids(ids: str) -> List[int]:
+    try:
+        return parse_user_ids(ids)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(400, detail=str(e))
+
+
+def _etag_response(request: Request, content) -> Response:
+    return _etag_body_response(request, *encode_batch(content))
+
+
+def _etag_body_response(request: Request, body: bytes, etag: str, cache_control: str = "private, no-cache") -> Response:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/keys/batch", response_model=List[KeyExchangeResponse])
+async def get_public_keys_batch(
+    request: Request,
+    ids: str = Query(..., description="Comma-separated user ids"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return _etag_response(request, public_keys(db, _batch_ids(ids)))
+
+
+@router.get("/users/profiles/batch", response_model=List[UserResponse])
+async def get_user_profiles_batch(
+    request: Request,
+    ids: str = Query(..., description="Comma-separated user ids"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    return _etag_response(request, user_cards(db, current_user.id, _batch_ids(ids), is_user_online))
 
 
 @router.get("/chats/active", response_model=List[UserResponse])
@@ -444,48 +538,27 @@ async def get_active_chats(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    sent_to = db.query(Message.receiver_id).filter(
-        and_(
-            Message.sender_id == current_user.id,
-            Message.receiver_id != current_user.id
-        )
-    ).distinct()
-    received_from = db.query(Message.sender_id).filter(
-        and_(
-            Message.receiver_id == current_user.id,
-            Message.sender_id != current_user.id
-        )
-    ).distinct()
-    
-    chat_user_ids = set()
-    for row in sent_to:
-        if row[0] != current_user.id:
-            chat_user_ids.add(row[0])
-    for row in received_from:
-        if row[0] != current_user.id:
-            chat_user_ids.add(row[0])
+    last_messages = {row.peer_id: row for row in last_message_rows(db, current_user.id)}
     
-    if not chat_user_ids:
+    if not last_messages:
         return []
     
     users = db.query(User).filter(
         and_(
-            User.id.in_(chat_user_ids),
+            User.id.in_(last_messages),
             User.id != current_user.id
         )
     ).all()
     
     contacts = db.query(Contact).filter(Contact.owner_id == current_user.id).all()
     contact_names = {contact.contact_id: contact.local_name for contact in contacts}
+    visibility = visible_to(db, current_user.id, [user.id for user in users])
     
     result = []
     for user in users:
-        last_message = db.query(Message).filter(
-            or_(
-                and_(Message.sender_id == current_user.id, Message.receiver_id == user.id),
-                and_(Message.sender_id == user.id, Message.receiver_id == current_user.id)
-            )
-        ).order_by(Message.timestamp.desc()).first()
+        last_message = last_messages[user.id]
+        if not last_message.live:
+            last_message = None
         
         result.append(UserResponse(
             id=user.id,
@@ -493,12 +566,12 @@ async def get_active_chats(
             first_name=user.first_name,
             last_name=user.last_name,
             public_key=user.public_key,
-            avatar_url=user.avatar_url,
+            avatar_url=user.avatar_url if visibility[user.id].avatar else None,
             avatar_frame=user.avatar_frame,
             bio=user.bio,
             birthdate=user.birthdate,
-            last_seen=user.last_seen,
-            is_online=user.id in user_socket_map and len(user_socket_map[user.id]) > 0,
+            last_seen=user.last_seen if visibility[user.id].last_seen else None,
+            is_online=is_user_online(user.id) if visibility[user.id].online else None,
             last_message=last_message.encrypted_content if last_message else None,
             last_message_time=last_message.timestamp if last_message else None,
             last_message_sender_id=last_message.sender_id if last_message else None,
@@ -513,47 +586,13 @@ async def get_active_chats(
 async def get_user_profile(
     user_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_read)
 ):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(404, detail="User not found")
     
-    is_online = user_id in user_socket_map and len(user_socket_map[user_id]) > 0
-    
-    avatar_url = None
-    if hasattr(user, 'avatar_visibility'):
-        avatar_visibility = user.avatar_visibility or 'all'
-        if avatar_visibility == 'all':
-            avatar_url = user.avatar_url
-        elif avatar_visibility == 'contacts':
-            has_messages = db.query(Message).filter(
-                or_(
-                    and_(Message.sender_id == current_user.id, Message.receiver_id == user_id),
-                    and_(Message.sender_id == user_id, Message.receiver_id == current_user.id)
-                )
-            ).first() is not None
-            if has_messages:
-                avatar_url = user.avatar_url
-        elif avatar_visibility == 'except':
-            import json
-            exceptions = []
-            if hasattr(user, 'avatar_visibility_exceptions') and user.avatar_visibility_exceptions:
-                try:
-                    exceptions = json.loads(user.avatar_visibility_exceptions)
-                except:
-                    exceptions = []
-            if current_user.id not in exceptions:
-                avatar_url = user.avatar_url
-    else:
-        avatar_url = user.avatar_url
-    
-    show_last_seen = True
-    show_online_status = True
-    if hasattr(user, 'show_last_seen'):
-        show_last_seen = user.show_last_seen if user.show_last_seen is not None else True
-    if hasattr(user, 'show_online_status'):
-        show_online_status = user.show_online_status if user.show_online_status is not None else True
+    visibility = visible_to(db, current_user.id, [user_id])[user_id]
     
     local_name = None
     contact = db.query(Contact).filter(
@@ -569,16 +608,16 @@ async def get_user_profile(
         last_name=user.last_name,
         local_name=local_name,
         public_key=user.public_key,
-        avatar_url=avatar_url,
+        avatar_url=user.avatar_url if visibility.avatar else None,
         avatar_frame=user.avatar_frame,
         bio=user.bio,
         birthdate=user.birthdate,
-        last_seen=user.last_seen if show_last_seen else None,
-        is_online=is_online if show_online_status else None
+        last_seen=user.last_seen if visibility.last_seen else None,
+        is_online=is_user_online(user_id) if visibility.online else None
     )
 
 
-@router.post("/upload")
+@router.post("/upload", dependencies=[Depends(rate_limit_user("upload"))])
 async def upload_file(
     request: Request,
     file: UploadFile = File(...),
@@ -602,63 +641,304 @@ async def upload_file(
     try:
         with open(file_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
+            size = buffer.tell()
         logger.info(f"File saved: {file_path}")
     except Exception as e:
         logger.error(f"Error saving file: {e}")
         raise HTTPException(500, detail=f"Error saving file: {str(e)}")
     
+    record_upload(current_user.id, size)
     base_url = str(request.base_url).rstrip("/")
     full_url = f"{base_url}/{file_path}"
     
     return {"url": full_url, "filename": filename}
 
 
+HISTORY_PAGE_SIZE_MAX = 500
+
+
 @router.get("/chats/{target_user_id}/messages")
 async def get_chat_history(
+    target_user_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_PAGE_SIZE_MAX),
+    before_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    if limit is None:
+        rows = chat_history_rows(db, current_user.id, target_user_id)
+    else:
+        rows = chat_history_page(db, current_user.id, target_user_id, limit, before_id)
+    
+    rows = with_reply_previews(db, rows, current_user.id, target_user_id)
+    return rows_response(rows, HISTORY_WITH_REPLY_FIELDS, datetime_fields=("timestamp",))
+
+
+@router.get("/messages/{message_id}/thread")
+async def get_message_thread(
+    message_id: int,
+    depth: int = Query(THREAD_DEPTH_DEFAULT, ge=1, le=THREAD_DEPTH_MAX),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    row = message_parties(db, message_id)
+    if row is None or current_user.id not in row:
+        raise HTTPException(404, detail="Message not found")
+    peer_id = row.receiver_id if row.sender_id == current_user.id else row.sender_id
+    thread = thread_rows(db, message_id, current_user.id, peer_id, depth)
+    return FastJSONResponse({
+        "message_id": message_id,
+        "ancestors": [dict(zip(THREAD_FIELDS, item)) for item in thread["ancestors"]],
+        "replies": [dict(zip(THREAD_FIELDS, item)) for item in thread["replies"]],
+    })
+
+
+@router.get("/chats/{target_user_id}/retention")
+async def get_chat_retention(
     target_user_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    messages = db.query(Message).filter(
-        or_(
-            and_(Message.sender_id == current_user.id, Message.receiver_id == target_user_id),
-            and_(Message.sender_id == target_user_id, Message.receiver_id == current_user.id)
-        )
-    ).order_by(Message.timestamp.asc()).all()
+    policy = get_retention_policy(db, current_user.id, target_user_id)
+    return {
+        "ttl_days": policy.ttl_days if policy else None,
+        "default_ttl_days": MESSAGE_RETENTION_DAYS or None,
+    }
+
+
+@router.put("/chats/{target_user_id}/retention")
+async def set_chat_retention(
+    target_user_id: int,
+    ttl_days: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if ttl_days is not None and ttl_days < RETENTION_MIN_TTL_DAYS:
+        raise HTTPException(400, detail=f"ttl_days must be at least {RETENTION_MIN_TTL_DAYS}")
+    if target_user_id == current_user.id:
+        raise HTTPException(400, detail="Cannot set retention for a chat with yourself")
+    if not db.query(User.id).filter(User.id == target_user_id).first():
+        raise HTTPException(404, detail="User not found")
     
-    return [
-        {
-            "id": msg.id,
-            "sender_id": msg.sender_id,
-            "receiver_id": msg.receiver_id,
-            "encrypted_content": msg.encrypted_content,
-            "message_type": msg.message_type,
-            "media_url": msg.media_url,
-            "reply_to_message_id": msg.reply_to_message_id,
-            "timestamp": isoformat_utc(msg.timestamp),
-            "is_read": msg.is_read
-        } for msg in messages
-    ]
+    policy = set_retention_policy(db, current_user.id, target_user_id, ttl_days)
+    logger.info(f"User {current_user.id} set retention for chat with user {target_user_id} to {ttl_days} day(s)")
+    
+    return {
+        "ttl_days": policy.ttl_days if policy else None,
+        "default_ttl_days": MESSAGE_RETENTION_DAYS or None,
+    }
+
+
+def _export_response(records, format: str, filename: str) -> StreamingResponse:
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(400, detail=f"Invalid format. Must be one of: {', '.join(EXPORT_FORMATS)}")
+    
+    if format == "zip":
+        return StreamingResponse(
+            zip_stream(records, arcname=f"{filename}.ndjson"),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.zip"'},
+        )
+    return StreamingResponse(
+        ndjson_stream(records),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson"'},
+    )
+
+
+@router.get("/chats/{target_user_id}/export")
+async def export_chat(
+    target_user_id: int,
+    format: str = "ndjson",
+    after_id: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user)
+):
+    logger.info(f"User {current_user.id} exporting chat with user {target_user_id} (format={format}, after_id={after_id})")
+    records = iter_chat_export(current_user.id, target_user_id, after_id)
+    return _export_response(records, format, f"chat_{current_user.id}_{target_user_id}")
+
 
+@router.get("/users/me/export")
+async def export_account(
+    format: str = "ndjson",
+    after_id: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user)
+):
+    logger.info(f"User {current_user.id} exporting account (format={format}, after_id={after_id})")
+    records = iter_account_export(current_user.id, after_id)
+    return _export_response(records, format, f"account_{current_user.id}")
 
-@router.delete("/chats/{target_user_id}/messages")
+
+@router.delete("/chats/{target_user_id}/messages", status_code=status.HTTP_202_ACCEPTED)
 async def clear_chat(
     target_user_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    deleted_count = db.query(Message).filter(
-        or_(
-            and_(Message.sender_id == current_user.id, Message.receiver_id == target_user_id),
-            and_(Message.sender_id == target_user_id, Message.receiver_id == current_user.id)
-        )
-    ).delete(synchronize_session=False)
+    job = enqueue_job(db, "clear_chat", {"user_id": current_user.id, "peer_id": target_user_id}, user_id=current_user.id)
     
-    db.commit()
+    logger.info(f"User {current_user.id} requested to clear chat with user {target_user_id} (job {job.id})")
     
-    logger.info(f"User {current_user.id} cleared chat with user {target_user_id}. Deleted {deleted_count} messages.")
-    
-    return {"deleted_count": deleted_count, "message": "Chat cleared successfully"}
+    return {**job_status(job), "message": "Chat clearing started"}
+
+
+@router.post("/groups", status_code=201)
+async def create_group_chat(
+    payload: GroupCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    title = payload.title.strip()
+    if not title or len(title) > GROUP_TITLE_MAX:
+        raise HTTPException(400, detail=f"title must be 1-{GROUP_TITLE_MAX} characters")
+    try:
+        conversation_id = create_group(db, current_user.id, title, payload.member_ids)
+    except GroupFull:
+        raise HTTPException(400, detail=f"At most {GROUP_MEMBERS_MAX} members per group")
+    detail = group_detail(db, conversation_id)
+    await notify_group_members_changed(conversation_id, [member["user_id"] for member in detail["members"]], [])
+    return FastJSONResponse(detail, status_code=201)
+
+
+@router.get("/groups")
+async def list_group_chats(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    return FastJSONResponse(group_summaries(db, current_user.id))
+
+
+@router.get("/groups/{conversation_id}")
+async def get_group_chat(
+    conversation_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read),
+    primary: Session = Depends(get_db)
+):
+    if current_user.id not in member_ids(primary, conversation_id):
+        raise HTTPException(404, detail="Group not found")
+    return FastJSONResponse(group_detail(db, conversation_id))
+
+
+@router.post("/groups/{conversation_id}/members")
+async def add_group_members(
+    conversation_id: int,
+    payload: GroupMembersAdd,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        added = add_members(db, conversation_id, current_user.id, payload.user_ids)
+    except GroupNotFound:
+        raise HTTPException(404, detail="Group not found")
+    except GroupForbidden:
+        raise HTTPException(403, detail="Only the group owner can add members")
+    except GroupFull:
+        raise HTTPException(400, detail=f"At most {GROUP_MEMBERS_MAX} members per group")
+    if added:
+        await notify_group_members_changed(conversation_id, added, [])
+    return {"added": added}
+
+
+@router.delete("/groups/{conversation_id}/members/{user_id}")
+async def remove_group_member(
+    conversation_id: int,
+    user_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        removed = remove_member(db, conversation_id, current_user.id, user_id)
+    except GroupNotFound:
+        raise HTTPException(404, detail="Group not found")
+    except GroupForbidden:
+        raise HTTPException(403, detail="Only the group owner can remove other members")
+    if not removed:
+        raise HTTPException(404, detail="Member not found")
+    await notify_group_members_changed(conversation_id, [], [user_id])
+    return {"removed": user_id}
+
+
+@router.get("/groups/{conversation_id}/messages")
+async def get_group_history(
+    conversation_id: int,
+    limit: int = Query(100, ge=1, le=HISTORY_PAGE_SIZE_MAX),
+    before_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read),
+    primary: Session = Depends(get_db)
+):
+    if current_user.id not in member_ids(primary, conversation_id):
+        raise HTTPException(404, detail="Group not found")
+    rows = group_history_page(db, conversation_id, limit, before_id)
+    return rows_response(rows, GROUP_MESSAGE_FIELDS, datetime_fields=("timestamp",))
+
+
+@router.post("/groups/{conversation_id}/read")
+async def mark_group_read(
+    conversation_id: int,
+    payload: GroupReadUpdate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if current_user.id not in member_ids(db, conversation_id):
+        raise HTTPException(404, detail="Group not found")
+    watermark = mark_read(db, conversation_id, current_user.id, payload.message_id)
+    if watermark is not None:
+        await emit_to_group(conversation_id, "group_read", {
+            "conversation_id": conversation_id,
+            "reader_id": current_user.id,
+            "message_id": watermark,
+        })
+    return {"last_read_message_id": watermark, "advanced": watermark is not None}
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    job = db.query(BackgroundJob).filter(
+        BackgroundJob.id == job_id,
+        BackgroundJob.user_id == current_user.id
+    ).first()
+    if not job:
+        raise HTTPException(404, detail="Job not found")
+    return job_status(job)
+
+
+@router.get("/stats/usage")
+async def get_usage_stats(
+    period: str = "day",
+    buckets: int = Query(30, ge=1, le=max(USAGE_SERIES_MAX.values())),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    if not current_user.is_admin:
+        raise HTTPException(403, detail="Admin access required")
+    if period not in USAGE_PERIODS:
+        raise HTTPException(400, detail=f"period must be one of: {', '.join(USAGE_PERIODS)}")
+    return {"period": period, "buckets": usage_series(db, period, buckets)}
+
+
+@router.put("/messages/{message_id}")
+async def edit_message(
+    message_id: int,
+    payload: MessageEdit,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not payload.encrypted_content:
+        raise HTTPException(400, detail="encrypted_content must not be empty")
+    try:
+        change = record_edit(db, message_id, current_user.id, payload.encrypted_content)
+    except MessageNotFound:
+        raise HTTPException(404, detail="Message not found")
+    except NotMessageOwner:
+        raise HTTPException(403, detail="You can only edit your own messages")
+    await notify_message_changed(change)
+    return {"message_id": message_id, "seq": change["seq"], "edited_at": change["timestamp"]}
 
 
 @router.delete("/messages/{message_id}")
@@ -667,39 +947,36 @@ async def delete_message(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    logger.info(f"🗑️ Delete request: message_id={message_id} (type: {type(message_id)}), user_id={current_user.id}")
+    logger.info(f"🗑️ Delete request: message_id={message_id}, user_id={current_user.id}")
     
     if message_id is None or message_id <= 0:
         logger.warning(f"Invalid message_id: {message_id}")
         raise HTTPException(400, detail="Invalid message ID")
     
-    message = db.query(Message).filter(Message.id == message_id).first()
-    
-    if not message:
+    try:
+        change = record_delete(db, message_id, current_user.id)
+    except MessageNotFound:
         logger.warning(f"Message {message_id} not found in database")
         raise HTTPException(404, detail="Message not found")
-    
-    if message.sender_id != current_user.id:
-        logger.warning(f"User {current_user.id} attempted to delete message {message_id} from user {message.sender_id}")
+    except NotMessageOwner:
+        logger.warning(f"User {current_user.id} attempted to delete message {message_id} of another user")
         raise HTTPException(403, detail="You can only delete your own messages")
     
-    if message.media_url:
-        try:
-            import os
-            if message.media_url.startswith('/static/'):
-                file_path = message.media_url.replace('/static/', 'static/')
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.info(f"Deleted media file: {file_path}")
-        except Exception as e:
-            logger.warning(f"Failed to delete media file: {e}")
-    
-    db.delete(message)
-    db.commit()
-    
+    await notify_message_changed(change)
     logger.info(f"✅ User {current_user.id} deleted message {message_id}")
     
-    return {"message": "Message deleted successfully"}
+    return {"message": "Message deleted successfully", "seq": change["seq"]}
+
+
+@router.get("/chats/{target_user_id}/changes")
+async def get_chat_changes(
+    target_user_id: int,
+    after_seq: int = Query(0, ge=0),
+    limit: int = Query(CHANGES_PAGE_MAX, ge=1, le=CHANGES_PAGE_MAX),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    return FastJSONResponse(changes_since(db, current_user.id, target_user_id, after_seq, limit))
 
 
 @router.put("/users/me/privacy")
@@ -712,10 +989,8 @@ async def update_privacy_settings(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    import json
-    
     if avatar_visibility is not None:
-        if avatar_visibility not in ['all', 'contacts', 'nobody', 'except']:
+        if avatar_visibility not in AVATAR_VISIBILITY_MODES:
             raise HTTPException(400, detail="Invalid avatar_visibility value")
         current_user.avatar_visibility = avatar_visibility
     
@@ -723,8 +998,8 @@ async def update_privacy_settings(
         try:
             exceptions_list = json.loads(avatar_visibility_exceptions)
             if isinstance(exceptions_list, list):
-                current_user.avatar_visibility_exceptions = avatar_visibility_exceptions
-        except json.JSONDecodeError:
+                set_avatar_exceptions(db, current_user.id, exceptions_list)
+        except (json.JSONDecodeError, ValueError, TypeError):
             raise HTTPException(400, detail="Invalid avatar_visibility_exceptions format")
     
     if show_read_receipts is not None:
@@ -738,10 +1013,11 @@ async def update_privacy_settings(
     
     db.commit()
     db.refresh(current_user)
+    invalidate_policies([current_user.id])
     
     return {
         "avatar_visibility": current_user.avatar_visibility,
-        "avatar_visibility_exceptions": current_user.avatar_visibility_exceptions,
+        "avatar_visibility_exceptions": json.dumps(avatar_exceptions(db, current_user.id)),
         "show_read_receipts": current_user.show_read_receipts,
         "show_last_seen": current_user.show_last_seen,
         "show_online_status": current_user.show_online_status,
@@ -755,7 +1031,7 @@ async def get_privacy_settings(
 ):
     return {
         "avatar_visibility": current_user.avatar_visibility or "all",
-        "avatar_visibility_exceptions": current_user.avatar_visibility_exceptions,
+        "avatar_visibility_exceptions": json.dumps(avatar_exceptions(db, current_user.id)),
         "show_read_receipts": current_user.show_read_receipts if current_user.show_read_receipts is not None else True,
         "show_last_seen": current_user.show_last_seen if current_user.show_last_seen is not None else True,
         "show_online_status": current_user.show_online_status if current_user.show_online_status is not None else True,
@@ -768,7 +1044,7 @@ async def mark_messages_as_read(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    from socketio_handler import user_socket_map, notify_messages_read
+    from socketio_handler import notify_messages_read
     
     messages_to_update = db.query(Message).filter(
         and_(
@@ -798,24 +1074,11 @@ async def mark_messages_as_read(
 async def get_chat_media(
     target_user_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_read)
 ):
-    messages = db.query(Message).filter(
-        Message.message_type == "image",
-        or_(
-            and_(Message.sender_id == current_user.id, Message.receiver_id == target_user_id),
-            and_(Message.sender_id == target_user_id, Message.receiver_id == current_user.id)
-        )
-    ).order_by(Message.timestamp.desc()).all()
+    rows = chat_media_rows(db, current_user.id, target_user_id)
     
-    return [
-        {
-            "id": msg.id,
-            "media_url": msg.media_url,
-            "timestamp": isoformat_utc(msg.timestamp),
-            "sender_id": msg.sender_id
-        } for msg in messages
-    ]
+    return rows_response(rows, CHAT_MEDIA_FIELDS, datetime_fields=("timestamp",))
 
 
 @router.post("/users/me/themes", response_model=UserThemeResponse, status_code=status.HTTP_201_CREATED)
@@ -839,17 +1102,36 @@ async def create_user_theme(
     )
     db.add(new_theme)
     db.commit()
+    invalidate_themes(current_user.id)
     db.refresh(new_theme)
     return new_theme
 
 
 @router.get("/users/me/themes", response_model=List[UserThemeResponse])
 async def get_user_themes(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    return _etag_body_response(request, *theme_list(db, current_user.id))
+
+
+@router.post("/users/me/themes/sync")
+async def sync_user_themes(
+    sync_request: ThemeSyncRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    themes = db.query(UserTheme).filter(UserTheme.user_id == current_user.id).order_by(UserTheme.created_at.desc()).all()
-    return themes
+    if len(sync_request.upserts) + len(sync_request.deleted) > THEME_SYNC_MAX:
+        raise HTTPException(400, detail=f"At most {THEME_SYNC_MAX} themes per sync")
+    
+    try:
+        created = sync_themes(db, current_user.id, sync_request.upserts, sync_request.deleted)
+    except ThemeNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Theme not found: {e.args[0]}")
+    
+    body, etag = theme_list(db, current_user.id)
+    return {"created": created, "etag": etag, "themes": loads(body)}
 
 
 @router.put("/users/me/themes/{theme_id}", response_model=UserThemeResponse)
@@ -882,37 +1164,28 @@ async def update_user_theme(
     theme.wallpaper_blur = theme_data.wallpaper_blur
     
     db.commit()
+    invalidate_themes(current_user.id)
     db.refresh(theme)
     return theme
 
 
-@router.delete("/users/me", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/users/me", status_code=status.HTTP_202_ACCEPTED)
 async def delete_account(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     try:
-        db.query(Message).filter(
-            or_(Message.sender_id == current_user.id, Message.receiver_id == current_user.id)
-        ).delete()
-        
-        db.query(UserTheme).filter(UserTheme.user_id == current_user.id).delete()
-        
-        if current_user.avatar_url:
-            import os
-            avatar_filename = os.path.basename(current_user.avatar_url)
-            avatar_path = os.path.join("static", "avatars", avatar_filename)
-            if os.path.exists(avatar_path):
-                try:
-                    os.remove(avatar_path)
-                except Exception as e:
-                    logger.warning(f"Failed to delete avatar file {avatar_path}: {e}")
-        
-        db.delete(current_user)
+        current_user.password_hash = ""
+        current_user.public_key = None
+        current_user.deleted_at = datetime.now(timezone.utc)
         db.commit()
+        forget_key(current_user.id)
+        await disconnect_user(current_user.id)
         
-        logger.info(f"User account {current_user.id} ({current_user.username}) deleted successfully")
-        return None
+        job = enqueue_job(db, "delete_account", {"user_id": current_user.id}, user_id=current_user.id)
+        
+        logger.info(f"User account {current_user.id} ({current_user.username}) scheduled for deletion (job {job.id})")
+        return {**job_status(job), "message": "Account deletion started"}
     except Exception as e:
         db.rollback()
         logger.error(f"Error deleting user account {current_user.id}: {e}")
@@ -938,9 +1211,48 @@ async def delete_user_theme(
     
     db.delete(theme)
     db.commit()
+    invalidate_themes(current_user.id)
     return None
 
 
+@router.post("/contacts/sync", dependencies=[Depends(rate_limit_user("contact_sync"))])
+async def sync_contact_list(
+    sync_request: ContactSyncRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if len(sync_request.added) + len(sync_request.removed) > CONTACT_SYNC_MAX:
+        raise HTTPException(400, detail=f"At most {CONTACT_SYNC_MAX} contacts per sync")
+    
+    added = {}
+    for entry in sync_request.added:
+        value = entry.phone_hash.lower()
+        if not valid_phone_hash(value):
+            raise HTTPException(400, detail="phone_hash must be a hex SHA-256 of the normalized phone number")
+        name = entry.name.strip()[:CONTACT_NAME_MAX] if entry.name and entry.name.strip() else None
+        added[value] = name
+    
+    removed = [value.lower() for value in sync_request.removed]
+    if not all(valid_phone_hash(value) for value in removed):
+        raise HTTPException(400, detail="phone_hash must be a hex SHA-256 of the normalized phone number")
+    
+    return sync_contacts(db, current_user.id, added, removed, full=sync_request.full)
+
+
+CONTACT_LIST_FIELDS = ("contact_id", "local_name", "source", "updated_at")
+
+
+@router.get("/contacts")
+async def get_contacts(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db_read)
+):
+    rows = db.query(Contact.contact_id, Contact.local_name, Contact.source, Contact.updated_at).filter(
+        Contact.owner_id == current_user.id
+    ).order_by(Contact.contact_id.asc())
+    return rows_response(rows, CONTACT_LIST_FIELDS, datetime_fields=("updated_at",))
+
+
 @router.put("/contacts/{contact_id}/local-name")
 async def set_contact_local_name(
     contact_id: int,
@@ -961,6 +1273,7 @@ async def set_contact_local_name(
     
     if contact:
         contact.local_name = local_name.strip() if local_name.strip() else None
+        contact.source = "manual"
         contact.updated_at = datetime.now(timezone.utc)
     else:
         contact = Contact(
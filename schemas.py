@@ -1,6 +1,7 @@
 from pydantic import BaseModel, field_serializer
-from typing import Optional
-from datetime import datetime, timezone
+from typing import List, Optional
+from datetime import datetime
+from serialization import isoformat_utc
 
 
 class UserCreate(BaseModel):
@@ -39,11 +40,7 @@ class UserResponse(BaseModel):
     def serialize_datetime_utc(self, value: Optional[datetime], _info) -> Optional[str]:
         if value is None:
             return None
-        if value.tzinfo is None:
-            dt_utc = value.replace(tzinfo=timezone.utc)
-        else:
-            dt_utc = value.astimezone(timezone.utc)
-        return dt_utc.isoformat().replace('+00:00', 'Z')
+        return isoformat_utc(value)
 
     class Config:
         from_attributes = True
@@ -61,6 +58,39 @@ class KeyExchangeRequest(BaseModel):
 class KeyExchangeResponse(BaseModel):
     user_id: int
     public_key: str
+    key_version: Optional[int] = None
+
+
+class PublicKeyUpdate(BaseModel):
+    public_key: str
+
+
+class MessageEdit(BaseModel):
+    encrypted_content: str
+
+
+class GroupCreate(BaseModel):
+    title: str
+    member_ids: List[int] = []
+
+
+class GroupMembersAdd(BaseModel):
+    user_ids: List[int]
+
+
+class GroupReadUpdate(BaseModel):
+    message_id: int
+
+
+class ContactSyncEntry(BaseModel):
+    phone_hash: str
+    name: Optional[str] = None
+
+
+class ContactSyncRequest(BaseModel):
+    added: List[ContactSyncEntry] = []
+    removed: List[str] = []
+    full: bool = False
 
 
 class UserThemeCreate(BaseModel):
@@ -76,6 +106,16 @@ class UserThemeCreate(BaseModel):
     wallpaper_blur: str | None = "0.0"
 
 
+class ThemeSyncItem(UserThemeCreate):
+    id: Optional[int] = None
+    client_id: Optional[str] = None
+
+
+class ThemeSyncRequest(BaseModel):
+    upserts: List[ThemeSyncItem] = []
+    deleted: List[int] = []
+
+
 class UserThemeResponse(BaseModel):
     id: int
     name: str
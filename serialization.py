@@ -0,0 +1,86 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+from typing import Any, Iterable, Optional, Sequence, Tuple
+
+from fastapi.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+
+def isoformat_utc(dt: datetime) -> str:
+    if dt.tzinfo is not None:
+        offset = dt.utcoffset()
+        if offset:
+            dt = dt.astimezone(timezone.utc)
+        dt = dt.replace(tzinfo=None)
+    return dt.isoformat() + "Z"
+
+
+def _default(value: Any):
+    if isinstance(value, datetime):
+        return isoformat_utc(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _normalize_datetime(value):
+    if isinstance(value, datetime) and value.tzinfo is not None and value.utcoffset():
+        return value.astimezone(timezone.utc)
+    return value
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=ORJSON_OPTIONS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def rows_to_json(rows: Iterable[Sequence], fields: Sequence[str], datetime_fields: Sequence[str] = ()) -> bytes:
+    if datetime_fields:
+        positions = [fields.index(name) for name in datetime_fields]
+        items = []
+        for row in rows:
+            row = list(row)
+            for pos in positions:
+                row[pos] = _normalize_datetime(row[pos])
+            items.append(dict(zip(fields, row)))
+    else:
+        items = [dict(zip(fields, row)) for row in rows]
+    return dumps(items)
+
+
+def rows_response(rows: Iterable[Sequence], fields: Sequence[str], datetime_fields: Sequence[str] = (), **kwargs) -> Response:
+    return Response(content=rows_to_json(rows, fields, datetime_fields), media_type="application/json", **kwargs)
+
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or any((value[2:] if value.startswith("W/") else value) == etag for value in candidates)
+
+
+def encode_batch(content) -> Tuple[bytes, str]:
+    body = dumps(content)
+    return body, etag_for(body)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+SEND_QUEUE_SIZE = 256
+SEND_QUEUE_HARD_LIMIT = 1024
+SEND_TIMEOUT = 10.0
+BACKPRESSURE_DISCONNECT_AFTER = 30.0
+LOW_PRIORITY_EVENTS = {"typing"}
+
+
+class _Connection:
+    def __init__(self, sid: str):
+        self.sid = sid
+        self.queue = deque()
+        self.pending: Dict[tuple, list] = {}
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.backpressured_since: Optional[float] = None
+        self.closing = False
+
+
+class SocketFanout:
+    def __init__(self, sio, namespace: str = "/"):
+        self.sio = sio
+        self.namespace = namespace
+        self.connections: Dict[str, _Connection] = {}
+        self.dropped_events = 0
+
+    def attach(self, sid: str):
+        if sid not in self.connections:
+            self.connections[sid] = _Connection(sid)
+
+    def detach(self, sid: str):
+        conn = self.connections.pop(sid, None)
+        if conn is None:
+            return
+        conn.closing = True
+        if conn.task is not None and conn.task is not asyncio.current_task():
+            conn.task.cancel()
+
+    def send(self, sid: str, event: str, data, coalesce_key=None) -> bool:
+        conn = self.connections.get(sid)
+        if conn is None or conn.closing:
+            return False
+
+        low_priority = event in LOW_PRIORITY_EVENTS
+
+        if coalesce_key is not None:
+            entry = conn.pending.get((event, coalesce_key))
+            if entry is not None:
+                entry[1] = data
+                return True
+
+        if len(conn.queue) >= SEND_QUEUE_SIZE:
+            if low_priority:
+                self.dropped_events += 1
+                logger.debug(f"Dropped {event} for socket {sid}: send queue is full")
+                return False
+            if not self._evict_low_priority(conn):
+                self._mark_backpressured(conn)
+                if conn.closing:
+                    return False
+
+        entry = [event, data, coalesce_key]
+        conn.queue.append(entry)
+        if coalesce_key is not None:
+            conn.pending[(event, coalesce_key)] = entry
+        conn.wakeup.set()
+
+        if conn.task is None:
+            conn.task = asyncio.ensure_future(self._writer(conn))
+        return True
+
+    def send_many(self, sids: Iterable[str], event: str, data, coalesce_key=None, skip_sid: Optional[str] = None) -> int:
+        delivered = 0
+        for sid in list(sids):
+            if sid == skip_sid:
+                continue
+            if self.send(sid, event, data, coalesce_key=coalesce_key):
+                delivered += 1
+        return delivered
+
+    def queue_depth(self, sid: str) -> int:
+        conn = self.connections.get(sid)
+        return len(conn.queue) if conn else 0
+
+    def _evict_low_priority(self, conn: _Connection) -> bool:
+        for entry in conn.queue:
+            if entry[0] in LOW_PRIORITY_EVENTS:
+                conn.queue.remove(entry)
+                if entry[2] is not None:
+                    conn.pending.pop((entry[0], entry[2]), None)
+                self.dropped_events += 1
+                return True
+        return False
+
+    def _mark_backpressured(self, conn: _Connection):
+        now = time.monotonic()
+        if conn.backpressured_since is None:
+            conn.backpressured_since = now
+            logger.warning(f"Socket {conn.sid} is backpressured ({len(conn.queue)} queued events)")
+            return
+        if len(conn.queue) >= SEND_QUEUE_HARD_LIMIT or now - conn.backpressured_since > BACKPRESSURE_DISCONNECT_AFTER:
+            self._disconnect(conn, "stayed backpressured")
+
+    def _disconnect(self, conn: _Connection, reason: str):
+        if conn.closing:
+            return
+        conn.closing = True
+        logger.warning(f"Disconnecting socket {conn.sid}: {reason} ({len(conn.queue)} queued events)")
+        conn.queue.clear()
+        conn.pending.clear()
+        asyncio.ensure_future(self.sio.disconnect(conn.sid, namespace=self.namespace))
+
+    async def _writer(self, conn: _Connection):
+        try:
+            while not conn.closing:
+                if not conn.queue:
+                    conn.wakeup.clear()
+                    await conn.wakeup.wait()
+                    continue
+
+                event, data, coalesce_key = conn.queue.popleft()
+                if coalesce_key is not None:
+                    conn.pending.pop((event, coalesce_key), None)
+
+                try:
+                    await asyncio.wait_for(
+                        self.sio.emit(event, data, room=conn.sid, namespace=self.namespace),
+                        timeout=SEND_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    self._disconnect(conn, f"emit of {event} timed out")
+                    return
+                except Exception as e:
+                    logger.error(f"Error emitting {event} to socket {conn.sid}: {e}")
+
+                if conn.backpressured_since is not None and len(conn.queue) < SEND_QUEUE_SIZE:
+                    conn.backpressured_since = None
+        except asyncio.CancelledError:
+            pass
@@ -1,16 +1,41 @@
+import asyncio
 import logging
-from typing import Dict
+import uuid
+from typing import Dict, Optional, Set
+import engineio
 from sqlalchemy.orm import Session
-from socketio import AsyncNamespace
+from socketio import AsyncNamespace, AsyncServer
 from socketio.exceptions import ConnectionRefusedError
-from database import SessionLocal
-from models import User, Message
+from database import SessionLocal, mark_user_write, set_write_listener, read_session
+from models import User
 from datetime import datetime, timezone
 from auth import get_user_from_token
+from socket_fanout import SocketFanout
+from typing_relay import TypingRelay
+from serialization import isoformat_utc, encode_batch
+from wire_format import WIRE_FORMATS, WIRE_JSON, negotiate_wire_format, encode_payload, decode_payload
+from event_bus import WORKER_ID, event_bus
+from ratelimit import socket_rate_limit
+from profiles import parse_user_ids, public_keys, user_cards
+from usage import record_message
+from replies import insert_message
+from groups import forget_members, insert_group_message, member_ids, set_members_listener, user_group_ids
 
 logger = logging.getLogger(__name__)
 
 user_socket_map: Dict[int, set] = {}
+socket_wire_format: Dict[str, str] = {}
+remote_presence: Dict[int, Set[str]] = {}
+
+
+class WorkerEngineIOServer(engineio.AsyncServer):
+    def _generate_id(self):
+        return f"{WORKER_ID}.{uuid.uuid4().hex}"
+
+
+class WorkerSocketIOServer(AsyncServer):
+    def _engineio_server_class(self):
+        return WorkerEngineIOServer
 
 
 class ChatNamespace(AsyncNamespace):
@@ -87,12 +112,23 @@ class ChatNamespace(AsyncNamespace):
                     logger.error(f"Failed to decode token: {decode_error}")
                 raise ConnectionRefusedError("Authentication failed: Invalid token")
             
-            await self.save_session(sid, {"user_id": user.id, "username": user.username})
+            wire_format = negotiate_wire_format(environ, auth)
+            await self.save_session(sid, {"user_id": user.id, "username": user.username, "wire": wire_format})
+            
+            if wire_format != WIRE_JSON:
+                socket_wire_format[sid] = wire_format
             
             if user.id not in user_socket_map:
                 user_socket_map[user.id] = set()
+                await event_bus.publish("presence", {"user_id": user.id, "online": True})
             user_socket_map[user.id].add(sid)
             
+            for conversation_id in user_group_ids(db, user.id):
+                self.enter_room(sid, group_room(conversation_id, wire_format))
+            
+            if _fanout is not None:
+                _fanout.attach(sid)
+            
             logger.info(f"User {user.username} (ID: {user.id}) connected via socket {sid}")
             
         except Exception as e:
@@ -102,6 +138,11 @@ class ChatNamespace(AsyncNamespace):
             db.close()
     
     async def on_disconnect(self, sid):
+        if _fanout is not None:
+            _fanout.detach(sid)
+        typing_relay.forget_socket(sid)
+        socket_wire_format.pop(sid, None)
+        
         session = await self.get_session(sid)
         if session and "user_id" in session:
             user_id = session["user_id"]
@@ -111,6 +152,8 @@ class ChatNamespace(AsyncNamespace):
                 user_socket_map[user_id].discard(sid)
                 if not user_socket_map[user_id]:
                     del user_socket_map[user_id]
+                    typing_relay.forget_sender(user_id)
+                    await event_bus.publish("presence", {"user_id": user_id, "online": False})
             
             db: Session = SessionLocal()
             try:
@@ -127,6 +170,7 @@ class ChatNamespace(AsyncNamespace):
             
             logger.info(f"User {username} (ID: {user_id}) disconnected from socket {sid}")
     
+    @socket_rate_limit("send_message", concurrency="db_writes")
     async def on_send_message(self, sid, data):
         session = await self.get_session(sid)
         if not session or "user_id" not in session:
@@ -134,6 +178,7 @@ class ChatNamespace(AsyncNamespace):
             await self.emit("error", {"message": "Unauthorized"}, room=sid)
             return
         
+        data = decode_payload(data, socket_wire_format.get(sid, WIRE_JSON))
         sender_id_raw = session["user_id"]
         receiver_id_raw = data.get("receiver_id")
         encrypted_content = data.get("encrypted_content")
@@ -149,6 +194,7 @@ class ChatNamespace(AsyncNamespace):
         try:
             sender_id = int(sender_id_raw)
             receiver_id = int(receiver_id_raw)
+            reply_to_message_id = int(reply_to_message_id) if reply_to_message_id else None
         except (ValueError, TypeError) as e:
             logger.error(f"Invalid user ID format: sender_id={sender_id_raw} (type: {type(sender_id_raw)}), receiver_id={receiver_id_raw} (type: {type(receiver_id_raw)}): {e}")
             await self.emit("error", {"message": "Invalid user ID format"}, room=sid)
@@ -161,83 +207,147 @@ class ChatNamespace(AsyncNamespace):
             await self.emit("error", {"message": "Cannot send message to yourself"}, room=sid)
             return
         
-        db: Session = SessionLocal()
+        now_utc = datetime.now(timezone.utc)
+        
+        def store():
+            db: Session = SessionLocal()
+            try:
+                if db.query(User.id).filter(User.id == receiver_id).first() is None:
+                    logger.warning(f"User {sender_id} attempted to send message to non-existent user {receiver_id}")
+                    return "Receiver not found"
+                saved = insert_message(
+                    db, sender_id, receiver_id, encrypted_content, message_type, media_url, reply_to_message_id, now_utc
+                )
+                if saved is None:
+                    db.rollback()
+                    logger.warning(f"User {sender_id} attempted to reply to message {reply_to_message_id} outside of the conversation")
+                    return "Reply message not found"
+                db.commit()
+                return saved
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+        
         try:
-            receiver = db.query(User).filter(User.id == receiver_id).first()
-            if not receiver:
-                logger.warning(f"User {sender_id} attempted to send message to non-existent user {receiver_id}")
-                await self.emit("error", {"message": "Receiver not found"}, room=sid)
+            saved = await asyncio.to_thread(store)
+            if isinstance(saved, str):
+                await self.emit("error", {"message": saved}, room=sid)
                 return
+            message_id, timestamp = saved
+            mark_user_write(sender_id)
+            mark_user_write(receiver_id)
+            record_message(sender_id, message_type, now_utc)
             
-            now_utc = datetime.now(timezone.utc)
-            if reply_to_message_id:
-                reply_message = db.query(Message).filter(Message.id == reply_to_message_id).first()
-                if not reply_message:
-                    logger.warning(f"User {sender_id} attempted to reply to non-existent message {reply_to_message_id}")
-                    await self.emit("error", {"message": "Reply message not found"}, room=sid)
-                    return
-            
-            message = Message(
-                sender_id=sender_id,
-                receiver_id=receiver_id,
-                encrypted_content=encrypted_content,
-                message_type=message_type,
-                media_url=media_url,
-                reply_to_message_id=reply_to_message_id,
-                timestamp=now_utc
-            )
-            db.add(message)
-            db.commit()
-            db.refresh(message)
+            typing_relay.clear(sender_id, receiver_id)
             
             logger.info(
                 f"Message saved: sender_id={sender_id}, receiver_id={receiver_id}, "
-                f"message_id={message.id}, timestamp={message.timestamp}. "
+                f"message_id={message_id}, timestamp={timestamp}. "
                 f"[PRIVACY: Content is encrypted (E2EE) and unreadable by server/admin]"
             )
             
             message_data = {
-                "id": message.id,
+                "id": message_id,
                 "sender_id": sender_id,
                 "receiver_id": receiver_id,
                 "encrypted_content": encrypted_content,
                 "message_type": message_type,
                 "media_url": media_url,
-                "reply_to_message_id": message.reply_to_message_id,
-                "timestamp": message.timestamp.astimezone(timezone.utc).isoformat().replace("+00:00", "Z"),
-                "is_read": message.is_read
+                "reply_to_message_id": reply_to_message_id,
+                "timestamp": isoformat_utc(timestamp),
+                "is_read": False
             }
             
             receiver_sockets = user_socket_map.get(receiver_id, set())
-            logger.info(f"Receiver {receiver_id} has {len(receiver_sockets)} active socket(s)")
+            logger.info(f"Receiver {receiver_id} has {len(receiver_sockets)} active socket(s) on this worker")
             
-            if not receiver_sockets:
+            if not is_user_online(receiver_id):
                 logger.warning(f"Receiver {receiver_id} is not connected - message saved but not delivered in real-time")
             
-            for receiver_sid in receiver_sockets:
-                await self.emit("new_message", message_data, room=receiver_sid)
-                logger.info(
-                    f"✅ Emitted new_message to receiver {receiver_id} (socket {receiver_sid}). "
-                    f"[PRIVACY: Content is encrypted and unreadable by server]"
-                )
+            delivered = await emit_to_user(receiver_id, "new_message", message_data)
+            logger.info(
+                f"✅ Queued new_message to receiver {receiver_id} on {delivered} local socket(s). "
+                f"[PRIVACY: Content is encrypted and unreadable by server]"
+            )
             
-            sender_sockets = user_socket_map.get(sender_id, set())
-            for sender_sid in sender_sockets:
-                if sender_sid != sid:
-                    await self.emit("new_message", message_data, room=sender_sid)
-                    logger.info(
-                        f"Emitted new_message to sender {sender_id} (socket {sender_sid}) for sync. "
-                        f"[PRIVACY: Content is encrypted and unreadable by server]"
-                    )
+            await emit_to_user(sender_id, "new_message", message_data, skip_sid=sid)
             
-            await self.emit("message_sent", {"message_id": message.id}, room=sid)
+            await _emit_to_sids([sid], "message_sent", {"message_id": message_id})
             
         except Exception as e:
-            db.rollback()
             logger.error(f"Error sending message from user {sender_id}: {str(e)}")
             await self.emit("error", {"message": "Failed to send message"}, room=sid)
-        finally:
-            db.close()
+    
+    @socket_rate_limit("send_message", concurrency="db_writes")
+    async def on_send_group_message(self, sid, data):
+        session = await self.get_session(sid)
+        if not session or "user_id" not in session:
+            await self.emit("error", {"message": "Unauthorized"}, room=sid)
+            return
+        
+        data = decode_payload(data, socket_wire_format.get(sid, WIRE_JSON))
+        sender_id = session["user_id"]
+        encrypted_content = data.get("encrypted_content")
+        message_type = data.get("message_type", "text")
+        media_url = data.get("media_url")
+        try:
+            conversation_id = int(data.get("conversation_id"))
+            reply_to_message_id = int(data["reply_to_message_id"]) if data.get("reply_to_message_id") else None
+        except (ValueError, TypeError):
+            await self.emit("error", {"message": "Invalid conversation_id"}, room=sid)
+            return
+        if not encrypted_content:
+            await self.emit("error", {"message": "Missing encrypted_content"}, room=sid)
+            return
+        
+        now_utc = datetime.now(timezone.utc)
+        
+        def store():
+            db: Session = SessionLocal()
+            try:
+                if sender_id not in member_ids(db, conversation_id):
+                    return "Group not found"
+                saved = insert_group_message(
+                    db, conversation_id, sender_id, encrypted_content, message_type, media_url, reply_to_message_id, now_utc
+                )
+                if saved is None:
+                    db.rollback()
+                    logger.warning(f"User {sender_id} failed to post to group {conversation_id} (not a member or bad reply {reply_to_message_id})")
+                    return "Reply message not found" if reply_to_message_id else "Group not found"
+                db.commit()
+                return saved
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+        
+        try:
+            saved = await asyncio.to_thread(store)
+            if isinstance(saved, str):
+                await self.emit("error", {"message": saved}, room=sid)
+                return
+            message_id, timestamp = saved
+            record_message(sender_id, message_type, now_utc)
+            
+            message_data = {
+                "id": message_id,
+                "conversation_id": conversation_id,
+                "sender_id": sender_id,
+                "encrypted_content": encrypted_content,
+                "message_type": message_type,
+                "media_url": media_url,
+                "reply_to_message_id": reply_to_message_id,
+                "timestamp": isoformat_utc(timestamp),
+            }
+            await emit_to_group(conversation_id, "new_group_message", message_data, skip_sid=sid)
+            await _emit_to_sids([sid], "message_sent", {"message_id": message_id, "conversation_id": conversation_id})
+            logger.info(f"Group message {message_id} saved for group {conversation_id} from user {sender_id}")
+        except Exception as e:
+            logger.error(f"Error sending group message from user {sender_id}: {str(e)}")
+            await self.emit("error", {"message": "Failed to send message"}, room=sid)
     
     async def on_typing(self, sid, data):
         session = await self.get_session(sid)
@@ -245,50 +355,245 @@ class ChatNamespace(AsyncNamespace):
             logger.warning(f"Unauthorized typing event from socket {sid}")
             return
         
+        data = decode_payload(data, socket_wire_format.get(sid, WIRE_JSON))
         sender_id = session["user_id"]
         receiver_id = data.get("receiver_id")
-        is_typing = data.get("is_typing", False)
+        is_typing = bool(data.get("is_typing", False))
         
         if not receiver_id:
             return
         
-        db: Session = SessionLocal()
         try:
-            receiver = db.query(User).filter(User.id == receiver_id).first()
-            if not receiver:
-                return
-        finally:
-            db.close()
+            receiver_id = int(receiver_id)
+        except (ValueError, TypeError):
+            return
         
-        typing_data = {
-            "sender_id": sender_id,
-            "is_typing": is_typing
-        }
+        await typing_relay.update(sid, sender_id, receiver_id, is_typing)
+    
+    async def on_get_public_keys(self, sid, data):
+        await self._batch_lookup(sid, data, "public_keys", lambda db, viewer_id, user_ids: public_keys(db, user_ids), primary=True)
+    
+    async def on_get_profiles(self, sid, data):
+        await self._batch_lookup(
+            sid, data, "profiles",
+            lambda db, viewer_id, user_ids: user_cards(db, viewer_id, user_ids, is_user_online)
+        )
+    
+    async def _batch_lookup(self, sid, data, event: str, lookup, primary: bool = False):
+        session = await self.get_session(sid)
+        if not session or "user_id" not in session:
+            await self.emit("error", {"message": "Unauthorized"}, room=sid)
+            return
+        
+        data = decode_payload(data, socket_wire_format.get(sid, WIRE_JSON))
+        try:
+            user_ids = parse_user_ids(data.get("user_ids") if isinstance(data, dict) else None)
+        except (ValueError, TypeError) as e:
+            await self.emit("error", {"message": str(e), "event": event}, room=sid)
+            return
         
-        receiver_sockets = user_socket_map.get(receiver_id, set())
-        for receiver_sid in receiver_sockets:
-            await self.emit("typing", typing_data, room=receiver_sid)
-            logger.debug(f"Relayed typing status from user {sender_id} to user {receiver_id}")
+        viewer_id = session["user_id"]
+        
+        def run():
+            db = SessionLocal() if primary else read_session(viewer_id)
+            try:
+                return lookup(db, viewer_id, user_ids)
+            finally:
+                db.close()
+        
+        try:
+            items = await asyncio.to_thread(run)
+        except Exception as e:
+            logger.error(f"Batch lookup {event} failed for user {viewer_id}: {e}")
+            await self.emit("error", {"message": "Lookup failed", "event": event}, room=sid)
+            return
+        
+        _, etag = encode_batch(items)
+        if data.get("etag") == etag:
+            await _emit_to_sids([sid], event, {"etag": etag, "not_modified": True})
+        else:
+            await _emit_to_sids([sid], event, {"etag": etag, "items": items})
 
 
 _sio_server = None
+_fanout: Optional[SocketFanout] = None
 
 def set_sio_server(sio):
-    global _sio_server
+    global _sio_server, _fanout
     _sio_server = sio
+    _fanout = SocketFanout(sio)
+
+def get_fanout() -> Optional[SocketFanout]:
+    return _fanout
+
+async def _emit_to_sids(sids, event: str, data, coalesce_key=None, skip_sid=None) -> int:
+    by_format: Dict[str, list] = {}
+    for target_sid in list(sids):
+        if target_sid == skip_sid:
+            continue
+        by_format.setdefault(socket_wire_format.get(target_sid, WIRE_JSON), []).append(target_sid)
+    
+    delivered = 0
+    for wire_format, format_sids in by_format.items():
+        payload = encode_payload(data, wire_format)
+        if _fanout is not None:
+            delivered += _fanout.send_many(format_sids, event, payload, coalesce_key=coalesce_key)
+            continue
+        for target_sid in format_sids:
+            await _sio_server.emit(event, payload, room=target_sid)
+            delivered += 1
+    return delivered
+
+def is_user_online(user_id: int) -> bool:
+    return bool(user_socket_map.get(user_id)) or bool(remote_presence.get(user_id))
+
+async def emit_to_user(user_id: int, event: str, data, coalesce_key=None, skip_sid=None) -> int:
+    delivered = await _emit_to_sids(user_socket_map.get(user_id, set()), event, data, coalesce_key=coalesce_key, skip_sid=skip_sid)
+    if remote_presence.get(user_id):
+        await event_bus.publish("emit", {"user_id": user_id, "event": event, "data": data, "coalesce_key": coalesce_key})
+    return delivered
+
+async def _disconnect_local(user_id: int):
+    if _sio_server is None:
+        return
+    for sid in list(user_socket_map.get(user_id, ())):
+        await _sio_server.disconnect(sid)
+
+async def disconnect_user(user_id: int):
+    await _disconnect_local(user_id)
+    await event_bus.publish("disconnect_user", {"user_id": user_id})
+
+async def notify_key_changed(user_id: int, key_version: int, public_key: str, peer_ids) -> int:
+    data = {"user_id": user_id, "key_version": key_version, "public_key": public_key}
+    delivered = await emit_to_user(user_id, "key_changed", data, coalesce_key=user_id)
+    for peer_id in peer_ids:
+        if is_user_online(peer_id):
+            delivered += await emit_to_user(peer_id, "key_changed", data, coalesce_key=user_id)
+    return delivered
+
+async def notify_message_changed(change: dict) -> int:
+    delivered = 0
+    for user_id in (change["sender_id"], change["receiver_id"]):
+        if is_user_online(user_id):
+            delivered += await emit_to_user(user_id, "message_changed", change)
+    return delivered
+
+def group_room(conversation_id: int, wire_format: str) -> str:
+    return f"group:{conversation_id}:{wire_format}"
+
+async def _emit_to_group_rooms(conversation_id: int, event: str, data, skip_sid=None):
+    for wire_format in WIRE_FORMATS:
+        await _sio_server.emit(event, encode_payload(data, wire_format), room=group_room(conversation_id, wire_format), skip_sid=skip_sid)
+
+async def emit_to_group(conversation_id: int, event: str, data, skip_sid=None):
+    if _sio_server is not None:
+        await _emit_to_group_rooms(conversation_id, event, data, skip_sid=skip_sid)
+    await event_bus.publish("group_emit", {"conversation_id": conversation_id, "event": event, "data": data})
+
+def _update_group_rooms(conversation_id: int, added, removed):
+    forget_members(conversation_id)
+    if _sio_server is None:
+        return
+    for user_id in added:
+        for sid in user_socket_map.get(user_id, ()):
+            _sio_server.enter_room(sid, group_room(conversation_id, socket_wire_format.get(sid, WIRE_JSON)))
+    for user_id in removed:
+        for sid in user_socket_map.get(user_id, ()):
+            _sio_server.leave_room(sid, group_room(conversation_id, socket_wire_format.get(sid, WIRE_JSON)))
+
+async def notify_group_members_changed(conversation_id: int, added, removed):
+    added, removed = list(added), list(removed)
+    _update_group_rooms(conversation_id, added, removed)
+    await event_bus.publish("group_members", {"conversation_id": conversation_id, "added": added, "removed": removed})
+    data = {"conversation_id": conversation_id, "added": added, "removed": removed}
+    await emit_to_group(conversation_id, "group_updated", data)
+    for user_id in removed:
+        if is_user_online(user_id):
+            await emit_to_user(user_id, "group_updated", data)
+
+def _schedule_group_members_changed(conversation_id: int, added, removed):
+    loop = event_bus.loop
+    if loop is None or loop.is_closed():
+        return
+    asyncio.run_coroutine_threadsafe(notify_group_members_changed(conversation_id, added, removed), loop)
+
+async def _on_bus_group_emit(origin: str, message: dict):
+    if _sio_server is not None:
+        await _emit_to_group_rooms(message["conversation_id"], message["event"], message["data"])
+
+async def _on_bus_group_members(origin: str, message: dict):
+    _update_group_rooms(message["conversation_id"], message["added"], message["removed"])
+
+async def _on_bus_emit(origin: str, message: dict):
+    sids = user_socket_map.get(message["user_id"])
+    if sids:
+        await _emit_to_sids(sids, message["event"], message["data"], coalesce_key=message.get("coalesce_key"))
+
+async def _on_bus_presence(origin: str, message: dict):
+    user_id = message["user_id"]
+    if message["online"]:
+        remote_presence.setdefault(user_id, set()).add(origin)
+    elif user_id in remote_presence:
+        remote_presence[user_id].discard(origin)
+        if not remote_presence[user_id]:
+            del remote_presence[user_id]
+
+async def _on_bus_snapshot(origin: str, message: dict):
+    _forget_worker(origin)
+    for user_id in message["user_ids"]:
+        remote_presence.setdefault(user_id, set()).add(origin)
+
+async def _on_bus_snapshot_request(origin: str, message: dict):
+    await event_bus.publish("presence_snapshot", {"user_ids": list(user_socket_map)})
+
+async def _on_bus_connected(origin: str, message: dict):
+    await event_bus.publish("presence_snapshot", {"user_ids": list(user_socket_map)})
+    await event_bus.publish("presence_snapshot_request", {})
+
+async def _on_worker_down(origin: str, message: dict):
+    _forget_worker(message["worker_id"])
+    logger.info(f"Worker {message['worker_id']} went down, dropped its presence")
+
+def _forget_worker(worker_id: str):
+    for user_id in list(remote_presence):
+        remote_presence[user_id].discard(worker_id)
+        if not remote_presence[user_id]:
+            del remote_presence[user_id]
+
+async def _on_bus_disconnect_user(origin: str, message: dict):
+    await _disconnect_local(message["user_id"])
+
+async def _on_bus_user_write(origin: str, message: dict):
+    mark_user_write(message["user_id"], broadcast=False)
+
+event_bus.on("emit", _on_bus_emit)
+event_bus.on("presence", _on_bus_presence)
+event_bus.on("presence_snapshot", _on_bus_snapshot)
+event_bus.on("presence_snapshot_request", _on_bus_snapshot_request)
+event_bus.on("bus_connected", _on_bus_connected)
+event_bus.on("worker_down", _on_worker_down)
+event_bus.on("user_write", _on_bus_user_write)
+event_bus.on("group_emit", _on_bus_group_emit)
+event_bus.on("group_members", _on_bus_group_members)
+event_bus.on("disconnect_user", _on_bus_disconnect_user)
+set_write_listener(lambda user_id: event_bus.publish_nowait("user_write", {"user_id": user_id}))
+set_members_listener(_schedule_group_members_changed)
+
+async def _deliver_typing(receiver_id: int, typing_data: dict):
+    await emit_to_user(receiver_id, "typing", typing_data, coalesce_key=typing_data["sender_id"])
+
+typing_relay = TypingRelay(_deliver_typing, is_user_online)
 
 async def notify_messages_read(sender_id: int, message_ids: list, reader_id: int):
     if _sio_server is None:
         logger.warning("Socket.IO server not initialized, cannot send read receipt")
         return
     
-    sender_sockets = user_socket_map.get(sender_id, set())
-    if sender_sockets:
+    if is_user_online(sender_id):
         read_data = {
             "message_ids": message_ids,
             "reader_id": reader_id
         }
-        for sender_sid in sender_sockets:
-            await _sio_server.emit("messages_read", read_data, room=sender_sid)
+        await emit_to_user(sender_id, "messages_read", read_data)
         logger.info(f"Sent read receipt notification to sender {sender_id} for messages {message_ids}")
 
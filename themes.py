@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import delete, update
+from sqlalchemy.orm import Session
+
+from event_bus import event_bus
+from models import UserTheme
+from serialization import encode_batch
+
+logger = logging.getLogger(__name__)
+
+THEME_CACHE_SIZE = 10000
+THEME_CACHE_TTL = 300
+THEME_SYNC_MAX = 100
+THEME_FIELDS = (
+    "id", "name", "primary_color", "background_color", "bubble_color_me", "bubble_color_other",
+    "text_color", "secondary_text_color", "brightness", "wallpaper_url", "wallpaper_blur", "created_at",
+)
+THEME_COLUMNS = tuple(getattr(UserTheme, name) for name in THEME_FIELDS)
+THEME_EDITABLE_FIELDS = THEME_FIELDS[1:-1]
+
+_theme_cache: "OrderedDict[int, Tuple[Tuple[bytes, str], float]]" = OrderedDict()
+_theme_lock = threading.Lock()
+_theme_generation: Dict[int, int] = {}
+
+
+class ThemeNotFound(Exception):
+    pass
+
+
+def invalidate_themes(user_id: int, broadcast: bool = True):
+    with _theme_lock:
+        _theme_cache.pop(user_id, None)
+        _theme_generation[user_id] = _theme_generation.get(user_id, 0) + 1
+    if broadcast:
+        event_bus.publish_nowait("themes_changed", {"user_id": user_id})
+
+
+def theme_list(db: Session, user_id: int) -> Tuple[bytes, str]:
+    now = time.monotonic()
+    cached = _theme_cache.get(user_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    generation = _theme_generation.get(user_id, 0)
+    rows = db.query(*THEME_COLUMNS).filter(UserTheme.user_id == user_id).order_by(
+        UserTheme.created_at.desc(), UserTheme.id.desc()
+    ).all()
+    cached = encode_batch([dict(zip(THEME_FIELDS, row)) for row in rows])
+    with _theme_lock:
+        if _theme_generation.get(user_id, 0) != generation:
+            return cached
+        _theme_cache[user_id] = (cached, now + THEME_CACHE_TTL)
+        _theme_cache.move_to_end(user_id)
+        while len(_theme_cache) > THEME_CACHE_SIZE:
+            _theme_cache.popitem(last=False)
+    return cached
+
+
+def _theme_values(item) -> dict:
+    return {name: getattr(item, name) for name in THEME_EDITABLE_FIELDS}
+
+
+def sync_themes(db: Session, user_id: int, upserts: List, deleted: Iterable[int]) -> List[dict]:
+    deleted = set(deleted)
+    updates = [item for item in upserts if item.id is not None]
+    inserts = [item for item in upserts if item.id is None]
+
+    requested = {item.id for item in updates} | deleted
+    if requested:
+        owned = {theme_id for (theme_id,) in db.query(UserTheme.id).filter(
+            UserTheme.user_id == user_id,
+            UserTheme.id.in_(requested)
+        )}
+        missing = requested - owned
+        if missing:
+            raise ThemeNotFound(sorted(missing))
+
+    try:
+        if deleted:
+            db.execute(delete(UserTheme).where(UserTheme.user_id == user_id, UserTheme.id.in_(deleted)))
+        updates = [item for item in updates if item.id not in deleted]
+        if updates:
+            db.execute(update(UserTheme), [{"id": item.id, **_theme_values(item)} for item in updates])
+        created = [UserTheme(user_id=user_id, **_theme_values(item)) for item in inserts]
+        db.add_all(created)
+        db.flush()
+        created_ids = [theme.id for theme in created]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        invalidate_themes(user_id)
+
+    logger.info(f"Theme sync for user {user_id}: {len(created)} created, {len(updates)} updated, {len(deleted)} deleted")
+    return [{"client_id": item.client_id, "id": theme_id} for item, theme_id in zip(inserts, created_ids)]
+
+
+async def _on_bus_themes_changed(origin: str, message: dict):
+    invalidate_themes(message["user_id"], broadcast=False)
+
+
+event_bus.on("themes_changed", _on_bus_themes_changed)
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TYPING_TTL = 6.0
+TYPING_STOP_DEBOUNCE = 1.0
+TYPING_RATE_PER_SECOND = 4.0
+TYPING_BURST = 8
+
+
+class _TypingState:
+    def __init__(self):
+        self.relayed = False
+        self.expire_handle: Optional[asyncio.TimerHandle] = None
+        self.stop_handle: Optional[asyncio.TimerHandle] = None
+
+    def cancel_timers(self):
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+        if self.stop_handle is not None:
+            self.stop_handle.cancel()
+            self.stop_handle = None
+
+
+class TypingRelay:
+    def __init__(self, deliver: Callable[[int, dict], Awaitable[None]], is_online: Callable[[int], bool]):
+        self.deliver = deliver
+        self.is_online = is_online
+        self.states: Dict[Tuple[int, int], _TypingState] = {}
+        self.buckets: Dict[str, list] = {}
+
+    def allow(self, sid: str) -> bool:
+        now = time.monotonic()
+        bucket = self.buckets.get(sid)
+        if bucket is None:
+            bucket = [float(TYPING_BURST), now]
+            self.buckets[sid] = bucket
+        tokens = min(float(TYPING_BURST), bucket[0] + (now - bucket[1]) * TYPING_RATE_PER_SECOND)
+        bucket[1] = now
+        if tokens < 1.0:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1.0
+        return True
+
+    async def update(self, sid: str, sender_id: int, receiver_id: int, is_typing: bool):
+        if not self.allow(sid):
+            logger.debug(f"Typing event from socket {sid} rate-limited")
+            return
+
+        key = (sender_id, receiver_id)
+        state = self.states.get(key)
+
+        if not self.is_online(receiver_id):
+            if state is not None:
+                state.cancel_timers()
+                del self.states[key]
+            return
+
+        if is_typing:
+            if state is None:
+                state = _TypingState()
+                self.states[key] = state
+            if state.stop_handle is not None:
+                state.stop_handle.cancel()
+                state.stop_handle = None
+            self._arm_expiry(key, state)
+            if not state.relayed:
+                state.relayed = True
+                await self._send(sender_id, receiver_id, True)
+            return
+
+        if state is None or not state.relayed:
+            return
+        if state.stop_handle is None:
+            loop = asyncio.get_event_loop()
+            state.stop_handle = loop.call_later(TYPING_STOP_DEBOUNCE, self._stop, key)
+
+    def clear(self, sender_id: int, receiver_id: int):
+        state = self.states.pop((sender_id, receiver_id), None)
+        if state is not None:
+            state.cancel_timers()
+
+    def forget_socket(self, sid: str):
+        self.buckets.pop(sid, None)
+
+    def forget_sender(self, sender_id: int):
+        for key in [k for k in self.states if k[0] == sender_id]:
+            self._stop(key)
+
+    def _arm_expiry(self, key: Tuple[int, int], state: _TypingState):
+        if state.expire_handle is not None:
+            state.expire_handle.cancel()
+        loop = asyncio.get_event_loop()
+        state.expire_handle = loop.call_later(TYPING_TTL, self._stop, key)
+
+    def _stop(self, key: Tuple[int, int]):
+        state = self.states.pop(key, None)
+        if state is None:
+            return
+        state.cancel_timers()
+        if state.relayed:
+            asyncio.ensure_future(self._send(key[0], key[1], False))
+
+    async def _send(self, sender_id: int, receiver_id: int, is_typing: bool):
+        try:
+            await self.deliver(receiver_id, {"sender_id": sender_id, "is_typing": is_typing})
+        except Exception as e:
+            logger.error(f"Error relaying typing status from user {sender_id} to user {receiver_id}: {e}")
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = int(os.environ.get("USAGE_FLUSH_INTERVAL_SECONDS", "60"))
+USAGE_PERIODS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+USAGE_SERIES_MAX = {"hour": 24 * 14, "day": 366}
+MESSAGE_TYPES = ("text", "image")
+ACTIVE_USERS_KEEP = timedelta(days=2)
+
+Bucket = Tuple[str, datetime]
+
+_pending_counts: Dict[Tuple[str, datetime, str], int] = defaultdict(int)
+_pending_active: Set[Tuple[str, datetime, int]] = set()
+_pending_lock = threading.Lock()
+
+_upsert_counter = text(
+    "INSERT INTO usage_rollups (period, bucket_start, metric, value) "
+    "VALUES (:period, :bucket_start, :metric, :value) "
+    "ON CONFLICT (period, bucket_start, metric) DO UPDATE SET value = usage_rollups.value + excluded.value"
+).bindparams(bindparam("bucket_start", type_=DateTime))
+
+_insert_active = text(
+    "INSERT INTO usage_active_users (period, bucket_start, user_id) "
+    "VALUES (:period, :bucket_start, :user_id) ON CONFLICT DO NOTHING"
+).bindparams(bindparam("bucket_start", type_=DateTime))
+
+_refresh_active = text(
+    "INSERT INTO usage_rollups (period, bucket_start, metric, value) "
+    "SELECT period, bucket_start, 'active_users', COUNT(*) FROM usage_active_users "
+    "WHERE period = :period AND bucket_start = :bucket_start GROUP BY period, bucket_start "
+    "ON CONFLICT (period, bucket_start, metric) DO UPDATE SET value = excluded.value"
+).bindparams(bindparam("bucket_start", type_=DateTime))
+
+_prune_active = text(
+    "DELETE FROM usage_active_users WHERE period = :period AND bucket_start < :cutoff"
+).bindparams(bindparam("cutoff", type_=DateTime))
+
+_select_series = text(
+    "SELECT bucket_start, metric, value FROM usage_rollups "
+    "WHERE period = :period AND bucket_start >= :since ORDER BY bucket_start DESC"
+).bindparams(bindparam("since", type_=DateTime)).columns(bucket_start=DateTime)
+
+
+def bucket_start(period: str, when: datetime) -> datetime:
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    when = when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0) if period == "day" else when
+
+
+def _buckets(when: Optional[datetime]) -> List[Bucket]:
+    when = when or datetime.now(timezone.utc)
+    return [(period, bucket_start(period, when)) for period in USAGE_PERIODS]
+
+
+def _count(metric: str, amount: int = 1, user_id: Optional[int] = None, when: Optional[datetime] = None):
+    with _pending_lock:
+        for period, start in _buckets(when):
+            _pending_counts[(period, start, metric)] += amount
+            if user_id is not None:
+                _pending_active.add((period, start, user_id))
+
+
+def record_message(user_id: int, message_type: Optional[str], when: Optional[datetime] = None):
+    kind = message_type if message_type in MESSAGE_TYPES else "other"
+    _count(f"messages.{kind}", user_id=user_id, when=when)
+
+
+def record_upload(user_id: int, size: int, when: Optional[datetime] = None):
+    _count("media_bytes", size, user_id=user_id, when=when)
+
+
+def record_registration(when: Optional[datetime] = None):
+    _count("registrations", when=when)
+
+
+def _take_pending():
+    global _pending_counts, _pending_active
+    with _pending_lock:
+        counts, active = _pending_counts, _pending_active
+        _pending_counts, _pending_active = defaultdict(int), set()
+    return counts, active
+
+
+def _restore_pending(counts, active):
+    with _pending_lock:
+        for key, value in counts.items():
+            _pending_counts[key] += value
+        _pending_active.update(active)
+
+
+def flush_usage(db: Session) -> int:
+    counts, active = _take_pending()
+    if not counts and not active:
+        return 0
+    try:
+        if counts:
+            db.execute(_upsert_counter, [
+                {"period": period, "bucket_start": start, "metric": metric, "value": value}
+                for (period, start, metric), value in counts.items()
+            ])
+        if active:
+            db.execute(_insert_active, [
+                {"period": period, "bucket_start": start, "user_id": user_id}
+                for period, start, user_id in active
+            ])
+            for period, start in {(period, start) for period, start, _ in active}:
+                db.execute(_refresh_active, {"period": period, "bucket_start": start})
+        cutoff = bucket_start("day", datetime.now(timezone.utc)) - ACTIVE_USERS_KEEP
+        for period in USAGE_PERIODS:
+            db.execute(_prune_active, {"period": period, "cutoff": cutoff})
+        db.commit()
+    except Exception:
+        db.rollback()
+        _restore_pending(counts, active)
+        raise
+    logger.debug(f"Usage rollups flushed: {len(counts)} counter(s), {len(active)} active user mark(s)")
+    return len(counts)
+
+
+def usage_series(db: Session, period: str, buckets: int) -> List[dict]:
+    step = USAGE_PERIODS[period]
+    buckets = max(1, min(buckets, USAGE_SERIES_MAX[period]))
+    since = bucket_start(period, datetime.now(timezone.utc)) - step * (buckets - 1)
+    series: Dict[datetime, dict] = {}
+    for start, metric, value in db.execute(_select_series, {"period": period, "since": since}):
+        row = series.setdefault(start, {
+            "bucket_start": start.replace(tzinfo=timezone.utc).isoformat(),
+            "messages": {},
+            "messages_total": 0,
+            "active_users": 0,
+            "media_bytes": 0,
+            "registrations": 0,
+        })
+        if metric.startswith("messages."):
+            row["messages"][metric.split(".", 1)[1]] = value
+            row["messages_total"] += value
+        else:
+            row[metric] = value
+    return list(series.values())
+
+
+class UsageFlusher:
+    def __init__(self, interval: int = USAGE_FLUSH_INTERVAL):
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        try:
+            await asyncio.to_thread(self.run_once)
+        except Exception as e:
+            logger.error(f"Failed to flush usage rollups on shutdown: {e}")
+
+    def run_once(self):
+        db = SessionLocal()
+        try:
+            flush_usage(db)
+        finally:
+            db.close()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logger.error(f"Failed to flush usage rollups: {e}")
+
+
+usage_flusher = UsageFlusher()
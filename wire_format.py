@@ -0,0 +1,97 @@
+import base64
+import binascii
+import urllib.parse
+from datetime import datetime, timezone
+from typing import Optional
+
+WIRE_JSON = "json"
+WIRE_COMPACT = "compact"
+WIRE_FORMATS = {WIRE_JSON, WIRE_COMPACT}
+
+COMPACT_KEYS = {
+    "id": "i",
+    "sender_id": "s",
+    "receiver_id": "r",
+    "encrypted_content": "c",
+    "message_type": "t",
+    "media_url": "m",
+    "reply_to_message_id": "p",
+    "timestamp": "ts",
+    "is_read": "rd",
+    "message_id": "mi",
+    "message_ids": "ids",
+    "reader_id": "rr",
+    "is_typing": "ty",
+    "seq": "sq",
+    "kind": "k",
+    "conversation_id": "cv",
+}
+FULL_KEYS = {short: full for full, short in COMPACT_KEYS.items()}
+
+
+def negotiate_wire_format(environ: dict, auth=None) -> str:
+    requested = None
+    if auth and isinstance(auth, dict):
+        requested = auth.get("wire")
+    if not requested and environ.get("QUERY_STRING"):
+        query_string = environ["QUERY_STRING"]
+        if isinstance(query_string, bytes):
+            query_string = query_string.decode("utf-8")
+        values = urllib.parse.parse_qs(query_string).get("wire")
+        if values:
+            requested = values[0]
+    return requested if requested in WIRE_FORMATS else WIRE_JSON
+
+
+def _timestamp_ms(value) -> Optional[int]:
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, str):
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    else:
+        return value
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def _ciphertext_bytes(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return value
+    return raw if base64.b64encode(raw).decode("ascii") == value else value
+
+
+def encode_payload(data, wire_format: str):
+    if wire_format != WIRE_COMPACT or not isinstance(data, dict):
+        return data
+    compact = {}
+    for key, value in data.items():
+        if value is None:
+            continue
+        if key == "timestamp":
+            value = _timestamp_ms(value)
+        elif key == "encrypted_content":
+            value = _ciphertext_bytes(value)
+        elif isinstance(value, bool):
+            value = int(value)
+        compact[COMPACT_KEYS.get(key, key)] = value
+    return compact
+
+
+def decode_payload(data, wire_format: str):
+    if wire_format != WIRE_COMPACT or not isinstance(data, dict):
+        return data
+    decoded = {}
+    for key, value in data.items():
+        full_key = FULL_KEYS.get(key, key)
+        if full_key == "encrypted_content" and isinstance(value, (bytes, bytearray)):
+            value = base64.b64encode(bytes(value)).decode("ascii")
+        decoded[full_key] = value
+    return decoded